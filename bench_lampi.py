@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+"""
+bench_lampi.py
+Benchmarks for lampi_lib that run without a Pi or a network connection.
+Lights are driven through the simulated GPIO backend, and forecast payloads
+are generated by lampi_sim in the same layout as wunderground.com's hourly
+forecast JSON (or read from recorded files).
+
+Results are printed, or written with --output, as JSON along with the git
+commit they were run on. Each result has a unique name, so a run can be
+checked against an earlier one with --compare to catch regressions.
+"""
+
+import lampi_lib as ll
+import lampi_sim
+import io
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import argparse
+
+
+##How to compare each measurement: True if bigger is better.
+HIGHER_IS_BETTER = {'seconds': False, 'peak_bytes': False, 'wire_bytes': False,
+                    'frame_rate': True, 'jitter': False, 'max_late': False, 'skipped': False,
+                    'per_second': True, 'speedup': True,
+                    'median_latency': False, 'max_latency': False, 'duration_error': False}
+
+
+def _measure(func, repeat):
+    """Run func repeat times, returning (best seconds per run, peak bytes allocated in one run)."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter()-start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def _throughput(func, calls, repeat):
+    """Best calls per second of func over repeat runs of calls calls."""
+    seconds = _measure(lambda: [func(i) for i in range(calls)], repeat)[0]
+    return calls/seconds
+
+
+def _animation_result(name, run, frame_time):
+    """Run one animation on a simulated light, timing every frame it shows."""
+    backend = ll.SimulatedBackend()
+    globe = ll.light(19, 21, 23, backend=backend)
+    lateness = []
+    start = time.perf_counter()
+    skipped = run(globe, lambda index, late: lateness.append(late))
+    elapsed = time.perf_counter()-start
+    mean = sum(lateness)/len(lateness)
+    return {'name': name, 'frame_time': frame_time, 'frames': len(lateness),
+            'frame_rate': len(lateness)/elapsed,
+            'jitter': (sum((late-mean)**2 for late in lateness)/len(lateness))**0.5,
+            'max_late': max(lateness), 'skipped': skipped, 'writes': len(backend.times)}
+
+
+def bench_animation(seconds=3):
+    """Frame rate and timing jitter of ramp, one_pulse and pulse_light on a simulated light."""
+    results = []
+
+    def ramp(globe, report):
+        clock = ll.FrameClock(0.02, report=report)
+        ll.play_frames(globe, ll.compile_ramp(255, 128, 0, int(seconds/0.02)), clock)
+        return clock.skipped
+    results.append(_animation_result('ramp', ramp, 0.02))
+
+    def one_pulse(globe, report):
+        ll.one_pulse(globe, 0, 100, 255, report=report)
+        return None #skips aren't reported by one_pulse.
+    results.append(_animation_result('one_pulse', one_pulse, 0.1))
+
+    def pulse_light(globe, report):
+        ll.pulse_light(globe, 255, 128, 0, 60, 255, time.time()+seconds, report=report)
+        return None
+    results.append(_animation_result('pulse_light', pulse_light, 0.5/36))
+    return results
+
+
+def _payloads(hours_list, recordings):
+    """(label, hours, bytes) forecast payloads to parse: generated ones, then any recorded ones."""
+    payloads = [('%dh' % hours, hours, json.dumps(lampi_sim.sample_hourly_forecast(hours)).encode('utf-8'))
+                for hours in hours_list]
+    if recordings:
+        for name in sorted(os.listdir(recordings)):
+            if name.endswith('.json'):
+                with open(os.path.join(recordings, name), 'rb') as f:
+                    data = f.read()
+                hours = len(json.loads(data.decode('utf-8'))['hourly_forecast'])
+                payloads.append((name[:-len('.json')], hours, data))
+    return payloads
+
+
+def bench_parse(hours_list=(36, 240), foretime=3, repeat=20, recordings=None):
+    """Compare loading the whole forecast JSON with stream_hourly_json on payloads of each size."""
+    results = []
+    for label, hours, payload in _payloads(hours_list, recordings):
+
+        def full():
+            parsed = json.loads(io.BytesIO(payload).read().decode('utf-8'))
+            return ll.extractHourlyUWeather(parsed, foretime)
+
+        def streamed():
+            parsed = ll.stream_hourly_json(io.BytesIO(payload), [foretime])
+            return ll.extractHourlyUWeather(parsed, foretime)
+
+        for name, func in (('full', full), ('stream', streamed)):
+            seconds, peak = _measure(func, repeat)
+            results.append({'name': 'parse_'+name+'_'+label, 'hours': hours, 'bytes': len(payload),
+                            'seconds': seconds, 'peak_bytes': peak})
+    return results
+
+
+def bench_download(hours_list=(36, 240), foretime=3, repeat=10):
+    """getUWeather + extractHourlyUWeather from a local FakeForecastServer, whole and streamed."""
+    results = []
+    for hours in hours_list:
+        server = lampi_sim.FakeForecastServer(hours=hours).start()
+        try:
+            for name, wanted in (('full', None), ('stream', [foretime])):
+                def download():
+                    with contextlib.redirect_stdout(io.StringIO()): #getUWeather is chatty.
+                        data = ll.getUWeather('BENCH', 'SIM/Bench', hours=wanted, base_url=server.url)
+                    return ll.extractHourlyUWeather(data, foretime)
+                seconds, peak = _measure(download, repeat)
+                results.append({'name': 'download_'+name+'_%dh' % hours, 'hours': hours,
+                                'seconds': seconds, 'peak_bytes': peak})
+        finally:
+            server.stop()
+    return results
+
+
+def bench_providers(locations=20, hours=240, repeat=5):
+    """
+    Forecasts for many locations from a local FakeForecastServer: one
+    getUWeather request each on new connections, one request each over a
+    kept-alive WundergroundProvider connection, and one batched
+    OpenMeteoProvider request. Bytes are as sent, gzip-compressed.
+    """
+    results = []
+    server = lampi_sim.FakeForecastServer(hours=hours).start()
+    wunderground = server.provider('wunderground')
+    open_meteo = server.provider('open-meteo')
+    try:
+        def each_new_connection():
+            with contextlib.redirect_stdout(io.StringIO()): #getUWeather is chatty.
+                for n in range(locations):
+                    ll.ForecastSeries.from_hourly(ll.getUWeather('BENCH', 'SIM/Lamp%d' % n, base_url=server.url))
+
+        def each_kept_alive():
+            wunderground.fetch_many(['SIM/Lamp%d' % n for n in range(locations)])
+
+        def batched():
+            open_meteo.fetch_many(['%d.5,%d.5' % (n % 90, n) for n in range(locations)])
+
+        for name, func in (('each_new_connection', each_new_connection), ('each_kept_alive', each_kept_alive),
+                           ('batched', batched)):
+            sent = server.bytes_sent
+            func()
+            wire_bytes = server.bytes_sent-sent
+            seconds, peak = _measure(func, repeat)
+            results.append({'name': 'providers_'+name, 'locations': locations, 'hours': hours,
+                            'seconds': seconds, 'wire_bytes': wire_bytes, 'peak_bytes': peak})
+    finally:
+        wunderground.close()
+        open_meteo.close()
+        server.stop()
+    return results
+
+
+def bench_commands(commands=20, seconds=4):
+    """
+    Seconds from putting a command on a ControlledLight's queue to it
+    showing, while the light fades, holds a colour and pulses.
+    """
+    results = []
+    effects = {
+        'fade': lambda globe, queue: ll.crossfade(globe, (0, 0, 0), (255, 128, 0), steps=int(seconds*10)),
+        'hold': lambda globe, queue: ll.pulse_light(globe, 255, 128, 0, 0, 255, time.time()+seconds,
+                                                    wake=queue),
+        'pulse': lambda globe, queue: ll.pulse_light(globe, 255, 128, 0, 60, 255, time.time()+seconds,
+                                                     wake=queue),
+    }
+    kinds = [{'command': 'brightness', 'level': 0.5}, {'command': 'brightness', 'level': 1},
+             {'command': 'notify', 'pulses': 1, 'seconds': 0.1}]
+    for name, effect in effects.items():
+        globe = ll.ControlledLight(ll.light(19, 21, 23, backend=ll.SimulatedBackend()))
+        player = threading.Thread(target=effect, args=(globe, globe.queue))
+        player.start()
+        for n in range(commands):
+            time.sleep(seconds*0.8/commands)
+            globe.queue.put(ll.Command.from_dict(kinds[n % len(kinds)])).done.wait(1)
+        player.join()
+        latencies = sorted(globe.latencies)
+        results.append({'name': 'command_'+name, 'commands': len(latencies),
+                        'median_latency': latencies[len(latencies)//2], 'max_latency': latencies[-1]})
+    return results
+
+
+class _SlowBackend(ll.SimulatedBackend):
+    """SimulatedBackend taking write_time seconds over every write, like a busy Pi Zero."""
+    def __init__(self, write_time):
+        super().__init__()
+        self.write_time = write_time
+
+    def commit(self, writes):
+        time.sleep(self.write_time)
+        super().commit(writes)
+
+
+def bench_governor(seconds=2, frame_time=0.02, write_time=0.03):
+    """
+    Cross-fades on a light slower to write to than the frames are short,
+    with the effects' fixed frame counts and with a FrameGovernor choosing
+    them. The governor gets one fade to learn the write time first.
+    """
+    results = []
+    for name in ('fixed', 'governed'):
+        if name == 'governed':
+            ll.enable_governor()
+        try:
+            globe = ll.light(19, 21, 23, backend=_SlowBackend(write_time))
+            steps = int(seconds/frame_time)
+            ll.crossfade(globe, (0, 0, 0), (255, 128, 0), steps, frame_time)
+            shown = []
+            start = time.perf_counter()
+            ll.crossfade(globe, (255, 128, 0), (0, 0, 0), steps, frame_time,
+                         report=lambda index, late: shown.append((index, late)))
+            elapsed = time.perf_counter()-start
+        finally:
+            ll.disable_governor()
+        lateness = [late for index, late in shown]
+        results.append({'name': 'governor_'+name, 'frames': len(shown),
+                        'skipped': shown[-1][0]+1-len(shown), 'max_late': max(lateness),
+                        'duration_error': abs(elapsed-seconds)})
+    return results
+
+
+def bench_colour(calls=10000, repeat=5):
+    """Temperature to colour and rain to pulse throughput (calls per second)."""
+    temps = [-35+(i*0.037) % 90 for i in range(calls)]
+    scale = ll.ColourScale(ll.TEMP_SCALE)
+    lut = ll.ColourScale(ll.TEMP_SCALE, lut_resolution=0.1)
+    series = ll.ForecastSeries.from_hourly(lampi_sim.sample_hourly_forecast(240))
+    forecasts = [series.row(i % len(series)) for i in range(calls)]
+
+    funcs = {
+        'lin_interp': lambda i: [ll.lin_interp(ll.TEMP_SCALE, d, temps[i]) for d in (1, 2, 3)],
+        'colour_scale': lambda i: scale.rgb(temps[i]),
+        'colour_scale_lut': lambda i: lut.rgb(temps[i]),
+        'pulsefreq_fromrain': lambda i: ll.pulsefreq_fromrain(forecasts[i]),
+    }
+    return [{'name': name, 'calls': calls, 'per_second': _throughput(func, calls, repeat)}
+            for name, func in funcs.items()]
+
+
+def bench_replay(days=1, animated_hours=2):
+    """The whole run_weatherlight.py pipeline replayed on a virtual clock (see lampi_sim.replay)."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        lampi_sim.write_sample_recordings(directory, days)
+        recordings = lampi_sim.load_recordings(directory)
+        for name, animate, end in (('replay_animated', True, recordings[0][0]+animated_hours*3600),
+                                   ('replay_scheduled', False, None)):
+            start = time.perf_counter()
+            timeline, backend = lampi_sim.replay(recordings, animate=animate, end_epoch=end)
+            seconds = time.perf_counter()-start
+            simulated = timeline[-1]['until']-timeline[0]['epoch']
+            results.append({'name': name, 'simulated_seconds': simulated, 'refreshes': len(timeline),
+                            'writes': len(backend.times), 'seconds': seconds,
+                            'speedup': simulated/seconds})
+    return results
+
+
+def git_commit():
+    """(commit hash, True if there are uncommitted changes) for this checkout, or (None, None)."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two runs' results, matching benchmarks by name.\n
+
+    Returns a list of (name, measurement, old value, new value, change) where
+    change is the fraction it got worse by (negative for better), for every
+    measurement in HIGHER_IS_BETTER, and the ones worse by more than
+    threshold as a second list.
+    """
+    old_results = {result['name']: result for result in old['results']}
+    changes = []
+    for result in new['results']:
+        before = old_results.get(result['name'])
+        if before is None:
+            continue
+        for key, higher in HIGHER_IS_BETTER.items():
+            a, b = before.get(key), result.get(key)
+            if not a or b is None:
+                continue
+            change = (a-b)/a if higher else (b-a)/a
+            changes.append((result['name'], key, a, b, change))
+    return changes, [c for c in changes if c[4] > threshold]
+
+
+GROUPS = {'animation': bench_animation, 'parse': bench_parse, 'download': bench_download,
+          'providers': bench_providers, 'commands': bench_commands, 'governor': bench_governor,
+          'colour': bench_colour, 'replay': bench_replay}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark lampi_lib without a Pi.')
+    parser.add_argument("--repeat", default=20, type=int,
+                        help="Runs of each parsing benchmark, the best is reported. Default 20")
+    parser.add_argument("--only", action="append", choices=sorted(GROUPS),
+                        help="Only run this group of benchmarks. Can be given more than once.")
+    parser.add_argument("--recordings", default=None,
+                        help="Directory of recorded forecast JSON files to parse as well.")
+    parser.add_argument("-o", "--output", default=None, help="Write the results to this file.")
+    parser.add_argument("--compare", default=None,
+                        help="Results file from an earlier run to compare with. Exits with"
+                        " status 1 if anything got worse by more than --threshold.")
+    parser.add_argument("--threshold", default=0.1, type=float,
+                        help="Fraction worse that counts as a regression. Default 0.1")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    run = {'commit': commit, 'dirty': dirty, 'time': time.time(),
+           'python': platform.python_version(), 'machine': platform.machine(), 'results': []}
+    for group in args.only or sorted(GROUPS):
+        if group == 'parse':
+            run['results'] += bench_parse(repeat=args.repeat, recordings=args.recordings)
+        elif group == 'download':
+            run['results'] += bench_download(repeat=max(1, args.repeat//2))
+        else:
+            run['results'] += GROUPS[group]()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=1)
+    else:
+        print(json.dumps(run, indent=1))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        changes, regressions = compare(old, run, args.threshold)
+        for name, key, a, b, change in changes:
+            print("%-28s %-12s %12.6g -> %-12.6g %+7.1f%%%s" % (
+                name, key, a, b, 100*(b-a)/a, "  REGRESSION" if change > args.threshold else ""),
+                  file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+"""
+forecast_daemon.py
+www.henryleach.com
+Local forecast daemon. Downloads each location's forecast from
+wunderground.com (or another provider) at most once per interval, however
+many lamps ask for it, and serves it to them over a Unix socket. Start
+lamps with --proxy pointing at the same socket.
+"""
+
+import lampi_lib as ll
+import argparse
+
+parser = argparse.ArgumentParser(description='Serve wunderground.com forecasts to local lamps.')
+parser.add_argument("apikey", nargs="?", default=None,
+                    help="wunderground.com 16-char apikey. Optional for open-meteo.")
+parser.add_argument("-p", "--provider", default="wunderground", choices=sorted(ll.PROVIDERS),
+                    help="Weather service to get forecasts from. Default wunderground")
+parser.add_argument("-s", "--socket", default="/tmp/lampi-forecast.sock",
+                    help="Unix socket to listen on. Default /tmp/lampi-forecast.sock")
+parser.add_argument("-i", "--interval", default=10, type=int,
+                    help="Minutes between downloads of each location. Default 10")
+args = parser.parse_args()
+if args.provider == 'wunderground' and not args.apikey:
+    parser.error("wunderground.com needs an apikey.")
+
+##One kept-alive, gzip-compressed upstream connection is shared by all locations.
+provider = ll.PROVIDERS[args.provider](args.apikey)
+proxy = ll.ForecastProxy(provider.fetch, args.socket, interval=args.interval*60)
+print("Serving forecasts on", args.socket)
+
+##Program can be stopped by a keyboard interrupt (ctrl+c) at the consol.
+try:
+    proxy.serve_forever()
+except KeyboardInterrupt:
+    pass
+
+proxy.stop()
+provider.close()
@@ -5,7 +5,6 @@ To test if the LEDs light up correctly using the LED board and lampi_lib.
 """
 
 import lampi_lib as ll
-import RPi.GPIO as GPIO
 
 ##pin numbers to match LED legs
 ##These match LED board pins.
@@ -23,4 +22,4 @@ lamp.testcycle()
 lamp.shutdown()
 
 ##Last we need to close all GPIO connections properly.
-GPIO.cleanup()
+lamp.backend.cleanup()
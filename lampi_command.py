@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+"""
+lampi_command.py
+www.henryleach.com
+Send a command to a lamp started with --control, e.g. from home automation:
+
+lampi_command.py /tmp/lampi.sock notify --rgb 0,0,255 --pulses 3
+lampi_command.py /tmp/lampi.sock brightness --level 0.3
+lampi_command.py /tmp/lampi.sock off
+
+Prints the lamp's reply, which includes how many milliseconds the
+command took to show.
+"""
+
+import lampi_lib as ll
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description='Send a command to a lamp.')
+parser.add_argument("socket", help="The lamp's --control Unix socket.")
+parser.add_argument("command", choices=sorted(ll.COMMAND_PRIORITY))
+parser.add_argument("--rgb", default="255,255,255",
+                    help="notify: colour to pulse to, R,G,B 0-255. Default white")
+parser.add_argument("--pulses", default=2, type=int, help="notify: how many pulses. Default 2")
+parser.add_argument("--seconds", default=1, type=float, help="notify: seconds each pulse. Default 1")
+parser.add_argument("--level", default=1, type=float,
+                    help="brightness: 0-1, 1 ends the override. Default 1")
+args = parser.parse_args()
+
+command = {'command': args.command}
+if args.command == 'notify':
+    command.update(rgb=[float(c) for c in args.rgb.split(',')], pulses=args.pulses, seconds=args.seconds)
+elif args.command == 'brightness':
+    command['level'] = args.level
+
+reply = ll.send_command(args.socket, command)
+print(json.dumps(reply))
+if not reply.get('ok'):
+    raise SystemExit(1)
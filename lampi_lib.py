@@ -7,43 +7,670 @@ a lampi and get weather data from the 'net to set the lighting
 pattern.
 """
 import time
-import RPi.GPIO as GPIO
 import math
 import bisect
-import json
-import urllib.request
-import datetime
-import socket #for timeout error
-import calendar #for transforming to epoch time.
+import array
+import codecs
+import functools
+import collections
+import heapq
+import itertools
+import os
+import struct
+import re
+import threading
+import zlib
+##json, urllib, socket, datetime, calendar and random are imported where
+##they're used, so the lamp can light up before they've loaded.
+
+
+##Clocks##
+##Everything in here that reads the time or sleeps does it through the
+##current clock, so a simulation can swap in a VirtualClock with set_clock().
+
+class SystemClock:
+    """The real clocks and sleep from the time module. The default clock."""
+    monotonic = staticmethod(time.monotonic)
+    perf_counter = staticmethod(time.perf_counter)
+    sleep = staticmethod(time.sleep)
+
+    @staticmethod
+    def wait(event, seconds):
+        """Sleep for seconds or until the threading.Event event is set. Returns True if it was."""
+        return event.wait(max(0.0, seconds))
+
+    time = staticmethod(time.time) #last, as it hides the time module in here.
+
+
+class VirtualClock:
+    """
+    Simulated clock for running lamps faster than real time.\n
+
+    It starts at start_epoch seconds since the epoch (now by default) and
+    only moves when something sleeps, which moves it on straight away, so a
+    day of pulses and refreshes runs as fast as the code does. It's for
+    one thread only: anything sleeping in the background, such as a
+    Prefetcher, would move time on for everyone.
+    """
+    def __init__(self, start_epoch=None):
+        self.start_epoch = time.time() if start_epoch is None else start_epoch
+        self.now = 0.0 #monotonic seconds since the start.
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+
+    def time(self):
+        return self.start_epoch+self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def wait(self, event, seconds):
+        if not event.is_set():
+            self.sleep(seconds)
+        return event.is_set()
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    """The clock currently in use."""
+    return _clock
+
+
+def set_clock(clock):
+    """Use clock (a SystemClock or VirtualClock) for all timing from now on. Returns the old one."""
+    global _clock
+    old, _clock = _clock, clock
+    return old
+
+
+##Metrics##
+##Off unless enable_metrics() is called. While off _metrics is None, and
+##that one test is all the instrumented code pays.
+
+class Metrics:
+    """
+    Counters and histograms of what the lamps are doing: duty cycle writes,
+    frames skipped and how late they were, forecast downloads and the cache.\n
+
+    Counters only ever go up. Histograms keep counts in fixed buckets (by
+    the unit their name ends in, see BUCKETS) and the last ring_size values
+    in a ring buffer, so memory use stays the same however long it runs.
+    to_prometheus() gives everything in Prometheus' text format, as served
+    by serve() or written out every so often by flush_every().
+    """
+    BUCKETS = {'seconds': (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5),
+               'bytes': (1000, 4000, 16000, 64000, 256000, 1000000)}
+    PREFIX = 'lampi_'
+
+    def __init__(self, ring_size=1024):
+        self.ring_size = ring_size
+        self.counters = {}
+        self._histograms = {} #name: [bounds, bucket counts, sum, count, ring, next slot]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0)+n
+
+    def observe(self, name, value):
+        """Add value to histogram name, e.g. 'fetch_seconds'."""
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                bounds = self.BUCKETS[name.rsplit('_', 1)[-1]]
+                h = [bounds, [0]*(len(bounds)+1), 0.0, 0, array.array('d', bytes(8*self.ring_size)), 0]
+                self._histograms[name] = h
+            h[1][bisect.bisect_left(h[0], value)] += 1
+            h[2] += value
+            h[3] += 1
+            h[4][h[5] % self.ring_size] = value
+            h[5] += 1
+
+    def recent(self, name):
+        """The last (up to ring_size) values of histogram name, oldest first."""
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                return []
+            ring, filled = h[4], h[5]
+            if filled <= self.ring_size:
+                return list(ring[:filled])
+            start = filled % self.ring_size
+            return list(ring[start:])+list(ring[:start])
+
+    def to_prometheus(self):
+        """All the metrics in Prometheus' text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((name, list(h[1]), h[2], h[3]) for name, h in self._histograms.items())
+        for name, value in counters:
+            name = self.PREFIX+name+'_total'
+            lines.append('# TYPE '+name+' counter')
+            lines.append(name+' '+repr(value))
+        for name, buckets, total, count in histograms:
+            bounds = self.BUCKETS[name.rsplit('_', 1)[-1]]
+            recent = sorted(self.recent(name))
+            name = self.PREFIX+name
+            lines.append('# TYPE '+name+' histogram')
+            cumulative = 0
+            for bound, n in zip(bounds+('+Inf',), buckets):
+                cumulative += n
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+            lines.append(name+'_sum '+repr(total))
+            lines.append(name+'_count '+str(count))
+            #Quantiles of the ring buffer, i.e. recently rather than since starting.
+            lines.append('# TYPE '+name+'_recent summary')
+            for q in (0.5, 0.9, 0.99, 1.0):
+                value = recent[min(len(recent)-1, int(q*len(recent)))] if recent else float('nan')
+                lines.append('%s_recent{quantile="%s"} %r' % (name, q, value))
+        return '\n'.join(lines)+'\n'
+
+    def serve(self, port=9101, host='127.0.0.1'):
+        """Serve to_prometheus() over HTTP (any path) from a background thread."""
+        import http.server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass #don't print every scrape.
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def flush(self, path):
+        """Write to_prometheus() to path, replacing it in one go."""
+        with open(path+'.tmp', 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(path+'.tmp', path)
+
+    def flush_every(self, path, interval=60):
+        """Flush to path every interval seconds from a background thread, until stop()."""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush(path)
+                except OSError as err:
+                    print("Couldn't write metrics:", err)
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        """Stop serving and flushing."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+_metrics = None
+
+
+def enable_metrics(ring_size=1024):
+    """Start collecting metrics, returning the Metrics object (the same one if already on)."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(ring_size)
+    return _metrics
+
+
+def disable_metrics():
+    """Stop collecting metrics. Returns the Metrics collected so far, or None."""
+    global _metrics
+    old, _metrics = _metrics, None
+    if old is not None:
+        old.stop()
+    return old
+
+
+def get_metrics():
+    """The Metrics being collected, or None if they're off."""
+    return _metrics
+
+
+##GPIO output backends##
+
+class GPIOBackend:
+    """
+    Base class for the PWM outputs behind a light object.\n
+
+    A backend hands out one PWM channel object per pin from setup_pwm(). Channels
+    have the same methods as RPi.GPIO's PWM objects: ChangeDutyCycle(0-100%),
+    ChangeFrequency(Hz) and stop(). cleanup() releases everything once all lights
+    using the backend are shut down.
+    """
+    def setup_pwm(self, pin, frequency):
+        """Set pin up as a PWM output at frequency Hz, starting off, and return its channel."""
+        raise NotImplementedError
+
+    def duty_resolution(self, frequency):
+        """Smallest duty cycle change (%) the outputs can actually show at frequency Hz."""
+        return 0.01
+
+    def commit(self, writes):
+        """Write a list of (channel, duty) pairs together."""
+        for channel, duty in writes:
+            channel.ChangeDutyCycle(duty)
+
+    def cleanup(self):
+        """Release the pins and any connections."""
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    """Software PWM using the RPi.GPIO library. Pins use the GPIO.BOARD numbering."""
+    def __init__(self):
+        import RPi.GPIO as GPIO #only import on a Pi, when this backend is used.
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BOARD)
+
+    def setup_pwm(self, pin, frequency):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+        pwm = self.GPIO.PWM(pin, frequency) #(Pin, frequency)
+        pwm.start(0) #Initial duty cycle of 0, off.
+        return pwm
+
+    def duty_resolution(self, frequency):
+        #RPi.GPIO times the on period in whole microseconds.
+        return frequency/10000
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+#GPIO.BOARD header pin to Broadcom (BCM) GPIO number, for the 40 pin header.
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27,
+                15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8,
+                26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19,
+                36: 16, 37: 26, 38: 20, 40: 21}
+
+
+##pigpiod socket protocol. Each command is four little-endian 32 bit words
+##(command, p1, p2, length of extension data), followed by the extension;
+##the reply echoes the first three words and gives a signed result instead.
+PIGPIO_MODES = 0 #set mode, p1 gpio, p2 mode (1 is output)
+PIGPIO_PWM = 5 #PWM duty cycle, p1 gpio, p2 duty (0-range)
+PIGPIO_PRS = 6 #PWM range, p1 gpio, p2 range
+PIGPIO_PFS = 7 #PWM frequency, p1 gpio, p2 Hz
+PIGPIO_HP = 86 #hardware PWM, p1 gpio, p2 Hz, extension duty (0-1000000)
+_PIGPIO_HEADER = struct.Struct('<IIII')
+_PIGPIO_REPLY = struct.Struct('<IIIi')
+
+#GPIOs that can use the Pi's two hardware PWM channels, and which channel.
+#These are BOARD pins 32, 12 (channel 0) and 33, 35 (channel 1). GPIOs on the
+#same channel always output the same duty, so only one colour can use each.
+HARDWARE_PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+HARDWARE_PWM_GPIOS = tuple(sorted(HARDWARE_PWM_CHANNELS))
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes from a socket, or raise ConnectionError if it closes."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size-len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+class _PigpioChannel:
+    """
+    One PWM output driven through the pigpio daemon. DMA-timed on any pin,
+    or the hardware PWM peripheral if hardware is True.
+    """
+    RANGE = 1000 #Duty cycle steps for DMA PWM, 0.1% resolution.
+
+    def __init__(self, backend, gpio, frequency, hardware=False):
+        self.backend = backend
+        self.gpio = gpio
+        self.frequency = frequency
+        self.hardware = hardware
+        self.duty = 0
+        backend.command(PIGPIO_MODES, gpio, 1) #output
+        if not hardware:
+            backend.command(PIGPIO_PRS, gpio, self.RANGE)
+            backend.command(PIGPIO_PFS, gpio, frequency)
+        backend.command(*self.duty_command(0))
+
+    def duty_command(self, duty):
+        """The (command, p1, p2, extension) to set duty (%)."""
+        self.duty = duty #remember for frequency changes.
+        if self.hardware:
+            return (PIGPIO_HP, self.gpio, self.frequency,
+                    struct.pack('<I', int(round(duty*10000))))
+        return (PIGPIO_PWM, self.gpio, int(round(duty*self.RANGE/100)))
+
+    def ChangeDutyCycle(self, duty):
+        self.backend.command(*self.duty_command(duty))
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        if self.hardware: #frequency and duty are set together.
+            self.ChangeDutyCycle(self.duty)
+        else:
+            self.backend.command(PIGPIO_PFS, self.gpio, frequency)
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+
+class PigpioBackend(GPIOBackend):
+    """
+    PWM through the pigpio daemon (pigpiod), talking its socket protocol
+    directly so no extra Python modules are needed. Pins use the GPIO.BOARD
+    numbering.\n
+
+    Pulses are timed by the Pi's DMA hardware, or on pins that have it the
+    hardware PWM peripheral (unless hardware_pwm is False), not by Python threads.
+    So the lamp uses no CPU while a colour is held, and doesn't flicker while
+    the rest of the program is busy. All the channels written by one set_rgb
+    go to the daemon in a single send.\n
+
+    Only BOARD pins 12 and 32 (PWM channel 0) and 33 and 35 (channel 1) have
+    hardware PWM, so at most two colours can use it; the default lamp pins
+    19, 21 and 23 all get DMA-timed PWM. A pin that can't have hardware PWM,
+    or whose channel another colour already has, falls back to DMA-timed
+    PWM. With hardware_pwm None (the default) hardware PWM is used where
+    it's available and one line says which pins didn't get it; with True
+    each pin that didn't is warned about.\n
+
+    host and port default to the PIGPIO_ADDR and PIGPIO_PORT environment
+    variables, as for pigpio's own library, or localhost:8888.
+    """
+    def __init__(self, host=None, port=None, hardware_pwm=None, timeout=2):
+        import socket
+        if host is None:
+            host = os.environ.get('PIGPIO_ADDR', 'localhost')
+        if port is None:
+            port = int(os.environ.get('PIGPIO_PORT', 8888))
+        self.hardware_pwm = hardware_pwm
+        self._hardware_channels = {} #hardware PWM channel: the GPIO using it.
+        self._noted_dma = False #whether the summary line's been printed.
+        self._lock = threading.Lock()
+        try:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError as err:
+            raise RuntimeError("Can't connect to pigpiod at "+str(host)+":"+str(port)+": "+str(err))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def commands(self, commands):
+        """Send a list of (command, p1, p2[, extension bytes]) to the daemon in one go.\n
+
+        Returns the list of results, raising RuntimeError if any were errors.
+        """
+        out = bytearray()
+        for c in commands:
+            extension = c[3] if len(c) > 3 else b''
+            out += _PIGPIO_HEADER.pack(c[0], c[1], c[2], len(extension))+extension
+
+        with self._lock:
+            self.sock.sendall(out)
+            replies = _recv_exact(self.sock, _PIGPIO_REPLY.size*len(commands))
+
+        results = [r[3] for r in _PIGPIO_REPLY.iter_unpack(replies)]
+        for c, result in zip(commands, results):
+            if result < 0:
+                raise RuntimeError("pigpiod error "+str(result)+" for command "+str(c[0]))
+        return results
+
+    def command(self, command, p1, p2, extension=b''):
+        """Send one command to the daemon and return its result."""
+        return self.commands([(command, p1, p2, extension)])[0]
+
+    def setup_pwm(self, pin, frequency):
+        gpio = BOARD_TO_BCM[pin]
+        return _PigpioChannel(self, gpio, frequency, self._use_hardware(pin, gpio))
+
+    def _use_hardware(self, pin, gpio):
+        """Whether gpio gets a hardware PWM channel, saying so if it can't have one."""
+        if self.hardware_pwm is False:
+            return False
+        channel = HARDWARE_PWM_CHANNELS.get(gpio)
+        if channel is None:
+            reason = "has no hardware PWM"
+        else:
+            owner = self._hardware_channels.setdefault(channel, gpio)
+            if owner == gpio:
+                return True
+            reason = "shares hardware PWM channel "+str(channel)+" with GPIO "+str(owner)
+
+        if self.hardware_pwm: #asked for, so every pin that misses out matters.
+            print("Warning: pin", pin, "(GPIO "+str(gpio)+")", reason+", using DMA-timed PWM.")
+        elif not self._noted_dma:
+            print("pigpio: DMA-timed PWM on pins without a hardware PWM channel of their own"
+                  " (hardware PWM is on pins 12 or 32, and 33 or 35).")
+            self._noted_dma = True
+        return False
+
+    def duty_resolution(self, frequency):
+        return 100/_PigpioChannel.RANGE
+
+    def commit(self, writes):
+        self.commands([channel.duty_command(duty) for channel, duty in writes])
+
+    def cleanup(self):
+        self.sock.close()
+
+
+class PigpiodStandIn:
+    """
+    Local stand-in for the pigpio daemon, for running PigpioBackend off a Pi.\n
+
+    Listens on host:port (port 0 picks a free one, see .port) and answers the
+    mode, PWM range/frequency/duty and hardware PWM commands, keeping the
+    state of each GPIO. Every duty cycle write is logged, as in
+    SimulatedBackend, in times, gpios and duties (% duty).
+    """
+    def __init__(self, host='127.0.0.1', port=0, timer=time.perf_counter):
+        import socketserver
+        self.timer = timer
+        self.times = array.array('d')
+        self.gpios = array.array('B')
+        self.duties = array.array('f')
+        self.ranges = {}
+        self.frequencies = {}
+        self.modes = {}
+        self._lock = threading.Lock()
+
+        standin = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    while True:
+                        cmd, p1, p2, length = _PIGPIO_HEADER.unpack(_recv_exact(self.request, 16))
+                        extension = _recv_exact(self.request, length) if length else b''
+                        result = standin._command(cmd, p1, p2, extension)
+                        self.request.sendall(_PIGPIO_REPLY.pack(cmd, p1, p2, result))
+                except ConnectionError:
+                    pass
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def _command(self, cmd, p1, p2, extension):
+        with self._lock:
+            if cmd == PIGPIO_MODES:
+                self.modes[p1] = p2
+            elif cmd == PIGPIO_PRS:
+                self.ranges[p1] = p2
+            elif cmd == PIGPIO_PFS:
+                self.frequencies[p1] = p2
+            elif cmd == PIGPIO_PWM:
+                self._log(p1, 100*p2/self.ranges.get(p1, 255))
+            elif cmd == PIGPIO_HP:
+                self.frequencies[p1] = p2
+                self._log(p1, struct.unpack('<I', extension)[0]/10000)
+            else:
+                return -1 #unknown command
+        return 0
+
+    def _log(self, gpio, duty):
+        self.times.append(self.timer())
+        self.gpios.append(gpio)
+        self.duties.append(duty)
+
+    def start(self):
+        """Start answering in a background thread. Returns self."""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SimulatedChannel:
+    """A PWM output that records its writes in a SimulatedBackend."""
+    def __init__(self, backend, pin, frequency):
+        self.backend = backend
+        self.pin = pin
+        self.frequency = frequency
+        backend.record(pin, 0)
+
+    def ChangeDutyCycle(self, duty):
+        self.backend.record(self.pin, duty)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.backend.record(self.pin, 0)
+
+
+class SimulatedBackend(GPIOBackend):
+    """
+    Backend that drives no hardware, it records every duty-cycle write instead.\n
+
+    Writes are logged in three parallel arrays: times (from timer, the current
+    clock's perf_counter by default), pins and duties (%). Use it to run and profile the animation code
+    off a Pi, then look at the log directly or through stats(). resolution is the
+    duty cycle resolution (%) to pretend to have, by default the same as RPi.GPIO.
+    """
+    def __init__(self, timer=None, resolution=None):
+        self.timer = timer
+        self.resolution = resolution
+        self.times = array.array('d')
+        self.pins = array.array('B')
+        self.duties = array.array('f')
+
+    def setup_pwm(self, pin, frequency):
+        return _SimulatedChannel(self, pin, frequency)
+
+    def duty_resolution(self, frequency):
+        if self.resolution is None:
+            return frequency/10000
+        return self.resolution
+
+    def commit(self, writes):
+        #Log all the channels with the same time, as real hardware would change together.
+        now = (self.timer or _clock.perf_counter)()
+        for channel, duty in writes:
+            self.times.append(now)
+            self.pins.append(channel.pin)
+            self.duties.append(duty)
+
+    def record(self, pin, duty):
+        """Log one write."""
+        self.times.append((self.timer or _clock.perf_counter)())
+        self.pins.append(pin)
+        self.duties.append(duty)
+
+    def clear(self):
+        """Empty the log."""
+        del self.times[:]
+        del self.pins[:]
+        del self.duties[:]
+
+    def writes(self, pin=None):
+        """Return a list of (time, pin, duty) tuples, for one pin or all of them."""
+        return [w for w in zip(self.times, self.pins, self.duties) if pin is None or w[1]==pin]
+
+    def stats(self, pin=None):
+        """Summarise the log, for one pin or all of them, as a dict.\n
+
+        writes is the number of writes, duration the time between the first and
+        last, rate the writes per second, and interval/jitter/max_interval the mean,
+        standard deviation and largest gap between writes (seconds).
+        """
+        times = [w[0] for w in self.writes(pin)]
+        result = {'writes': len(times), 'duration': 0.0, 'rate': 0.0,
+                  'interval': 0.0, 'jitter': 0.0, 'max_interval': 0.0}
+        if len(times) < 2:
+            return result
+
+        gaps = [b-a for a, b in zip(times, times[1:])]
+        result['duration'] = times[-1]-times[0]
+        result['interval'] = sum(gaps)/len(gaps)
+        result['jitter'] = (sum((g-result['interval'])**2 for g in gaps)/len(gaps))**0.5
+        result['max_interval'] = max(gaps)
+        if result['duration'] > 0:
+            result['rate'] = (len(times)-1)/result['duration']
+        return result
+
+
+BACKENDS = {'rpi': RPiGPIOBackend,
+            'pigpio': PigpioBackend,
+            'sim': SimulatedBackend}
 
 
 ##LED control object and related control functions.##
 
 class light:
     """
-    Light class. Contains three PWM GPIO objects
+    Light class. Contains three PWM channels
     to control RGB LEDs attached to the pins.
     To create pin numbers for red, green and blue
     are needed. Frequency can be optionally set, default
-    is 100Hz.
+    is 100Hz. The channels come from a GPIOBackend,
+    by default RPi.GPIO's software PWM.
+    The current duty of each channel is tracked, so writes that
+    wouldn't change the output are skipped. writes and
+    skipped_writes count channel writes made and skipped.
     """
-    def __init__(self, R_pin, G_pin, B_pin, Frequency=100):
+    def __init__(self, R_pin, G_pin, B_pin, Frequency=100, backend=None):
         """Create a light object controlling an RGB LED using three GPIO pins with PWM.\n
 
         Pins use the GPIO.BOARD number convention. Default frequency is 100Hz.
+        backend is a GPIOBackend; if None an RPiGPIOBackend is created.
         """
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(R_pin, GPIO.OUT)
-        GPIO.setup(G_pin, GPIO.OUT)
-        GPIO.setup(B_pin, GPIO.OUT)
+        if backend is None:
+            backend = RPiGPIOBackend()
+        self.backend = backend
 
         #setup the colours
-        self.RED = GPIO.PWM(R_pin, Frequency) #(Pin, frequency)
-        self.RED.start(0) #Initial duty cycle of 0, off.
-        self.GREEN = GPIO.PWM(G_pin, Frequency)    
-        self.GREEN.start(0)  
-        self.BLUE = GPIO.PWM(B_pin, Frequency)
-        self.BLUE.start(0)
+        self.RED = backend.setup_pwm(R_pin, Frequency)
+        self.GREEN = backend.setup_pwm(G_pin, Frequency)
+        self.BLUE = backend.setup_pwm(B_pin, Frequency)
+        self._channels = (self.RED, self.GREEN, self.BLUE)
+
+        #Current duty of each channel, in whole steps of resolution (% duty).
+        self.resolution = backend.duty_resolution(Frequency)
+        self._steps = [0, 0, 0]
+        self.writes = 0
+        self.skipped_writes = 0
 
     def change_freq(self, Frequency):
         """Change the frequency (in Hz) of the PWM for all three pins.\n
@@ -53,6 +680,11 @@ class light:
         self.GREEN.ChangeFrequency(Frequency)
         self.BLUE.ChangeFrequency(Frequency)
 
+        #Resolution may change with frequency, so rescale the tracked duties.
+        new_resolution = self.backend.duty_resolution(Frequency)
+        self._steps = [round(n*self.resolution/new_resolution) for n in self._steps]
+        self.resolution = new_resolution
+
     def shutdown(self):
         """Close all the GPIO connections in a tidy manner.\n
 
@@ -61,6 +693,7 @@ class light:
         self.RED.stop()
         self.GREEN.stop()
         self.BLUE.stop()
+        self._steps = [0, 0, 0]
 
     def colour(self, R, G, B, on_time):
         """Colour depth is 0-255. On time in seconds, after which lights are turned off.\n
@@ -77,29 +710,50 @@ class light:
         if B > 255 or B < 0:
             B=128
 
-        ratio=100/255 #to convert to % duty cycle.
-        
-        self.RED.ChangeDutyCycle(R*ratio)
-        self.GREEN.ChangeDutyCycle(G*ratio)
-        self.BLUE.ChangeDutyCycle(B*ratio)
-        time.sleep(on_time)
+        self.set_rgb(R, G, B)
+        _clock.sleep(on_time)
 
         #Turn all off, leaving ready for next call.
-        self.RED.ChangeDutyCycle(0)
-        self.GREEN.ChangeDutyCycle(0) 
-        self.BLUE.ChangeDutyCycle(0)
+        self.set_rgb(0, 0, 0)
 
 
     def colour_cont(self, R, G, B, on_time):
         """As .colour method, but leave the colour on until changed.\n
 
         """
-        ratio=100/255 #to convert to % duty cycle.
-        
-        self.RED.ChangeDutyCycle(R*ratio)
-        self.GREEN.ChangeDutyCycle(G*ratio)
-        self.BLUE.ChangeDutyCycle(B*ratio)
-        time.sleep(on_time)
+        self.set_rgb(R, G, B)
+        _clock.sleep(on_time)
+
+    def set_rgb(self, R, G, B):
+        """Set the colour (0-255 per channel) and return straight away, leaving it on.\n
+
+        Used by the animation functions, which do their own timing.
+        Duty cycles are rounded to the backend's resolution, only channels
+        that actually change are written, and they are committed together.
+        Returns the number of channels written.
+        """
+        scale = 100/255/self.resolution #0-255 to whole resolution steps.
+        steps = self._steps
+        writes = None
+
+        for c, value in enumerate((R, G, B)):
+            n = round(value*scale)
+            if n != steps[c]:
+                steps[c] = n
+                if writes is None:
+                    writes = []
+                writes.append((self._channels[c], n*self.resolution))
+
+        if writes is None:
+            self.skipped_writes += 3
+            return 0
+
+        self.backend.commit(writes)
+        self.writes += len(writes)
+        self.skipped_writes += 3-len(writes)
+        if _metrics is not None:
+            _metrics.count('duty_writes', len(writes))
+        return len(writes)
 
     def testcycle(self):
         """
@@ -116,6 +770,183 @@ class light:
         self.colour(255,255,255,1) #white
 
 
+##Animation timing##
+
+def sleep_until(deadline):
+    """Sleep until deadline on the monotonic clock. Returns at once if it has passed."""
+    delay = deadline-_clock.monotonic()
+    if delay > 0:
+        _clock.sleep(delay)
+
+
+def wait_until(deadline, wake=None):
+    """
+    As sleep_until, but returns early if the threading.Event wake is set,
+    without waking up in between to check. Returns True if woken by it.
+    """
+    if wake is None:
+        sleep_until(deadline)
+        return False
+    return _clock.wait(wake, deadline-_clock.monotonic())
+
+
+def monotonic_from_epoch(epoch_time):
+    """Convert a time in seconds since the epoch to the monotonic clock."""
+    return _clock.monotonic()+(epoch_time-_clock.time())
+
+
+class FrameClock:
+    """
+    Absolute-deadline frame clock for animations.\n
+
+    Frame i is due at start + i*frame_time on the monotonic clock, so the time
+    taken writing to the GPIO, doing the maths or waiting on the scheduler
+    doesn't push later frames back. A frame that is reached after the next one
+    is already due is skipped, instead of stretching the animation.\n
+
+    report, if given, is called with (frame index, seconds late) for every frame
+    shown. Running totals are kept in shown, skipped, max_late and total_late.
+    If a FrameGovernor is on, it's told how long each frame took to write,
+    the time between yielding a frame and being asked for the next.
+    """
+    def __init__(self, frame_time, start=None, report=None):
+        self.frame_time = frame_time
+        self.start = _clock.monotonic() if start is None else start
+        self.report = report
+        self.shown = 0
+        self.skipped = 0
+        self.max_late = 0.0
+        self.total_late = 0.0
+
+    def deadline(self, index):
+        """Monotonic time frame index is due."""
+        return self.start+index*self.frame_time
+
+    def frames(self, count):
+        """Yield the index of each of count frames once it is due.\n
+
+        Late frames are skipped, but the last frame is always shown so an
+        animation finishes on its final value. After the last frame this waits
+        until the end of its slot, so the whole run takes exactly
+        count*frame_time, then moves start on to follow straight after.
+        """
+        frame_time = self.frame_time
+        start = self.start
+        metrics = _metrics
+        governor = _governor
+        i = 0
+        while i < count:
+            due = start+i*frame_time
+            now = _clock.monotonic()
+            if now < due:
+                _clock.sleep(due-now)
+                now = _clock.monotonic()
+            else:
+                #Which frame should be showing by now?
+                current = min(int((now-start)/frame_time), count-1)
+                if current > i:
+                    self.skipped += current-i
+                    if metrics is not None:
+                        metrics.count('frames_skipped', current-i)
+                    i = current
+                    due = start+i*frame_time
+
+            late = now-due
+            self.shown += 1
+            self.total_late += late
+            if late > self.max_late:
+                self.max_late = late
+            if self.report is not None:
+                self.report(i, late)
+            if metrics is not None:
+                metrics.observe('frame_late_seconds', late)
+
+            yield i
+            if governor is not None:
+                governor.observe(_clock.monotonic()-now, late)
+            i += 1
+
+        self.start = start+count*frame_time
+        sleep_until(self.start)
+
+
+class FrameGovernor:
+    """
+    Chooses how many frames an effect is cut into as it starts, from what
+    the frames cost here and how big the colour change is.\n
+
+    The effect's duration stays exactly as asked; only the number of frames
+    and so the time each lasts change. There's no point in more frames than
+    the change has visible levels (one per 1/255, or per duty step if the
+    backend is coarser), or in frames shorter than min_frame_time (two PWM
+    periods at 100Hz, so each level is really shown). And a frame should cost no more than load of the time
+    it's shown for: cost is a moving average of the time spent writing each
+    frame plus how late it was written (up to max_late), which FrameClock
+    and play_timelines measure as effects play. So a busy Pi Zero gets
+    fewer, longer frames, a Pi 4 more, shorter ones, and the effects take
+    the same time on both.
+    """
+    def __init__(self, min_frame_time=0.02, load=0.25, smoothing=0.05, max_late=0.1):
+        self.min_frame_time = min_frame_time
+        self.load = load
+        self.smoothing = smoothing
+        self.max_late = max_late
+        self.cost = 0.0
+
+    def observe(self, work, late):
+        """Account for one frame that took work seconds to write and was late seconds late."""
+        sample = work+min(max(late, 0.0), self.max_late)
+        self.cost += (sample-self.cost)*self.smoothing
+
+    def frame_time(self):
+        """Shortest frame time that can be kept up now."""
+        return max(self.min_frame_time, self.cost/self.load)
+
+    def plan(self, duration, delta, resolution=None):
+        """
+        (frames, frame_time) for an effect lasting duration seconds whose
+        channels change by at most delta (0-255, summed over the whole
+        effect, e.g. twice the height of a pulse). resolution is the
+        light's duty resolution (%), if known.
+        """
+        level = 1.0 if resolution is None else max(1.0, resolution*255/100)
+        visible = math.ceil(abs(delta)/level)
+        frames = max(1, min(visible, int(duration/self.frame_time())))
+        if _metrics is not None:
+            _metrics.observe('governed_frame_seconds', duration/frames)
+        return frames, duration/frames
+
+
+_governor = None
+
+
+def enable_governor(**settings):
+    """Let a FrameGovernor pick effects' frames, returning it (the same one if already on)."""
+    global _governor
+    if _governor is None:
+        _governor = FrameGovernor(**settings)
+    return _governor
+
+
+def disable_governor():
+    """Go back to the effects' fixed frame counts. Returns the FrameGovernor, or None."""
+    global _governor
+    old, _governor = _governor, None
+    return old
+
+
+def get_governor():
+    """The FrameGovernor in use, or None if effects use fixed frame counts."""
+    return _governor
+
+
+def _governed(steps, frame_time, delta, lightobj=None):
+    """(steps, frame_time) for an effect, replanned over the same duration if a FrameGovernor is on."""
+    if _governor is None:
+        return steps, frame_time
+    return _governor.plan(steps*frame_time, delta, getattr(lightobj, 'resolution', None))
+
+
 def possinwave(amplitude, angle, frequency):
     """Input angle in degrees. Output a positive sin wave value 0 and amplitude*2.\n
 
@@ -124,142 +955,1862 @@ def possinwave(amplitude, angle, frequency):
 
 
 
-def ramp(lightobj, R, G, B, steps):
+##Precompiled effects##
+
+EFFECT_CACHE_SIZE = 64 #How many compiled effects to keep, least recently used are dropped.
+
+class FrameBuffer:
     """
-    Ramps between off and desired colour in a linear ramp.\n
-    
-    Negative step value ramps down, positive up.
-    The greater the number of steps, the longer the ramp is.
-    50 is a good step value, which takes around 10 seconds.
+    A precomputed animation: a sequence of (R, G, B) frames, 0-255 per channel.\n
+
+    Frames are stored flat in an array of doubles, three values per frame, so
+    playing a frame is just a table read. The buffers returned by the compile_*
+    functions are cached and shared, so treat them as read-only.
     """
-    R_step = R/steps
-    G_step = G/steps
-    B_step = B/steps
+    def __init__(self, values=()):
+        self.data = array.array('d', values)
 
-    if steps>0:
-        for i in range(0, steps, 1):
-            lightobj.colour_cont(i*R_step, i*G_step, i*B_step, 0.1)
-    else:
-        for i in range(-steps, 0, -1):
-            lightobj.colour_cont(i*-R_step, i*-G_step, i*-B_step, 0.1)
- 
+    def __len__(self):
+        return len(self.data)//3
 
-def pulse_light(lightobj, R, G, B, pulse_freq, intensity, stop_time):
-    """ Fade from input colour to white (intesity 0-255) and back again until
-    stop_time (in seconds since the epoch) is reached.\n
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        j = index*3
+        data = self.data
+        return (data[j], data[j+1], data[j+2])
 
-    pulse_freq is approximatly(*) the number of times a minute the light pulses.
-    stop_time is seconds since epoch. pulse_light will always complete a
-    current set of pulses before stopping, therefore it will stop some
-    slightly random time after stop_time.\n
-    
-    (*)Rounding errors and uneven code running time dependent on system
-    load mean that at higher pulse_freq values (>40) you're going to start
-    loosing some pulses.\n
-    """
-    if intensity < 0 or intensity > 255:
-        #set to max
-        intensity = 255
-    
-    
+    def append(self, R, G, B):
+        """Add a frame to the end of the buffer."""
+        self.data.extend((R, G, B))
+
+    def as_numpy(self):
+        """Return the frames as an (N, 3) NumPy array sharing this buffer's memory.\n
+
+        Raises ImportError if NumPy isn't installed.
+        """
+        import numpy
+        return numpy.frombuffer(self.data, dtype=float).reshape(-1, 3)
+
+
+@functools.lru_cache(maxsize=EFFECT_CACHE_SIZE)
+def compile_pulse(R, G, B, intensity, steps=36):
+    """Compile one pulse from R, G, B to white (of intensity 0-255) and back in steps frames."""
     R_diff = (intensity-R)/2
     G_diff = (intensity-G)/2
     B_diff = (intensity-B)/2
 
-    if pulse_freq>0:
-        #Approximatly how many times a minute the pulse should appear.
-        #Over long run periods this is going to get seriously out of step.
-        #Additional -10s for two ramps (at 50 steps each).
-        #Give the time for each hold. 60 sec - 2*ramp time / number of pulses + number of holds + 1
-        hold = (60-10)/(pulse_freq*2 + 1) 
-        #Pulse steps slighty smaller than 1/36th to compensate for processing time.
-        pulse_step = hold/37 
+    frames = FrameBuffer()
+    for i in range(steps):
+        angle = -90+i*360/steps #start and end at the bottom of the sine wave.
+        frames.append(R+possinwave(R_diff,angle,1),
+                      G+possinwave(G_diff,angle,1),
+                      B+possinwave(B_diff,angle,1))
+    return frames
+
+
+@functools.lru_cache(maxsize=EFFECT_CACHE_SIZE)
+def compile_ramp(R, G, B, steps):
+    """Compile a linear ramp between off and R, G, B.\n
+
+    As ramp(): positive steps ramps up from off, negative steps ramps down to (nearly) off.
+    """
+    R_step = R/abs(steps)
+    G_step = G/abs(steps)
+    B_step = B/abs(steps)
+
+    if steps>0:
+        levels = range(0, steps)
     else:
-        hold = 1
-        pulse_step = 0.1 ##This should never be used.
+        levels = range(-steps, 0, -1)
 
+    frames = FrameBuffer()
+    for i in levels:
+        frames.append(i*R_step, i*G_step, i*B_step)
+    return frames
 
-    while time.time() < stop_time:
-        lightobj.colour_cont(R, G, B, hold) #steady colour        
 
-        if pulse_freq>0 and time.time() < stop_time:
-            for i in range(-90, 270, 10): #36 steps.
-               #Pulse to white and back. 
-                lightobj.colour_cont(R+possinwave(R_diff,i,1),
-                       G+possinwave(G_diff,i,1),
-                       B+possinwave(B_diff,i,1),
-                       pulse_step)
-                #print("Colours",R+possinwave(R_diff,i,1),G+possinwave(G_diff,i,1),B+possinwave(B_diff,i,1))
-        else:
-            pass
+@functools.lru_cache(maxsize=EFFECT_CACHE_SIZE)
+def compile_wave(wave, steps, *args):
+    """Compile a custom waveform.\n
 
+    wave(i, steps, *args) is called for each frame i and must return an (R, G, B)
+    tuple. wave and args must be hashable, as they are the cache key along with steps.
+    """
+    frames = FrameBuffer()
+    for i in range(steps):
+        frames.append(*wave(i, steps, *args))
+    return frames
 
-def one_pulse(lightobj, R, G, B):
-    """One to white pulse."""
-    R_diff = (255-R)/2
-    G_diff = (255-G)/2
-    B_diff = (255-B)/2
 
-    for i in range(-90, 270, 10): #pulse to white and back
-        lightobj.colour_cont(R+possinwave(R_diff,i,1),
-               G+possinwave(G_diff,i,1),
-               B+possinwave(B_diff,i,1),
-               0.1)
+@functools.lru_cache(maxsize=EFFECT_CACHE_SIZE)
+def compile_fade(from_rgb, to_rgb, steps):
+    """Compile a linear cross-fade from one (R, G, B) colour to another, ending on to_rgb."""
+    R0, G0, B0 = from_rgb
+    R1, G1, B1 = to_rgb
 
-##Weatherdata and internet functions##
+    frames = FrameBuffer()
+    for i in range(1, steps+1):
+        f = i/steps
+        frames.append(R0+(R1-R0)*f, G0+(G1-G0)*f, B0+(B1-B0)*f)
+    return frames
 
-def check_connection(url):
-    """Quick check if your Pi is connected to the internet.\n
 
-    Returns True or False depending on result.
+def play_frames(lightobj, frames, clock):
+    """Play a FrameBuffer (or any sequence of (R, G, B) tuples) on lightobj, timed by a FrameClock."""
+    if isinstance(lightobj, RemoteLight):
+        lightobj.play_frames(frames, clock) #the driver process does the timing.
+        return
+    if isinstance(frames, FrameBuffer):
+        data = frames.data
+        for i in clock.frames(len(frames)):
+            j = i*3
+            lightobj.set_rgb(data[j], data[j+1], data[j+2])
+    else:
+        for i in clock.frames(len(frames)):
+            lightobj.set_rgb(*frames[i])
+
+
+def ramp(lightobj, R, G, B, steps, frame_time=0.1, report=None):
     """
-    try:
-        urllib.request.urlopen(url, timeout=2)
-        return True
-    except urllib.request.URLError:
-        return False
+    Ramps between off and desired colour in a linear ramp.\n
+    
+    Negative step value ramps down, positive up.
+    The greater the number of steps, the longer the ramp is.
+    Each step lasts frame_time seconds (default 0.1), so 50 steps takes 5 seconds.
+    Steps are timed against absolute deadlines (see FrameClock), report is passed on.
+    If a FrameGovernor is on it picks the steps, the ramp still takes as long.
+    """
+    count, frame_time = _governed(abs(steps), frame_time, max(R, G, B), lightobj)
+    steps = count if steps > 0 else -count
+    play_frames(lightobj, compile_ramp(R, G, B, steps), FrameClock(frame_time, report=report))
+ 
 
-def getUWeather(apikey, location):
-    """Uses a wunderground.com api key get a 10 hour forecast JSON file
-    and return a dict() structure.\n
+def crossfade(lightobj, from_rgb, to_rgb, steps=50, frame_time=0.1, report=None):
+    """
+    Fade smoothly from one (R, G, B) colour to another.\n
 
-    User needs to register to get their own API key (16 digit hex).\n
-    Location is a string in the format 'Country/City' outside the USA and TWO_LETTER_STATE/City inside.
-    e.g. 'UK/Bristol' or 'TX/El_Paso'.\n
-    Returns -1 if url doesn't exist or contents is an error message.\n
-    Returns -2 if connection timesout.\n
+    Takes steps*frame_time seconds, 5 seconds by default, like a 50 step ramp.
+    Used instead of ramping down and up again when the colour changes.
     """
-    WURL = 'http://api.wunderground.com/api/'
-    url = WURL+apikey+"/hourly/q/"+location+".json"
+    delta = max(abs(a-b) for a, b in zip(from_rgb, to_rgb))
+    steps, frame_time = _governed(steps, frame_time, delta, lightobj)
+    play_frames(lightobj, compile_fade(tuple(from_rgb), tuple(to_rgb), steps),
+                FrameClock(frame_time, report=report))
 
-    ##Try to download the JSON. Some error catching.
-    try:
-        source = urllib.request.urlopen(url, timeout=2)
-        json_string = source.read()
-    
-        ##This returns binary data, and for json we need a string, so we need to decode:
-        encoding = source.headers.get_content_charset() #find the encoding type. Almost certainly "utf-8"
-        parsed_json = json.loads(json_string.decode(encoding)) #decode it and load it so it becomes a dict()
 
-    except (urllib.error.HTTPError, urllib.error.URLError) as err:
-        print(err)
-        return -1
-    except socket.timeout as err:
-        print(err)
-        return -2
+def pulse_light(lightobj, R, G, B, pulse_freq, intensity, stop_time, report=None, wake=None):
+    """ Fade from input colour to white (intesity 0-255) and back again until
+    stop_time (in seconds since the epoch) is reached.\n
 
+    pulse_freq is the number of times a minute the light pulses. Each pulse
+    period is split evenly between holding the steady colour and a 36 step
+    pulse (or as many as a FrameGovernor picks, if one is on). Pulses are scheduled against absolute deadlines from when
+    pulse_light starts (see FrameClock), so late steps are dropped rather than
+    slowing the pulses down, and the rate stays exact however long it runs.
+    report is passed on to the FrameClock.\n
 
-    ##Some checks to see if we actually got weather data
-    try:
-        #Did our returned information contain an error code?
-        print("Error: ",parsed_json['response']['error']['type'],
-              ". Description: ",parsed_json['response']['error']['description'], sep="")
-        return -1 #no data loaded, return error code
-    except KeyError:
-        pass #Error not found in JSON, so we're probably ok.
+    pulse_light will always complete a pulse that has started before stop_time,
+    so it can stop up to half a pulse period after stop_time.\n
+
+    With no pulses the colour is written once and the process sleeps until
+    stop_time without waking in between. If wake (a threading.Event) is
+    given and gets set, e.g. from a signal handler, pulse_light stops at the
+    end of the current pulse, or straight away while holding the colour,
+    and returns True. Otherwise it returns False.
+    """
+    if intensity < 0 or intensity > 255:
+        #set to max
+        intensity = 255
+
+    stop = monotonic_from_epoch(stop_time)
+    if pulse_freq <= 0:
+        #Nothing changes until stop_time, so there's no need to wake before then.
+        lightobj.set_rgb(R, G, B)
+        return wait_until(stop, wake)
+
+    period = 60/pulse_freq
+    hold = period/2
+    delta = 2*max(abs(intensity-c) for c in (R, G, B))
+    start = _clock.monotonic()
+    clock = FrameClock(hold/36, report=report)
+
+    cycle = 0
+    while start+cycle*period < stop:
+        cycle_start = start+cycle*period
+        if wait_until(cycle_start, wake):
+            return True
+        lightobj.set_rgb(R, G, B) #steady colour
+
+        pulse_start = cycle_start+hold
+        if pulse_start >= stop:
+            return wait_until(stop, wake)
+        if wait_until(pulse_start, wake):
+            return True
+        #Replanned every pulse, so the steps follow the load.
+        steps, clock.frame_time = _governed(36, hold/36, delta, lightobj)
+        clock.start = pulse_start
+        play_frames(lightobj, compile_pulse(R, G, B, intensity, steps), clock) #Pulse to white and back.
+        cycle += 1
+    return False
+
+
+def one_pulse(lightobj, R, G, B, report=None):
+    """One to white pulse, 36 steps of 0.1 seconds (or as a FrameGovernor picks)."""
+    steps, frame_time = _governed(36, 0.1, 2*max(255-c for c in (R, G, B)), lightobj)
+    play_frames(lightobj, compile_pulse(R, G, B, 255, steps), FrameClock(frame_time, report=report))
+
+##Frame timelines##
+##Effects as generators of (deadline, (R, G, B)) frames, deadlines on the
+##monotonic clock, so many lights can be driven from one loop.
+
+def fade_timeline(from_rgb, to_rgb, start, steps=50, frame_time=0.1):
+    """Frames of a cross-fade (as crossfade()) starting at monotonic time start."""
+    delta = max(abs(a-b) for a, b in zip(from_rgb, to_rgb))
+    steps, frame_time = _governed(steps, frame_time, delta)
+    frames = compile_fade(tuple(from_rgb), tuple(to_rgb), steps)
+    for i in range(len(frames)):
+        yield (start+i*frame_time, frames[i])
+
+
+def pulse_timeline(R, G, B, pulse_freq, intensity, start, stop):
+    """Frames of pulse_light's pattern, from monotonic time start until stop.\n
+
+    With no pulses this is a single frame, the light just holds its colour.
+    A pulse that starts before stop is always finished. If a FrameGovernor
+    is on, each pulse's steps are planned as it's reached.
+    """
+    if intensity < 0 or intensity > 255:
+        intensity = 255
+
+    yield (start, (R, G, B)) #steady colour
+    if pulse_freq <= 0:
+        return
+
+    period = 60/pulse_freq
+    hold = period/2
+    delta = 2*max(abs(intensity-c) for c in (R, G, B))
+
+    cycle = 0
+    while True:
+        cycle_start = start+cycle*period
+        if cycle_start >= stop:
+            return
+        if cycle > 0:
+            yield (cycle_start, (R, G, B))
+        pulse_start = cycle_start+hold
+        if pulse_start >= stop:
+            return
+        steps, pulse_step = _governed(36, hold/36, delta)
+        pulse = compile_pulse(R, G, B, intensity, steps)
+        for i in range(len(pulse)):
+            yield (pulse_start+i*pulse_step, pulse[i])
+        cycle += 1
+
+
+def play_timelines(players, report=None):
+    """
+    Play several timelines at once from a single thread.\n
+
+    players is a list of (lightobj, timeline) pairs. Frames from all timelines
+    are written in deadline order. If a light's next frame is already due
+    when a frame comes up, the late frame is skipped; the last frame of each
+    timeline is always shown. report, if given, is called with (player index,
+    seconds late) for each frame written. Returns the number of frames skipped.
+    A FrameGovernor, if on, is told how long each write took and how late.
+    """
+    heap = []
+    for n, (lightobj, timeline) in enumerate(players):
+        frame = next(timeline, None)
+        if frame is not None:
+            heap.append((frame[0], n, frame[1]))
+    heapq.heapify(heap)
+
+    skipped = 0
+    while heap:
+        deadline, n, rgb = heapq.heappop(heap)
+        sleep_until(deadline)
+        lightobj, timeline = players[n]
+
+        following = next(timeline, None)
+        now = _clock.monotonic()
+        while following is not None and following[0] <= now:
+            skipped += 1
+            if _metrics is not None:
+                _metrics.count('frames_skipped')
+            deadline, rgb = following
+            following = next(timeline, None)
+
+        lightobj.set_rgb(*rgb)
+        if _governor is not None:
+            _governor.observe(_clock.monotonic()-now, now-deadline)
+        if report is not None:
+            report(n, now-deadline)
+        if _metrics is not None:
+            _metrics.observe('frame_late_seconds', now-deadline)
+        if following is not None:
+            heapq.heappush(heap, (following[0], n, following[1]))
+
+    return skipped
+
+
+##Lamp commands##
+##Commands from outside, e.g. home automation: notification pulses, brightness
+##overrides and off. They go on a CommandQueue, and a ControlledLight carries
+##them out between the frames of whatever effect is playing, and while it
+##waits, so they show within a frame instead of at the next refresh.
+
+##Lower goes first. Off and on beat everything, a notification waits for them.
+COMMAND_PRIORITY = {'off': 0, 'on': 0, 'brightness': 1, 'notify': 2}
+
+
+class Command:
+    """
+    One command for a ControlledLight, usually made from_dict() a request
+    such as {"command": "notify", "rgb": [0, 0, 255], "pulses": 3}.\n
+
+    notify: pulse to rgb (default white) and back pulses times (default 2),
+    seconds each (default 1), then carry on with what was showing.
+    brightness: scale everything shown by level (0-1) from now on, 1 to
+    end the override. off: show nothing until on.\n
+
+    received and applied are perf_counter times, set as the command is put
+    on a queue and first shows on the light, and the threading.Event done
+    is set once it has.
+    """
+    def __init__(self, kind, **params):
+        if kind not in COMMAND_PRIORITY:
+            raise ValueError("Unknown command: "+repr(kind))
+        self.kind = kind
+        self.params = params
+        self.priority = COMMAND_PRIORITY[kind]
+        self.received = None
+        self.applied = None
+        self.done = threading.Event()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Make a command from a decoded JSON request, raising ValueError if it's not a valid one."""
+        if not isinstance(data, dict):
+            raise ValueError("A command is a JSON object")
+        kind = data.get('command')
+        if not isinstance(kind, str) or kind not in COMMAND_PRIORITY:
+            raise ValueError("Unknown command: "+repr(kind))
+        try:
+            if kind == 'notify':
+                rgb = tuple(float(c) for c in data.get('rgb', (255, 255, 255)))
+                if len(rgb) != 3 or not all(0 <= c <= 255 for c in rgb):
+                    raise ValueError("rgb is three numbers from 0 to 255")
+                pulses = int(data.get('pulses', 2))
+                seconds = float(data.get('seconds', 1))
+                if not (0 < pulses <= 100 and 0.1 <= seconds <= 60):
+                    raise ValueError("pulses is 1-100 and seconds 0.1-60")
+                return cls(kind, rgb=rgb, pulses=pulses, seconds=seconds)
+            if kind == 'brightness':
+                level = float(data['level'])
+                if not 0 <= level <= 1:
+                    raise ValueError("level is from 0 to 1")
+                return cls(kind, level=level)
+        except (KeyError, TypeError) as err:
+            raise ValueError("Bad "+str(kind)+" command: "+repr(err)) from err
+        return cls(kind)
+
+    def latency(self):
+        """Seconds from being put on the queue to showing on the light, None until it has."""
+        if self.applied is None or self.received is None:
+            return None
+        return self.applied-self.received
+
+
+class CommandQueue:
+    """
+    Priority queue of Commands, which also stands in for a threading.Event
+    as the wake argument of pulse_light, wait_until and the like.\n
+
+    set(), clear(), is_set() and wait(timeout) behave as an Event's, for
+    asking for a refresh. But while wait() waits, commands put on the queue
+    are handed to handler (a ControlledLight) as soon as they arrive, and
+    the wait carries on, so a light holding a steady colour still answers
+    a command at once without ever waking up to check.
+    """
+    def __init__(self, handler=None):
+        self.handler = handler
+        self._heap = []
+        self._count = itertools.count() #first come first served within a priority.
+        self._flag = False
+        self._condition = threading.Condition()
+
+    def put(self, command):
+        """Add a command, returning it."""
+        command.received = _clock.perf_counter()
+        with self._condition:
+            heapq.heappush(self._heap, (command.priority, next(self._count), command))
+            self._condition.notify_all()
+        return command
+
+    def get(self):
+        """Take the most urgent command, or None if there are none."""
+        with self._condition:
+            if not self._heap:
+                return None
+            return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def set(self):
+        with self._condition:
+            self._flag = True
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._flag = False
+
+    def is_set(self):
+        return self._flag
+
+    def wait(self, timeout=None):
+        """
+        Wait until set() or for timeout seconds, running commands as they
+        arrive. Returns is_set(). Timed on the current clock; on a
+        VirtualClock a timeout is slept straight away, as VirtualClock.wait does.
+        """
+        clock = _clock
+        deadline = None if timeout is None else clock.monotonic()+timeout
+        while True:
+            with self._condition:
+                while not self._flag and not (self._heap and self.handler is not None):
+                    remaining = None if deadline is None else deadline-clock.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    if remaining is not None and isinstance(clock, VirtualClock):
+                        clock.sleep(remaining)
+                    else:
+                        self._condition.wait(remaining)
+                if self._flag:
+                    return True
+            self.handler.run_commands(deadline) #not holding the lock, so more can be put meanwhile.
+
+
+class ControlledLight:
+    """
+    Wraps a light object so Commands on queue (a CommandQueue, made if not
+    given, which should be the wake Event of the effects played on it) can
+    preempt or overlay the effect playing.\n
+
+    Every frame an effect writes goes through set_rgb, which first runs any
+    commands waiting, and the queue runs them itself while the effect waits
+    (see CommandQueue.wait), so a command shows within one frame time at
+    most. Brightness and off overlay every frame from then on. A notification
+    takes over the light, at its own frame_time, and then the effect's
+    latest frame is shown again; effects time frames against absolute
+    deadlines, so they carry on from where they should be by then. A
+    notification lasts at most max_notify seconds, and stops early for
+    another command, the queue being set (e.g. a refresh asked for by a
+    signal) or the end of the wait it was run from.\n
+
+    latencies keeps each command's latency(), and metrics get
+    command_latency_seconds, when enabled.
+    """
+    def __init__(self, lightobj, queue=None, frame_time=0.02, max_notify=60):
+        self.light = lightobj
+        self.backend = lightobj.backend
+        self.queue = queue if queue is not None else CommandQueue()
+        self.queue.handler = self
+        self.frame_time = frame_time
+        self.max_notify = max_notify
+        self.rgb = (0, 0, 0) #the effect's latest frame.
+        self.level = 1.0
+        self.off = False
+        self.latencies = collections.deque(maxlen=1000)
+
+    def _shown(self, rgb):
+        """The colour to write for rgb, with brightness and off applied."""
+        if self.off:
+            return (0, 0, 0)
+        level = self.level
+        return (rgb[0]*level, rgb[1]*level, rgb[2]*level)
+
+    def _applied(self, command):
+        command.applied = _clock.perf_counter()
+        latency = command.latency()
+        self.latencies.append(latency)
+        if _metrics is not None:
+            _metrics.observe('command_latency_seconds', latency)
+            _metrics.count('commands')
+        command.done.set()
+
+    def run_commands(self, until=None):
+        """
+        Carry out every command waiting on the queue, most urgent first.
+        until is the monotonic time (on the current clock) notifications must stop by, if any.
+        """
+        while True:
+            command = self.queue.get()
+            if command is None:
+                return
+            if command.kind == 'notify':
+                self._notify(command, until)
+            else:
+                if command.kind == 'off':
+                    self.off = True
+                elif command.kind == 'on':
+                    self.off = False
+                elif command.kind == 'brightness':
+                    self.level = command.params['level']
+                self.light.set_rgb(*self._shown(self.rgb))
+                self._applied(command)
+
+    def _notify(self, command, until=None):
+        """
+        Pulse to the command's colour and back, for at most max_notify seconds
+        and stopping by until (monotonic time). Another command arriving,
+        or the queue being set, cuts it short.
+        """
+        if self.off:
+            self._applied(command) #an off lamp stays off.
+            return
+        steps = max(1, round(command.params['seconds']/self.frame_time/2))
+        here, there = self._shown(self.rgb), self._shown(command.params['rgb'])
+        pulse = itertools.chain(compile_fade(here, there, steps), compile_fade(there, here, steps))
+        frames = list(pulse)*command.params['pulses']
+        frames = frames[:max(1, int(self.max_notify/self.frame_time))]
+        clock = FrameClock(self.frame_time)
+        queue = self.queue
+        for i in clock.frames(len(frames)):
+            self.light.set_rgb(*frames[i])
+            if command.applied is None:
+                self._applied(command)
+            if len(queue) or queue.is_set() or (until is not None and _clock.monotonic() >= until):
+                break
+        self.light.set_rgb(*self._shown(self.rgb))
+
+    def set_rgb(self, R, G, B):
+        if len(self.queue):
+            self.run_commands()
+        self.rgb = (R, G, B)
+        return self.light.set_rgb(*self._shown(self.rgb))
+
+    def colour_cont(self, R, G, B, on_time):
+        self.set_rgb(R, G, B)
+        wait_until(_clock.monotonic()+on_time, self.queue)
+
+    def colour(self, R, G, B, on_time):
+        self.colour_cont(R, G, B, on_time)
+        self.set_rgb(0, 0, 0)
+
+    def shutdown(self):
+        self.light.shutdown()
+
+
+class CommandServer:
+    """
+    Local control endpoint putting Commands on a CommandQueue, on a Unix
+    socket (socket_path) and/or HTTP on localhost (port).\n
+
+    The Unix socket takes one JSON command per line and answers each with
+    a line; HTTP takes one JSON command POSTed to any path. Replies are
+    {"ok": true, "latency_ms": ...} once the command shows on the light,
+    {"ok": true, "queued": true} if it hasn't within wait seconds, or
+    {"ok": false, "error": message}.
+    """
+    def __init__(self, queue, socket_path=None, port=None, host='127.0.0.1', wait=1.0):
+        import socketserver
+        import http.server
+        self.queue = queue
+        self.socket_path = socket_path
+        self.wait = wait
+        self.servers = []
+        control = self
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path) #left over from last time.
+
+            class StreamHandler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    for line in self.rfile:
+                        self.wfile.write(control.reply(line))
+                        self.wfile.flush()
+
+            self.servers.append(socketserver.ThreadingUnixStreamServer(socket_path, StreamHandler))
+
+        if port is not None:
+            class HTTPHandler(http.server.BaseHTTPRequestHandler):
+                def do_POST(self):
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    reply = control.reply(body)
+                    self.send_response(200 if reply.startswith(b'{"ok": true') else 400)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(reply)))
+                    self.end_headers()
+                    self.wfile.write(reply)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.servers.append(http.server.ThreadingHTTPServer((host, port), HTTPHandler))
+
+        for server in self.servers:
+            server.daemon_threads = True
+
+    @property
+    def port(self):
+        """The HTTP port listened on, e.g. if port 0 was asked for, or None."""
+        for server in self.servers:
+            if isinstance(server.server_address, tuple):
+                return server.server_address[1]
+        return None
+
+    def reply(self, request):
+        """Handle one encoded JSON command, returning the encoded reply line."""
+        import json
+        try:
+            command = Command.from_dict(json.loads(request))
+        except Exception as err: #whatever was sent, the client gets an answer.
+            return (json.dumps({'ok': False, 'error': str(err)})+'\n').encode()
+        self.queue.put(command)
+        if not command.done.wait(self.wait):
+            return b'{"ok": true, "queued": true}\n'
+        return (json.dumps({'ok': True, 'latency_ms': round(command.latency()*1000, 3)})+'\n').encode()
+
+    def start(self):
+        """Serve in background threads. Returns self."""
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path is not None:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+def send_command(socket_path, command, timeout=5):
+    """
+    Send a command dict to a CommandServer's Unix socket, returning its
+    decoded reply, e.g. send_command(path, {"command": "off"}).
+    """
+    import json
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(command)+'\n').encode())
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+##Multi-pixel output##
+
+class SimulatedStripDriver:
+    """
+    Stand-in for an addressable LED strip or PWM hat. Each committed frame is
+    kept as bytes (R, G, B per pixel, 0-255) with its time from timer, the
+    current clock's perf_counter by default.
+    """
+    def __init__(self, timer=None):
+        self.timer = timer
+        self.times = array.array('d')
+        self.frames = []
+
+    def write(self, data):
+        self.times.append((self.timer or _clock.perf_counter)())
+        self.frames.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+class APA102Driver:
+    """
+    Drives an APA102 ("DotStar") strip over SPI with the spidev module.
+    A whole frame goes out in one SPI transfer.
+    """
+    def __init__(self, bus=0, device=0, speed_hz=8000000, brightness=31):
+        import spidev
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = speed_hz
+        self.brightness = 0xE0 | (brightness & 0x1F)
+
+    def write(self, data):
+        count = len(data)//3
+        out = bytearray(4) #start frame
+        for i in range(count):
+            out += bytes((self.brightness, data[3*i+2], data[3*i+1], data[3*i])) #LEDs take B, G, R.
+        out += b'\xff'*((count+15)//16) #end frame, enough clocks to reach the last LED.
+        self.spi.writebytes2(out)
+
+    def close(self):
+        self.spi.close()
+
+
+class LightsDriver:
+    """Maps the pixels of a LightArray onto light objects, one per pixel, e.g. several globes."""
+    def __init__(self, lights):
+        self.lights = list(lights)
+
+    def write(self, data):
+        for i, lightobj in enumerate(self.lights):
+            lightobj.set_rgb(data[3*i], data[3*i+1], data[3*i+2])
+
+    def close(self):
+        for lightobj in self.lights:
+            lightobj.shutdown()
+
+
+class LightArray:
+    """
+    count RGB pixels held in one contiguous frame buffer.\n
+
+    frame holds R, G, B (0-255) for each pixel in turn. Effects work on the
+    whole buffer at once, as NumPy array operations if NumPy is installed
+    (and use_numpy isn't False). Nothing is shown until commit(), which sends
+    the whole frame to driver in a single write: SimulatedStripDriver,
+    APA102Driver, LightsDriver or anything with write(bytes) and close().\n
+
+    set_rgb, colour and colour_cont set every pixel, so the single-light
+    effects (ramp, pulse_light, ...) also work on a whole array.
+    """
+    def __init__(self, driver, count, use_numpy=None):
+        self.driver = driver
+        self.count = count
+        self.numpy = None
+        if use_numpy or use_numpy is None:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+
+        if self.numpy is not None:
+            self.frame = self.numpy.zeros(3*count)
+        else:
+            self.frame = array.array('d', bytes(8*3*count))
+
+    def __len__(self):
+        return self.count
+
+    def fill(self, R, G, B):
+        """Set every pixel to one colour."""
+        if self.numpy is not None:
+            self.frame.reshape(-1, 3)[:] = (R, G, B)
+        else:
+            self.frame[:] = array.array('d', (R, G, B))*self.count
+
+    def set_pixel(self, index, R, G, B):
+        if self.numpy is not None:
+            self.frame[3*index:3*index+3] = (R, G, B)
+        else:
+            self.frame[3*index:3*index+3] = array.array('d', (R, G, B))
+
+    def get_pixel(self, index):
+        return tuple(float(v) for v in self.frame[3*index:3*index+3])
+
+    def set_frame(self, values):
+        """Replace the whole frame with 3*count values."""
+        if len(values) != 3*self.count:
+            raise ValueError("Frame needs "+str(3*self.count)+" values")
+        if self.numpy is not None:
+            self.frame[:] = values
+        else:
+            self.frame[:] = array.array('d', values)
+
+    def mix(self, base, target, fraction):
+        """Set the frame to base + (target-base)*fraction, where base and target are whole frames."""
+        if self.numpy is not None:
+            base = self.numpy.asarray(base, dtype=float)
+            self.frame[:] = base+(self.numpy.asarray(target, dtype=float)-base)*fraction
+        else:
+            self.frame[:] = array.array('d', [b+(t-b)*fraction for b, t in zip(base, target)])
+
+    def scale(self, factor):
+        """Multiply every channel of every pixel by factor, e.g. to dim the whole array."""
+        if self.numpy is not None:
+            self.frame *= factor
+        else:
+            self.frame[:] = array.array('d', [v*factor for v in self.frame])
+
+    def to_bytes(self):
+        """The frame as bytes, each channel rounded and clamped to 0-255."""
+        if self.numpy is not None:
+            return self.numpy.clip(self.numpy.rint(self.frame), 0, 255).astype(self.numpy.uint8).tobytes()
+        return bytes(0 if v < 0 else 255 if v > 255 else int(v+0.5) for v in self.frame)
+
+    def commit(self):
+        """Send the whole frame to the driver in one write."""
+        self.driver.write(self.to_bytes())
+
+    def set_rgb(self, R, G, B):
+        self.fill(R, G, B)
+        self.commit()
+
+    def colour_cont(self, R, G, B, on_time):
+        self.set_rgb(R, G, B)
+        _clock.sleep(on_time)
+
+    def colour(self, R, G, B, on_time):
+        self.colour_cont(R, G, B, on_time)
+        self.set_rgb(0, 0, 0)
+
+    def shutdown(self):
+        self.set_rgb(0, 0, 0)
+        self.driver.close()
+
+
+def _wave_weights(steps):
+    """Pulse shape, 0 to 1 and back, as possinwave over one period in steps."""
+    return [(1+math.sin(math.radians(-90+i*360/steps)))/2 for i in range(steps)]
+
+
+def array_pulse(lightarray, base, intensity, clock, steps=36):
+    """
+    Pulse every pixel from its colour in base (a whole frame) to white of intensity
+    (0-255) and back, in steps frames timed by a FrameClock. All pixels are computed
+    together for each frame.
+    """
+    white = [intensity]*len(base)
+    weights = _wave_weights(steps)
+    for i in clock.frames(steps):
+        lightarray.mix(base, white, weights[i])
+        lightarray.commit()
+
+
+def array_fade(lightarray, from_frame, to_frame, clock, steps=50):
+    """Cross-fade the whole array between two frames in steps frames timed by a FrameClock."""
+    for i in clock.frames(steps):
+        lightarray.mix(from_frame, to_frame, (i+1)/steps)
+        lightarray.commit()
+
+
+##Light driver process##
+##The lights can run in a process of their own, so downloads, parsing and
+##garbage collection in the main process can't make them stutter. The main
+##process puts timed frames into a FrameRing in shared memory and the driver
+##process plays them at their deadlines.
+
+_U64 = struct.Struct('<Q')
+_F64 = struct.Struct('<d')
+
+
+class FrameRing:
+    """
+    Lock-free ring buffer of timed frames in shared memory, for one process
+    writing and one reading.\n
+
+    Each slot holds (sequence, deadline on the monotonic clock, light index,
+    R, G, B). The writer only moves head (and cut), the reader only moves
+    tail and its counters, so neither ever waits for the other, and the
+    real-time driver can't be held up by a preempted main process.\n
+
+    Plain writes to shared memory aren't ordered between cores (e.g. on a
+    multi-core ARM Pi the reader could see a new head before the slot it
+    publishes), so each slot is published seqlock style: the writer marks
+    it 2*n+1 while writing frame n, then 2*n+2 once it's complete, and only
+    then moves head. The reader takes a slot only if its sequence reads
+    2*n+2 both before and after reading the frame, otherwise it tries again,
+    so it never plays a stale or half-written frame. Indexes are 64 bit,
+    but stay below 2**32 (a few years of frames) so a 32 bit Pi can't read
+    one half-written either.\n
+
+    Made with name None it creates a new block of shared memory; given the
+    name of one it attaches to it. The creator should unlink() it when
+    finished.
+    """
+    HEADER = 256
+    SLOT = struct.Struct('<QdQddd')
+    FRAME = struct.Struct('<dQddd') #a slot after its sequence.
+    #Header offsets. Writer and reader fields are kept on separate cache lines.
+    HEAD, CUT, STOP = 0, 8, 16
+    TAIL, SHOWN, SKIPPED, TOTAL_LATE, MAX_LATE = 64, 72, 80, 88, 96
+    RETRIES = 100 #reads of a slot whose sequence hasn't caught up with head yet.
+
+    def __init__(self, slots=4096, name=None):
+        from multiprocessing import shared_memory
+        size = self.HEADER+slots*self.SLOT.size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.slots = slots
+        self.buf = self.shm.buf
+
+    def _get(self, offset):
+        return _U64.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        _U64.pack_into(self.buf, offset, value)
+
+    def _slot(self, n):
+        """Offset of the slot frame n goes in."""
+        return self.HEADER+(n % self.slots)*self.SLOT.size
+
+    def __len__(self):
+        return self._get(self.HEAD)-self._get(self.TAIL)
+
+    def put(self, deadline, index, rgb):
+        """Writer: add a frame after all the others. Returns False if the ring is full."""
+        head = self._get(self.HEAD)
+        if head-self._get(self.TAIL) >= self.slots:
+            return False
+        offset = self._slot(head)
+        self._set(offset, 2*head+1) #being written.
+        self.FRAME.pack_into(self.buf, offset+8, deadline, index, rgb[0], rgb[1], rgb[2])
+        self._set(offset, 2*head+2) #complete.
+        self._set(self.HEAD, head+1) #only now can the reader see it.
+        return True
+
+    def deadline(self, ahead=0):
+        """Writer: deadline of the frame ahead frames after the oldest one waiting, or None."""
+        tail = self._get(self.TAIL)+ahead
+        if tail >= self._get(self.HEAD):
+            return None
+        return _F64.unpack_from(self.buf, self._slot(tail)+8)[0]
+
+    def clear(self):
+        """Writer: drop every frame waiting so far, e.g. to show something else now."""
+        self._set(self.CUT, self._get(self.HEAD))
+
+    def peek(self):
+        """Reader: the oldest frame waiting, as (deadline, index, R, G, B), or None."""
+        tail = self._get(self.TAIL)
+        cut = self._get(self.CUT)
+        if cut > tail:
+            self._set(self.SKIPPED, self._get(self.SKIPPED)+cut-tail)
+            tail = cut
+            self._set(self.TAIL, tail)
+        if tail >= self._get(self.HEAD):
+            return None
+        offset = self._slot(tail)
+        complete = 2*tail+2
+        for attempt in range(self.RETRIES):
+            if self._get(offset) == complete:
+                frame = self.FRAME.unpack_from(self.buf, offset+8)
+                if self._get(offset) == complete:
+                    return frame
+        return None #not visible to this core yet, the reader should look again.
+
+    def pop(self):
+        """Reader: done with the oldest frame, so the writer can reuse its slot."""
+        self._set(self.TAIL, self._get(self.TAIL)+1)
+
+    def record(self, shown, skipped, total_late, max_late):
+        """Reader: add to the counters stats() reports."""
+        self._set(self.SHOWN, self._get(self.SHOWN)+shown)
+        self._set(self.SKIPPED, self._get(self.SKIPPED)+skipped)
+        _F64.pack_into(self.buf, self.TOTAL_LATE, _F64.unpack_from(self.buf, self.TOTAL_LATE)[0]+total_late)
+        if max_late > _F64.unpack_from(self.buf, self.MAX_LATE)[0]:
+            _F64.pack_into(self.buf, self.MAX_LATE, max_late)
+
+    def stats(self):
+        """Frames shown and skipped by the reader, and its total and worst lateness (seconds)."""
+        return {'shown': self._get(self.SHOWN), 'skipped': self._get(self.SKIPPED),
+                'total_late': _F64.unpack_from(self.buf, self.TOTAL_LATE)[0],
+                'max_late': _F64.unpack_from(self.buf, self.MAX_LATE)[0],
+                'waiting': len(self)}
+
+    def stop(self):
+        self._set(self.STOP, 1)
+
+    def stopping(self):
+        return self._get(self.STOP) != 0
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _raise_priority(priority):
+    """Ask for real-time (SCHED_FIFO) scheduling at priority, or failing that a lower nice value."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return 'SCHED_FIFO %d' % priority
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(-10)
+        return 'nice -10'
+    except OSError:
+        return None
+
+
+def _run_light_driver(ring, doorbell, pins, backend, frequency, priority, parent):
+    """Body of the driver process: play frames from ring on lights at pins until told to stop."""
+    import gc
+    import signal
+    #ctrl+c and other signals are for the main process, which stops this one.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    if priority and _raise_priority(priority) is None:
+        print("Light driver: couldn't raise priority, running at normal priority.")
+
+    shared = BACKENDS[backend]()
+    lights = [light(R_pin, G_pin, B_pin, Frequency=frequency, backend=shared)
+              for R_pin, G_pin, B_pin in pins]
+    gc.disable() #nothing here makes reference cycles, and a collection would be a stutter.
+
+    latest = [None]*len(lights)
+    while True:
+        doorbell.clear() #before looking, so a frame put after this rings it again.
+        if ring.stopping():
+            break
+        frame = ring.peek()
+        if frame is None:
+            if len(ring):
+                continue #a frame not visible to this core yet, look again.
+            #Nothing to do. Check once a minute that the main process is still there.
+            if not doorbell.wait(60) and os.getppid() != parent:
+                break
+            continue
+        now = _clock.monotonic()
+        if frame[0] > now:
+            doorbell.wait(frame[0]-now) #early if cleared or stopped.
+            continue
+
+        #Take everything that's due; if a light has several, only the latest is shown.
+        skipped = 0
+        while frame is not None and frame[0] <= now:
+            ring.pop()
+            if latest[frame[1]] is not None:
+                skipped += 1
+            latest[frame[1]] = frame
+            frame = ring.peek()
+        shown = 0
+        total_late = max_late = 0.0
+        for i, due in enumerate(latest):
+            if due is not None:
+                lights[i].set_rgb(due[2], due[3], due[4])
+                shown += 1
+                total_late += now-due[0]
+                max_late = max(max_late, now-due[0])
+                latest[i] = None
+        ring.record(shown, skipped, total_late, max_late)
+
+    for lightobj in lights:
+        lightobj.shutdown()
+    shared.cleanup()
+    ring.close()
+
+
+class LightDriverProcess:
+    """
+    Runs lights in a separate process, fed timed frames through a FrameRing.\n
+
+    pins is a list of (R_pin, G_pin, B_pin), one per light, all on a backend
+    from BACKENDS (by name) made in the driver process. The driver tries to
+    raise its scheduling priority to real-time priority (which needs root or
+    CAP_SYS_NICE, 0 to not try) and turns off garbage collection.\n
+
+    The main process uses play_timelines() to queue frames ahead of time, or
+    the RemoteLight objects in lights as if they were light objects. The
+    driver process is forked, so make one before starting any threads. The
+    frames are timed on the system's monotonic clock, not a VirtualClock.
+    """
+    def __init__(self, pins, backend='rpi', frequency=100, slots=4096, priority=10):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        self.ring = FrameRing(slots)
+        self.doorbell = context.Event()
+        self.last_deadline = 0.0
+        self.process = context.Process(target=_run_light_driver, name='lampi-driver', daemon=True,
+                                       args=(self.ring, self.doorbell, list(pins), backend,
+                                             frequency, priority, os.getpid()))
+        self.process.start()
+        self.lights = [RemoteLight(self, i) for i in range(len(pins))]
+
+    def _put(self, deadline, index, rgb, wake=None):
+        """
+        Queue one frame, waiting for room if the ring is full. Returns True if
+        woken by wake. Raises RuntimeError if the driver process has died, as
+        then the ring never empties.
+        """
+        while not self.ring.put(deadline, index, rgb):
+            if not self.process.is_alive():
+                raise RuntimeError("Light driver process has stopped (exit code "
+                                   +str(self.process.exitcode)+")")
+            self.doorbell.set()
+            #Wait for half the ring to be played, rather than waking for every frame.
+            if wait_until(self.ring.deadline(self.ring.slots//2) or 0.0, wake):
+                return True
+        self.last_deadline = max(self.last_deadline, deadline)
+        return False
+
+    def set_rgb(self, index, R, G, B):
+        """Show a colour on light index now, or straight after the frames already queued for it."""
+        self._put(max(_clock.monotonic(), self.last_deadline), index, (R, G, B))
+        self.doorbell.set()
+
+    def play_timelines(self, players, wake=None):
+        """
+        Queue timelines, as play_timelines() plays them, for the driver to play.\n
+
+        players is a list of (light index, timeline) pairs. This returns once
+        every frame is queued, which for long timelines is up to a ring's
+        worth of frames before the end. If wake (a threading.Event) is set
+        meanwhile it returns True straight away, leaving the rest unqueued.
+        """
+        heap = []
+        for n, (index, timeline) in enumerate(players):
+            frame = next(timeline, None)
+            if frame is not None:
+                heap.append((frame[0], n, frame[1]))
+        heapq.heapify(heap)
+
+        while heap:
+            deadline, n, rgb = heapq.heappop(heap)
+            index, timeline = players[n]
+            if self._put(deadline, index, rgb, wake):
+                self.doorbell.set()
+                return True
+            frame = next(timeline, None)
+            if frame is not None:
+                heapq.heappush(heap, (frame[0], n, frame[1]))
+        self.doorbell.set()
+        return False
+
+    def clear(self):
+        """Drop every frame queued but not yet shown."""
+        self.ring.clear()
+        self.last_deadline = 0.0
+        self.doorbell.set()
+
+    def wait(self):
+        """Wait until every frame queued has been shown."""
+        deadline = self.last_deadline
+        sleep_until(deadline)
+        while len(self.ring) and self.process.is_alive():
+            sleep_until(_clock.monotonic()+0.01)
+
+    def stats(self):
+        """The driver's counts of frames shown and skipped, and how late they were."""
+        return self.ring.stats()
+
+    def cleanup(self, timeout=5):
+        """Stop the driver process, turning the lights off, and free the shared memory."""
+        self.ring.stop()
+        self.doorbell.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.ring.close()
+        self.ring.unlink()
+
+
+class RemoteLight:
+    """
+    Stands in for a light object run by a LightDriverProcess, so the usual
+    effects can be used on it. set_rgb queues the colour to show now, and
+    play_frames hands a whole effect's frames over at once so the driver
+    times every frame of it.
+    """
+    def __init__(self, driver, index):
+        self.driver = driver
+        self.backend = driver #so lightobj.backend.cleanup() stops the driver.
+        self.index = index
+
+    def set_rgb(self, R, G, B):
+        self.driver.set_rgb(self.index, R, G, B)
+
+    def play_frames(self, frames, clock):
+        """Queue frames at clock's deadlines and wait until they've been played, as play_frames() does."""
+        if isinstance(frames, FrameBuffer):
+            frames = [frames[i] for i in range(len(frames))]
+        start, frame_time = clock.start, clock.frame_time
+        self.driver.play_timelines([(self.index, ((start+i*frame_time, rgb) for i, rgb in enumerate(frames)))])
+        clock.start = start+len(frames)*frame_time
+        sleep_until(clock.start)
+
+    def play_timeline(self, timeline, wake=None):
+        """Queue a timeline for this light. See LightDriverProcess.play_timelines."""
+        return self.driver.play_timelines([(self.index, timeline)], wake)
+
+    def colour_cont(self, R, G, B, on_time):
+        self.set_rgb(R, G, B)
+        _clock.sleep(on_time)
+
+    def colour(self, R, G, B, on_time):
+        self.colour_cont(R, G, B, on_time)
+        self.set_rgb(0, 0, 0)
+
+    def shutdown(self):
+        self.set_rgb(0, 0, 0)
+
+
+##Weatherdata and internet functions##
+
+def check_connection(url, timeout=2):
+    """Quick check if your Pi is connected to the internet.\n
+
+    Only opens (and closes) a connection to the url's server, nothing is
+    downloaded. Returns True or False depending on result.
+    """
+    import socket
+    import urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    try:
+        socket.create_connection((parts.hostname, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+class ForecastError(Exception):
+    """
+    Getting a forecast failed, and asking again won't help: a bad API key or
+    location, or a reply that isn't a forecast.
+    """
+
+
+class ForecastUnavailable(ForecastError):
+    """
+    Getting a forecast failed for now: the connection timed out or the
+    server is too busy. retry_after is the server's hint of how many
+    seconds to wait before asking again, or None.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _status_error(status, message, headers=None):
+    """The exception for an HTTP error status: ForecastUnavailable if the server is busy (429 or 503)."""
+    if status in (429, 503):
+        return ForecastUnavailable(message, cache_hints(headers).get('retry_after'))
+    return ForecastError(message)
+
+
+def _network_error(err):
+    """The exception for a network error: ForecastUnavailable if it timed out, which may well pass."""
+    import socket
+    reason = getattr(err, 'reason', err) #urllib's URLError wraps the real error.
+    if isinstance(reason, socket.timeout):
+        return ForecastUnavailable(str(err))
+    return ForecastError(str(err))
+
+
+class ForecastCache:
+    """
+    Forecast cache held in memory and, if directory is given, on disk so it
+    survives restarts. Entries are keyed by a (provider, location) tuple.\n
+
+    An entry is fresh for ttl seconds after it was downloaded, or for the
+    server's max_age if it gave one, then stale. Stale entries older than
+    max_stale seconds are not served at all. The ETag and Last-Modified
+    headers are kept so stale entries can be revalidated with a conditional
+    request, and the last failed revalidation of each entry is kept so
+    callers serving it stale can back off (see failure()).
+    """
+    def __init__(self, directory=None, ttl=600, max_stale=6*3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries = {}
+        self._revalidating = {} #key: Thread currently refreshing that entry.
+        self._failures = {} #key: exception from the last revalidation, if it failed.
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = '-'.join(re.sub(r'[^A-Za-z0-9]+', '_', str(k)) for k in key)
+        return os.path.join(self.directory, name+'.json')
+
+    def get(self, key):
+        """Return the entry dict for key, loading it from disk if needed, or None.\n
+
+        Entries have 'data', 'fetched' (epoch seconds), 'etag', 'last_modified'
+        and 'max_age' (seconds, or None) keys. Entries too old to serve are
+        returned as None.
+        """
+        import json
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.directory is not None:
+            try:
+                with open(self._path(key)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with self._lock:
+                self._entries[key] = entry
+
+        if entry is None or self.age(entry) > self.max_stale:
+            return None
+        return entry
+
+    def put(self, key, data, etag=None, last_modified=None, max_age=None):
+        """Store newly downloaded data for key, fresh for the server's max_age if given."""
+        entry = {'data': data, 'fetched': _clock.time(),
+                 'etag': etag, 'last_modified': last_modified, 'max_age': max_age}
+        with self._lock:
+            self._entries[key] = entry
+            self._failures.pop(key, None)
+        self._save(key, entry)
+        return entry
+
+    def touch(self, key, max_age=None):
+        """Mark the entry for key as just checked, e.g. after a 304 Not Modified."""
+        with self._lock:
+            entry = self._entries.get(key)
+            self._failures.pop(key, None)
+            if entry is None:
+                return
+            entry['fetched'] = _clock.time()
+            entry['max_age'] = max_age
+        self._save(key, entry)
+
+    def _save(self, key, entry):
+        import json
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            with open(path+'.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(path+'.tmp', path) #so a crash never leaves half a file.
+        except OSError as err:
+            print("Couldn't save forecast cache:", err)
+
+    def age(self, entry):
+        """Seconds since the entry was downloaded or last revalidated."""
+        return _clock.time()-entry['fetched']
+
+    def lifetime(self, entry):
+        """Seconds the entry stays fresh for: the server's max_age, or ttl."""
+        max_age = entry.get('max_age')
+        return self.ttl if max_age is None else max_age
+
+    def is_fresh(self, entry):
+        return self.age(entry) < self.lifetime(entry)
+
+    def hints(self, key, entry):
+        """
+        cache_hints-style dict for serving entry: max_age is how much longer
+        it stays fresh. If it's stale because the last revalidation failed,
+        stale is True and retry_after is the server's hint, if it gave one.
+        """
+        if self.is_fresh(entry):
+            return {'max_age': self.lifetime(entry)-self.age(entry)}
+        with self._lock:
+            err = self._failures.get(key)
+        if err is None:
+            return {}
+        hints = {'stale': True}
+        if getattr(err, 'retry_after', None) is not None:
+            hints['retry_after'] = err.retry_after
+        return hints
+
+    def failure(self, key):
+        """The exception the last revalidation of key failed with, or None."""
+        with self._lock:
+            return self._failures.get(key)
+
+    def revalidate(self, key, fetch):
+        """Refresh the entry for key in a background thread, if one isn't already running.\n
+
+        fetch(entry, hints) is called with the current entry (or None) and an
+        empty dict to fill in with cache_hints(), and must return (data, etag,
+        last_modified), with data None if the server said it was unchanged.
+        Errors are printed and kept for failure(), and leave the cached entry
+        as it was. Returns the thread, so callers can wait on it.
+        """
+        with self._lock:
+            thread = self._revalidating.get(key)
+            if thread is not None and thread.is_alive():
+                return thread
+            thread = threading.Thread(target=self._revalidate, args=(key, fetch), daemon=True)
+            self._revalidating[key] = thread
+        thread.start()
+        return thread
+
+    def _revalidate(self, key, fetch):
+        hints = {}
+        try:
+            data, etag, last_modified = fetch(self.get(key), hints)
+        except Exception as err:
+            print("Forecast revalidation failed:", err)
+            with self._lock:
+                self._failures[key] = err
+            return
+        if data is None:
+            self.touch(key, hints.get('max_age'))
+        else:
+            self.put(key, data, etag, last_modified, hints.get('max_age'))
+
+
+class Prefetcher:
+    """
+    Runs fetch() in a background thread, so the result is ready when it's needed
+    and the lamp can keep animating while it downloads.\n
+
+    start(at) begins a run, waiting until at (seconds since the epoch) if given,
+    and start_now() cuts that wait short. result() waits for the run to finish and returns what fetch() returned,
+    or raises the exception it raised.
+    """
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self._thread = None
+        self._result = None
+        self._error = None
+
+    def start(self, at=None):
+        """Start fetching now, or at the epoch time at. Does nothing if a run is in progress."""
+        if self.running():
+            return
+        deadline = None if at is None else monotonic_from_epoch(at)
+        self._go = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(deadline, self._go), daemon=True)
+        self._thread.start()
+
+    def start_now(self):
+        """Start fetching straight away: cut short the wait of a run started with at, or start one."""
+        if self.running():
+            self._go.set()
+        else:
+            self.start()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, deadline, go):
+        if deadline is not None:
+            wait_until(deadline, go)
+        try:
+            self._result, self._error = self.fetch(), None
+        except Exception as err:
+            self._result, self._error = None, err
+
+    def result(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for the current run and return its result.\n
+
+        If nothing has been started yet a run is started now.
+        """
+        if self._thread is None:
+            self.start()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError("Prefetch still running")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+#Fields of each wunderground.com hourly forecast entry used by extractHourlyUWeather.
+HOURLY_FIELDS = ('FCTTIME', 'temp', 'wspd', 'condition', 'pop', 'qpf')
+
+_JSON_SPECIAL = re.compile(r'["{}\[\]]') #Characters that matter when skipping a value.
+_JSON_STRING_END = re.compile(r'["\\]')
+_JSON_SCALAR_END = re.compile(r'[\s,}\]]')
+
+
+class _JSONStream:
+    """
+    Minimal incremental reader for one JSON document, used by stream_hourly_json.\n
+
+    Only as much of the source as is needed is read, and text that has been
+    dealt with is dropped, so memory use stays around the size of one value.
+    """
+    def __init__(self, source, encoding, chunk_size):
+        self.source = source
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.bytes_read = 0
+
+    def _more(self):
+        """Read another chunk, returns False at the end of the source."""
+        chunk = self.source.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.bytes_read += len(chunk)
+        if self.pos > 0: #throw away what's been used already.
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += self.decoder.decode(chunk)
+        return True
+
+    def _need(self, offset):
+        """Make sure buf[pos+offset] exists."""
+        while self.pos+offset >= len(self.buf):
+            if not self._more():
+                raise ValueError("Unexpected end of JSON document")
+
+    def peek(self):
+        """Skip whitespace and return the next character without using it."""
+        while True:
+            self._need(0)
+            c = self.buf[self.pos]
+            if not c.isspace():
+                return c
+            self.pos += 1
+
+    def expect(self, chars):
+        """Use the next non-whitespace character, which must be one of chars."""
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of "+repr(chars)+" in JSON document, found "+repr(c))
+        self.pos += 1
+        return c
+
+    def _search(self, pattern, start):
+        """Find pattern from buf offset start (relative to pos), reading more as needed."""
+        while True:
+            match = pattern.search(self.buf, self.pos+start)
+            if match is not None:
+                return match.start()-self.pos
+            start = len(self.buf)-self.pos
+            if not self._more():
+                return None
+
+    def _value_end(self):
+        """Offset from pos of the end of the value starting at pos, reading as needed."""
+        first = self.peek()
+        if first not in '{["':
+            end = self._search(_JSON_SCALAR_END, 0)
+            return len(self.buf)-self.pos if end is None else end
+
+        depth = 0
+        offset = 0
+        while True:
+            offset = self._search(_JSON_SPECIAL, offset)
+            if offset is None:
+                raise ValueError("Unexpected end of JSON document")
+            c = self.buf[self.pos+offset]
+            if c == '"':
+                #Find the end of the string, stepping over escapes.
+                offset += 1
+                while True:
+                    offset = self._search(_JSON_STRING_END, offset)
+                    if offset is None:
+                        raise ValueError("Unexpected end of JSON document")
+                    if self.buf[self.pos+offset] == '"':
+                        break
+                    offset += 2
+                    self._need(offset)
+                if depth == 0:
+                    return offset+1
+            elif c in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return offset+1
+            offset += 1
+
+    def skip(self):
+        """Step over the next value without decoding it."""
+        end = self._value_end() #may move pos on past whitespace, so find this first.
+        self.pos += end
+
+    def value(self):
+        """Decode and return the next value."""
+        import json
+        end = self._value_end()
+        text = self.buf[self.pos:self.pos+end]
+        self.pos += end
+        return json.loads(text)
+
+
+def stream_hourly_json(source, hours, fields=HOURLY_FIELDS, encoding='utf-8', chunk_size=4096):
+    """
+    Read a wunderground.com hourly forecast JSON document from the file-like
+    object source incrementally, keeping only what's needed.\n
+
+    Only the 'response' object and, for each hour index in hours, the given
+    fields of that 'hourly_forecast' entry are decoded; everything else is skipped
+    over as it is read. Reading stops as soon as the last wanted hour is found.
+    Returns a dict in the same layout as the full document, where
+    'hourly_forecast' is a list with None for the hours not kept, so it works
+    with extractHourlyUWeather. Raises ValueError for malformed JSON.
+    """
+    wanted = set(int(h) for h in hours)
+    last = max(wanted)
+    stream = _JSONStream(source, encoding, chunk_size)
+    result = {}
+
+    stream.expect('{')
+    if stream.peek() == '}':
+        return result
+
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'hourly_forecast':
+            hourly = [None]*(last+1)
+            result['hourly_forecast'] = hourly
+            stream.expect('[')
+            index = 0
+            if stream.peek() != ']':
+                while True:
+                    if index in wanted:
+                        entry = stream.value()
+                        hourly[index] = {f: entry[f] for f in fields if f in entry}
+                    else:
+                        stream.skip()
+                    if index == last:
+                        return result #got everything, don't read any further.
+                    index += 1
+                    if stream.expect(',]') == ']':
+                        break
+            else:
+                stream.pos += 1
+            del hourly[index:] #fewer hours in the document than asked for.
+        elif key == 'response':
+            result['response'] = stream.value()
+        else:
+            stream.skip()
+
+        if stream.expect(',}') == '}':
+            return result
+
+
+def cache_hints(headers):
+    """
+    Read the server's hints on when to ask again from HTTP response headers.\n
+
+    Returns a dict with 'max_age' (seconds the response stays fresh, from
+    Cache-Control max-age or Expires) and/or 'retry_after' (seconds to wait
+    before retrying, from Retry-After), for whichever are present.
+    """
+    import email.utils
+
+    def seconds_until(http_date):
+        try:
+            when = email.utils.parsedate_to_datetime(http_date).timestamp()
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when-_clock.time())
+
+    hints = {}
+    if headers is None:
+        return hints
+
+    found = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+    if found:
+        hints['max_age'] = float(found.group(1))
+    elif headers.get('Expires'):
+        max_age = seconds_until(headers['Expires'])
+        if max_age is not None:
+            hints['max_age'] = max_age
+
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        if retry_after.strip().isdigit():
+            hints['retry_after'] = float(retry_after)
+        else:
+            retry_after = seconds_until(retry_after)
+            if retry_after is not None:
+                hints['retry_after'] = retry_after
+    return hints
+
+
+def _download_json(url, etag=None, last_modified=None, timeout=2, hours=None, fields=HOURLY_FIELDS,
+                   hints=None):
+    """Download and decode a JSON document, optionally as a conditional request.\n
+
+    Returns (parsed JSON, ETag, Last-Modified). Parsed JSON is None if the server
+    replied 304 Not Modified. Network errors are raised.
+    If hours is given the document is read with stream_hourly_json instead of
+    being loaded whole. If hints is a dict it is updated with cache_hints() from
+    the response, including error responses. A gzip-compressed reply is asked
+    for, and decompressed as it's read.
+    """
+    import json
+    import gzip
+    import urllib.request
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+
+    metrics = _metrics
+    if metrics is not None:
+        started = time.perf_counter()
+    try:
+        source = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if hints is not None:
+            hints.update(cache_hints(err.headers))
+        if err.code == 304:
+            if metrics is not None:
+                metrics.observe('fetch_seconds', time.perf_counter()-started)
+                metrics.count('fetch_not_modified')
+            return None, etag, last_modified
+        raise
+    if metrics is not None:
+        metrics.observe('fetch_seconds', time.perf_counter()-started)
+        started = time.perf_counter()
+    if hints is not None:
+        hints.update(cache_hints(source.headers))
+    headers = source.headers
+    encoding = headers.get_content_charset() or 'utf-8' #find the encoding type. Almost certainly "utf-8"
+    compressed = headers.get('Content-Encoding', '').lower() == 'gzip'
+
+    if hours is not None:
+        reader = _CountingReader(source) if metrics is not None else source
+        parsed_json = stream_hourly_json(gzip.GzipFile(fileobj=reader) if compressed else reader,
+                                         hours, fields, encoding)
+        source.close()
+        if metrics is not None:
+            metrics.observe('parse_seconds', time.perf_counter()-started)
+            metrics.observe('fetch_bytes', reader.bytes_read)
+        return parsed_json, headers.get('ETag'), headers.get('Last-Modified')
+
+    json_string = source.read()
+    if metrics is not None:
+        metrics.observe('fetch_bytes', len(json_string))
+    if compressed:
+        json_string = gzip.decompress(json_string)
+
+    ##This returns binary data, and for json we need a string, so we need to decode:
+    parsed_json = json.loads(json_string.decode(encoding)) #decode it and load it so it becomes a dict()
+    if metrics is not None:
+        metrics.observe('parse_seconds', time.perf_counter()-started)
+    return parsed_json, headers.get('ETag'), headers.get('Last-Modified')
+
+
+class _CountingReader:
+    """Wraps a response for _download_json, counting the bytes read from it."""
+    def __init__(self, source):
+        self.source = source
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.source.close()
+
+
+def _wunderground_error(parsed_json):
+    """Return the error message in a wunderground.com response, or None if there isn't one."""
+    try:
+        #Did our returned information contain an error code?
+        return (str(parsed_json['response']['error']['type'])+
+                ". Description: "+str(parsed_json['response']['error']['description']))
+    except (KeyError, TypeError):
+        return None #Error not found in JSON, so we're probably ok.
+
+
+WUNDERGROUND_URL = 'http://api.wunderground.com/api/'
+
+
+def wunderground_cache_key(location, hours=None):
+    """The ForecastCache key getUWeather keeps location's forecast under, for those hours."""
+    key = ('wunderground', location)
+    if hours is not None:
+        key = key+(','.join(str(h) for h in sorted(hours)),)
+    return key
+
+def getUWeather(apikey, location, cache=None, wait=2, hours=None, fields=HOURLY_FIELDS,
+                hints=None, base_url=WUNDERGROUND_URL):
+    """Uses a wunderground.com api key get a 10 hour forecast JSON file
+    and return a dict() structure.\n
+
+    User needs to register to get their own API key (16 digit hex).\n
+    Location is a string in the format 'Country/City' outside the USA and TWO_LETTER_STATE/City inside.
+    e.g. 'UK/Bristol' or 'TX/El_Paso'.\n
+    Raises ForecastError if url doesn't exist or contents is an error message.\n
+    Raises ForecastUnavailable if connection timesout, or the server is too busy (HTTP 429 or 503).\n
+
+    If a ForecastCache is given a fresh cached forecast is returned without
+    downloading. A stale one is revalidated in the background with a
+    conditional request; if that hasn't finished within wait seconds the stale
+    forecast is returned, and the cache is updated when the download completes.
+    Errors are only raised when there is nothing cached to fall back on.\n
+
+    If a list of hours is given (e.g. [foretime]) the response is streamed with
+    stream_hourly_json, keeping only those hours and fields, and stopping
+    early. This saves loading the whole document on small Pis.\n
+
+    If hints is a dict it is filled in with the server's max_age and
+    retry_after hints (see cache_hints). For a cached forecast max_age is how
+    much longer it stays fresh, and if it's served stale because revalidating
+    failed, hints['stale'] is True and retry_after is the server's, so the
+    caller can back off (see ForecastCache.hints).
+    base_url can point at another server with the same API, e.g. for testing.\n
+    """
+    import socket
+    import urllib.error
+    url = base_url+apikey+"/hourly/q/"+location+".json"
+    key = wunderground_cache_key(location, hours)
+
+    def fetch(entry, fetch_hints):
+        etag, last_modified = (None, None) if entry is None else (entry['etag'], entry['last_modified'])
+        try:
+            parsed_json, etag, last_modified = _download_json(url, etag, last_modified, hours=hours,
+                                                              fields=fields, hints=fetch_hints)
+        except urllib.error.HTTPError as err:
+            raise _status_error(err.code, str(err), err.headers) from err
+        except (urllib.error.URLError, socket.timeout) as err:
+            raise _network_error(err) from err
+        if parsed_json is not None:
+            error = _wunderground_error(parsed_json)
+            if error is not None:
+                raise ForecastError(error)
+            print('Forecast loaded from:\n'+url)
+        return parsed_json, etag, last_modified
+
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            if not cache.is_fresh(entry):
+                cache.revalidate(key, fetch).join(wait)
+                entry = cache.get(key) or entry
+                if not cache.is_fresh(entry):
+                    print("Using cached forecast from", round(cache.age(entry)), "seconds ago.")
+                    if _metrics is not None:
+                        _metrics.count('cache_stale_hits')
+                elif _metrics is not None:
+                    _metrics.count('cache_revalidated')
+            elif _metrics is not None:
+                _metrics.count('cache_hits')
+            if hints is not None:
+                hints.update(cache.hints(key, entry))
+            return entry['data']
+        if _metrics is not None:
+            _metrics.count('cache_misses')
+
+    ##Try to download the JSON. Some error catching.
+    if hints is None:
+        hints = {} #still wanted for the cache.
+    try:
+        parsed_json, etag, last_modified = _download_json(url, hours=hours, fields=fields, hints=hints)
+    except urllib.error.HTTPError as err:
+        raise _status_error(err.code, str(err), err.headers) from err #Busy, try again later.
+    except (urllib.error.URLError, socket.timeout) as err:
+        raise _network_error(err) from err #timed out connecting, try again later.
+    except ValueError as err:
+        raise ForecastError(str(err)) from err
+
+    ##Some checks to see if we actually got weather data
+    error = _wunderground_error(parsed_json)
+    if error is not None:
+        raise ForecastError(error) #no data loaded
+
+    print('Forecast loaded from:\n'+url)
+
+    if cache is not None:
+        cache.put(key, parsed_json, etag, last_modified, hints.get('max_age'))
 
-    print('Forecast loaded from:\n'+url)
-    
     return parsed_json
 
 
@@ -275,9 +2826,11 @@ def extractHourlyUWeather(hourlyforecastdict, foretime):
       uni = ultraviolet index (1 - 16. 16 is extreme)
       mslp = mean sea-level pressure. Barometric pressure reduced to sea level.
     """
+    import calendar
+    import datetime
 
     foretime=int(foretime)  #prevent addressing errors
-    forecast = {'retreived_time': datetime.datetime.today()}
+    forecast = {'retreived_time': datetime.datetime.fromtimestamp(_clock.time())}
     forecast['forecast_time'] = datetime.datetime.fromtimestamp( int(hourlyforecastdict['hourly_forecast'][foretime]['FCTTIME']['epoch']) )
 
     forecast['retreived_epoch'] = calendar.timegm(forecast['retreived_time'].timetuple()) #give value in unix time.
@@ -296,25 +2849,372 @@ def extractHourlyUWeather(hourlyforecastdict, foretime):
     return forecast
 
 
-def pulsefreq_fromrain(forecast):
-    """Take forecast dict() and based on 'condition' string and Probability of Precipitation ('pop')
-    percentage returns a tuple containing pulse frequency and intensity.\n
+class ForecastSeries:
+    """
+    Compact columns of hourly forecast data, built once per download.\n
+
+    Each column is an array with one value per forecast hour: hours (the hour
+    index in the original forecast), epoch (forecast time, seconds since the
+    epoch), tempC, windKPH, pop (%), QPFcm and condition_code. condition_code
+    indexes into the conditions list, so each distinct condition string is
+    only stored once. retrieved_epoch is when the forecast was downloaded.
     """
-    ##Descriptions of conditions:
-    ##http://www.wunderground.com/weather/api/d/docs?d=resources/phrase-glossary
-    ##Most conditions can be preceeded by 'Light' or 'Heavy'
+    COLUMNS = ('epoch', 'tempC', 'windKPH', 'pop', 'QPFcm')
 
-    pulses = 0  #start assuming no preciptitation. As we go through the options
-                #we'll build up the pulse value
-    intensity = 0
+    def __init__(self, retrieved_epoch=None):
+        self.retrieved_epoch = _clock.time() if retrieved_epoch is None else retrieved_epoch
+        self.hours = array.array('H')
+        self.epoch = array.array('d')
+        self.tempC = array.array('d')
+        self.windKPH = array.array('d')
+        self.pop = array.array('d')
+        self.QPFcm = array.array('d')
+        self.condition_code = array.array('H')
+        self.conditions = []
+        self._condition_codes = {}
 
-    if int(forecast['pop'])==0: #no precipitation, let's skip the rest of this function.
-        return (pulses, 0)
-        
+    @classmethod
+    def from_hourly(cls, hourlyforecastdict, retrieved_epoch=None):
+        """Build a series from a wunderground.com hourly forecast dict, as from getUWeather.\n
+
+        Hours left out by a streamed download (None entries) are skipped.
+        """
+        series = cls(retrieved_epoch)
+        for hour, entry in enumerate(hourlyforecastdict['hourly_forecast']):
+            if entry is None:
+                continue
+            try: #if zero this is often an empty string.
+                qpf = float(entry['qpf']['metric'])
+            except ValueError:
+                qpf = 0.0
+            series.append(hour, int(entry['FCTTIME']['epoch']), float(entry['temp']['metric']),
+                          float(entry['wspd']['metric']), float(entry['pop']), qpf,
+                          entry['condition'])
+        return series
+
+    def append(self, hour, epoch, tempC, windKPH, pop, QPFcm, condition):
+        """Add one hour to the end of the series. Hours must be added in order."""
+        code = self._condition_codes.get(condition)
+        if code is None:
+            code = len(self.conditions)
+            self.conditions.append(condition)
+            self._condition_codes[condition] = code
+
+        self.hours.append(hour)
+        self.epoch.append(epoch)
+        self.tempC.append(tempC)
+        self.windKPH.append(windKPH)
+        self.pop.append(pop)
+        self.QPFcm.append(QPFcm)
+        self.condition_code.append(code)
+
+    def __len__(self):
+        return len(self.hours)
+
+    def index(self, hour):
+        """Row holding forecast hour, raises KeyError if it isn't in the series."""
+        i = bisect.bisect_left(self.hours, hour)
+        if i == len(self.hours) or self.hours[i] != hour:
+            raise KeyError(hour)
+        return i
+
+    def condition(self, row):
+        """Condition string for a row."""
+        return self.conditions[self.condition_code[row]]
+
+    def row(self, row):
+        """A forecast dict, in the same format as extractHourlyUWeather returns, for a row."""
+        import datetime
+        return {'retreived_time': datetime.datetime.fromtimestamp(self.retrieved_epoch),
+                'retreived_epoch': self.retrieved_epoch,
+                'forecast_time': datetime.datetime.fromtimestamp(self.epoch[row]),
+                'tempC': self.tempC[row],
+                'windKPH': self.windKPH[row],
+                'condition': self.condition(row),
+                'pop': int(self.pop[row]),
+                'QPFcm': self.QPFcm[row]}
+
+    def hour(self, hour):
+        """The forecast dict for forecast hour, as extractHourlyUWeather(data, hour) would give."""
+        return self.row(self.index(hour))
+
+    def slice(self, start, stop):
+        """A new series holding rows start to stop (as for list slicing)."""
+        series = ForecastSeries(self.retrieved_epoch)
+        for name in ('hours', 'condition_code')+self.COLUMNS:
+            setattr(series, name, getattr(self, name)[start:stop])
+        series.conditions = self.conditions #codes still index the same list.
+        series._condition_codes = self._condition_codes
+        return series
+
+    def to_dict(self):
+        """The series as a dict of plain lists, e.g. for JSON."""
+        result = {'retrieved_epoch': self.retrieved_epoch, 'conditions': self.conditions}
+        for name in ('hours', 'condition_code')+self.COLUMNS:
+            result[name] = getattr(self, name).tolist()
+        return result
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a series from to_dict()'s output."""
+        series = cls(data['retrieved_epoch'])
+        series.hours = array.array('H', data['hours'])
+        series.condition_code = array.array('H', data['condition_code'])
+        for name in cls.COLUMNS:
+            setattr(series, name, array.array('d', data[name]))
+        series.conditions = list(data['conditions'])
+        series._condition_codes = {c: i for i, c in enumerate(series.conditions)}
+        return series
+
+    def nearest(self, epoch):
+        """Row whose forecast time is closest to epoch."""
+        i = bisect.bisect_left(self.epoch, epoch)
+        if i == 0:
+            return 0
+        if i == len(self.epoch):
+            return len(self.epoch)-1
+        return i if self.epoch[i]-epoch < epoch-self.epoch[i-1] else i-1
+
+    def at(self, column, epoch):
+        """Linearly interpolate column (e.g. 'tempC') at epoch, clamped to the ends of the series."""
+        values = getattr(self, column)
+        times = self.epoch
+        i = bisect.bisect_left(times, epoch)
+        if i == 0:
+            return values[0]
+        if i == len(times):
+            return values[-1]
+        f = (epoch-times[i-1])/(times[i]-times[i-1])
+        return values[i-1]+(values[i]-values[i-1])*f
+
+
+##Forecast archive##
+
+def read_recorded_forecast(path):
+    """
+    Read a recorded forecast file, returning (epoch recorded, hourly forecast dict).\n
+
+    Files can be ForecastCache entries, recorded at their 'fetched' time, or
+    wunderground.com hourly forecast JSON, recorded at the epoch the file is
+    named after (e.g. 1500000000.json) or else an hour before its first hour.
+    """
+    import json
+    with open(path) as f:
+        data = json.load(f)
+    if 'fetched' in data and 'data' in data:
+        return data['fetched'], data['data']
+    named = re.match(r'\d+', os.path.basename(path))
+    if named:
+        return int(named.group()), data
+    first = next(entry for entry in data['hourly_forecast'] if entry is not None)
+    return int(first['FCTTIME']['epoch'])-3600, data
+
+
+class _ArchiveColumn:
+    """One field of every record in a ForecastArchive, read straight from the map, for bisect."""
+    def __init__(self, archive, offset, fmt):
+        self.archive = archive
+        self.offset = archive.HEADER.size+offset
+        self.unpack_from = struct.Struct(fmt).unpack_from
+
+    def __len__(self):
+        return len(self.archive)
+
+    def __getitem__(self, i):
+        return self.unpack_from(self.archive._map, self.offset+i*self.archive.RECORD.size)[0]
+
+
+class ForecastArchive:
+    """
+    Append-only file of every hourly forecast downloaded for a location.\n
+
+    Each forecast hour is one fixed size record: retrieved_epoch, epoch
+    (forecast time), tempC, windKPH, pop, QPFcm, hour (the hour index in its
+    forecast, as foretime) and condition_code. Condition strings are kept
+    once each, a line apiece, in path+'.conditions'.\n
+
+    Records are only ever added at the end and always in the order the
+    forecasts were retrieved, so the retrieved_epoch field is itself the
+    time index: it's searched with bisect straight from the file, which is
+    read through mmap, so queries over years of forecasts load only the
+    records they look at. A half-written record from a crash is ignored.
+    """
+    HEADER = struct.Struct('<8sII') #magic, record size, spare.
+    MAGIC = b'LAMPIFA1'
+    RECORD = struct.Struct('<ddffffHH4x')
+    MAX_AHEAD = 16*86400 #longest forecast range looked back over by query().
+    FIELDS = ('retrieved_epoch', 'epoch', 'tempC', 'windKPH', 'pop', 'QPFcm', 'hour', 'condition_code')
+
+    def __init__(self, path):
+        self.path = path
+        self.conditions = []
+        self._condition_codes = {}
+        self._map = None
+        self._mapped_size = 0
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.RECORD.size, 0))
+        with open(path, 'rb') as f:
+            magic, size, spare = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC or size != self.RECORD.size:
+            raise ValueError(path+" isn't a forecast archive.")
+        try:
+            with open(path+'.conditions') as f:
+                for line in f:
+                    self._add_condition(line.rstrip('\n'))
+        except FileNotFoundError:
+            pass
+        self.retrieved = _ArchiveColumn(self, 0, '<d')
+
+    def _add_condition(self, condition):
+        self._condition_codes[condition] = len(self.conditions)
+        self.conditions.append(condition)
+
+    def _remap(self):
+        """Map the file again if it has grown. Returns the number of whole records."""
+        import mmap
+        size = os.path.getsize(self.path)
+        if size != self._mapped_size:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return (size-self.HEADER.size)//self.RECORD.size
+
+    def __len__(self):
+        return self._remap()
+
+    def record(self, i):
+        """Record i as a tuple in the order of FIELDS."""
+        return self.RECORD.unpack_from(self._map, self.HEADER.size+i*self.RECORD.size)
+
+    def last_retrieved(self):
+        """retrieved_epoch of the newest forecast archived, or None if it's empty."""
+        n = len(self)
+        return self.retrieved[n-1] if n else None
+
+    def append(self, series):
+        """
+        Add a ForecastSeries to the end of the archive, returning the number
+        of records written. Raises ValueError if it was retrieved before the
+        newest forecast already archived.
+        """
+        n = len(self)
+        if n and series.retrieved_epoch < self.retrieved[n-1]:
+            raise ValueError("Forecasts must be archived in the order they were retrieved.")
+
+        new_conditions = []
+        codes = []
+        for condition in series.conditions:
+            if condition not in self._condition_codes:
+                self._add_condition(condition)
+                new_conditions.append(condition)
+            codes.append(self._condition_codes[condition])
+        if new_conditions:
+            with open(self.path+'.conditions', 'a') as f:
+                f.write(''.join(condition+'\n' for condition in new_conditions))
+
+        data = bytearray()
+        for row in range(len(series)):
+            data += self.RECORD.pack(series.retrieved_epoch, series.epoch[row], series.tempC[row],
+                                     series.windKPH[row], series.pop[row], series.QPFcm[row],
+                                     series.hours[row], codes[series.condition_code[row]])
+        with open(self.path, 'r+b') as f:
+            f.seek(self.HEADER.size+n*self.RECORD.size) #over any half-written record.
+            f.write(data)
+            f.truncate()
+        return len(series)
 
-    ##Going to tight on definition here. Mist, Fog, Haze etc. won't result in a flashing light.
-    ##These conditions are listed on the API part of wunderground.com.
-    PrecipConds = [  'Drizzle',
+    def import_files(self, paths):
+        """
+        Archive recorded forecast files (see read_recorded_forecast), oldest
+        first. Files recorded no later than the newest forecast already
+        archived are skipped, so a directory can be imported again as it
+        grows. Returns the number of forecasts added.
+        """
+        recordings = sorted((read_recorded_forecast(path) for path in paths), key=lambda r: r[0])
+        last = self.last_retrieved()
+        added = 0
+        for recorded, data in recordings:
+            if last is not None and recorded <= last:
+                continue
+            self.append(ForecastSeries.from_hourly(data, recorded))
+            last = recorded
+            added += 1
+        return added
+
+    def query(self, hour=None, start=None, stop=None, retrieved_start=None, retrieved_stop=None):
+        """
+        Yield records (tuples in the order of FIELDS) for forecast hour
+        (None for all) whose forecast time is from start up to stop and
+        that were retrieved from retrieved_start up to retrieved_stop, all
+        epoch seconds and None for no limit.\n
+
+        Only records retrieved in the window that could match are read,
+        found with bisect on the time index. For "all 3 hour forecasts in
+        January" use hour=3, start and stop as January's start and end.
+        """
+        n = len(self)
+        #A forecast is retrieved before the time it's for, and at most MAX_AHEAD before.
+        low, high = retrieved_start, retrieved_stop
+        if stop is not None:
+            high = stop if high is None else min(high, stop)
+        if start is not None:
+            earliest = start-self.MAX_AHEAD
+            low = earliest if low is None else max(low, earliest)
+        first = 0 if low is None else bisect.bisect_left(self.retrieved, low)
+        last = n if high is None else bisect.bisect_left(self.retrieved, high)
+
+        unpack_from = self.RECORD.unpack_from
+        size = self.RECORD.size
+        offset = self.HEADER.size
+        for i in range(first, last):
+            record = unpack_from(self._map, offset+i*size)
+            if hour is not None and record[6] != hour:
+                continue
+            if (start is not None and record[1] < start) or (stop is not None and record[1] >= stop):
+                continue
+            yield record
+
+    def downloads(self, start=None, stop=None):
+        """Yield each forecast retrieved from start up to stop (epochs, None for no limit) as a ForecastSeries."""
+        n = len(self)
+        i = 0 if start is None else bisect.bisect_left(self.retrieved, start)
+        end = n if stop is None else bisect.bisect_left(self.retrieved, stop)
+        while i < end:
+            retrieved = self.retrieved[i]
+            j = bisect.bisect_right(self.retrieved, retrieved, i, end)
+            series = ForecastSeries(retrieved)
+            for k in range(i, j):
+                record = self.record(k)
+                series.append(record[6], record[1], record[2], record[3], record[4], record[5],
+                              self.conditions[record[7]])
+            yield series
+            i = j
+
+    def as_numpy(self):
+        """All the records as a NumPy structured array viewing the map (no copy), if NumPy is installed."""
+        import numpy
+        n = len(self)
+        dtype = numpy.dtype({'names': list(self.FIELDS),
+                             'formats': ['<f8', '<f8', '<f4', '<f4', '<f4', '<f4', '<u2', '<u2'],
+                             'offsets': [0, 8, 16, 20, 24, 28, 32, 34],
+                             'itemsize': self.RECORD.size})
+        return numpy.frombuffer(self._map, dtype, count=n, offset=self.HEADER.size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+
+
+##Descriptions of conditions:
+##http://www.wunderground.com/weather/api/d/docs?d=resources/phrase-glossary
+##Going to tight on definition here. Mist, Fog, Haze etc. won't result in a flashing light.
+##These conditions are listed on the API part of wunderground.com.
+PRECIP_CONDITIONS = ('Drizzle',
                      'Rain',
                      'Snow',
                      'Snow Grains',
@@ -347,25 +3247,115 @@ def pulsefreq_fromrain(forecast):
                      'Freezing Rain',
                      'Freezing Fog',
                      'Unknown Precipitation', #Frogs, cats, dogs etc.
-                     'Small Hail']
-
-    for i in PrecipConds:
-        if forecast['condition'].find(i) != -1: #does anything match the list above?
-            intensity = 200
-            pulses = int(forecast['pop'])*0.4
-
-            #now adjust for severity
-            #Have also seen 'Chance of' adjective phrase, but it's not documented.
-            if forecast['condition'].startswith('Heavy'):
-                intensity=255
-            elif forecast['condition'].startswith('Light'):
-                intensity=150
+                     'Small Hail')
+
+##Pulse intensity by the severity adjective a condition starts with, '' for none.
+##Have also seen 'Chance of' adjective phrase, but it's not documented.
+PRECIP_INTENSITY = {'Heavy': 255, 'Light': 150, '': 200}
+
+
+class PrecipRules:
+    """
+    Compiled table of which weather conditions make the light pulse, and how hard.\n
+
+    conditions are matched anywhere in the condition string, with a single
+    regular expression compiled when the table is created. intensities maps
+    the severity adjective the condition starts with ('' for none) to a pulse
+    intensity (0-255). The number of pulses a minute is the Probability of
+    Precipitation % times pulses_per_pop. Results are remembered for each
+    distinct condition string.
+    """
+    MEMO_SIZE = 1024 #Most distinct condition strings to remember.
+
+    def __init__(self, conditions=PRECIP_CONDITIONS, intensities=PRECIP_INTENSITY, pulses_per_pop=0.4):
+        if not conditions:
+            raise ValueError("Need at least one precipitation condition")
+
+        #Longest first, so 'Rain Showers' is reported rather than 'Rain'.
+        names = sorted(set(conditions), key=len, reverse=True)
+        self._condition = re.compile('|'.join(re.escape(c) for c in names))
+        adjectives = sorted((a for a in intensities if a), key=len, reverse=True)
+        self._severity = re.compile('|'.join(re.escape(a) for a in adjectives)) if adjectives else None
+
+        self.conditions = tuple(conditions)
+        self.intensities = dict(intensities)
+        self.pulses_per_pop = pulses_per_pop
+        self._memo = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a rule table from a JSON file.\n
+
+        The file holds an object with any of the keys "conditions" (list of strings),
+        "intensities" (object of adjective: intensity) and "pulses_per_pop" (number).
+        Missing keys use the defaults.
+        """
+        import json
+        with open(path) as f:
+            table = json.load(f)
+        return cls(table.get('conditions', PRECIP_CONDITIONS),
+                   table.get('intensities', PRECIP_INTENSITY),
+                   table.get('pulses_per_pop', 0.4))
+
+    def match(self, condition):
+        """Return (matched precipitation condition or None, pulse intensity) for a condition string."""
+        result = self._memo.get(condition)
+        if result is not None:
+            return result
+
+        found = self._condition.search(condition)
+        if found is None:
+            result = (None, 0)
+        else:
+            adjective = self._severity.match(condition) if self._severity else None
+            adjective = adjective.group() if adjective else ''
+            result = (found.group(), self.intensities.get(adjective, self.intensities.get('', 0)))
+
+        if len(self._memo) >= self.MEMO_SIZE:
+            self._memo.clear()
+        self._memo[condition] = result
+        return result
+
+    def pulses(self, condition, pop):
+        """Return (pulse frequency, intensity) for a condition string and Probability of Precipitation."""
+        pop = int(pop)
+        if pop == 0: #no precipitation
+            return (0, 0)
+
+        found, intensity = self.match(condition)
+        if found is None:
+            ##It is possible to have a non-precipitation condition and pop > 0. Not sure what to do then.
+            return (0, 0)
+        return (pop*self.pulses_per_pop, intensity)
+
+    def pulses_series(self, series):
+        """Return a list of (pulse frequency, intensity) for every row of a ForecastSeries.\n
+
+        Each distinct condition is only matched once.
+        """
+        matches = [self.match(c) for c in series.conditions]
+        result = []
+        for code, pop in zip(series.condition_code, series.pop):
+            found, intensity = matches[code]
+            if found is None or int(pop) == 0:
+                result.append((0, 0))
             else:
-                pass
+                result.append((int(pop)*self.pulses_per_pop, intensity))
+        return result
+
+
+DEFAULT_PRECIP_RULES = PrecipRules()
 
-    ##It is possible to have a non-precipitation condition and pop > 0. Not sure what to do then.
 
-    return (pulses, intensity)
+def pulsefreq_fromrain(forecast, rules=None):
+    """Take forecast dict() and based on 'condition' string and Probability of Precipitation ('pop')
+    percentage returns a tuple containing pulse frequency and intensity.\n
+
+    rules is a PrecipRules table, by default DEFAULT_PRECIP_RULES.
+    """
+    if rules is None:
+        rules = DEFAULT_PRECIP_RULES
+    return rules.pulses(forecast['condition'], forecast['pop'])
 
 ##timing and other admin functions##
 
@@ -387,7 +3377,7 @@ def lin_interp(indata, dimension, xvalue):
     #check xvalue is within range
     if xvalue >= max(indata[0]):
         #Above/at maximum, return rightmost dimension value.
-        return indata[dimension][len(indata[dimension]-1)]        
+        return indata[dimension][len(indata[dimension])-1]
     if xvalue <= min(indata[0]):
         #Below/at min value, return leftmost dimension value.
         return indata[dimension][0]
@@ -418,6 +3408,242 @@ def lin_interp(indata, dimension, xvalue):
 
     return yvalue
 
+
+class ColourScale:
+    """
+    Precompiled colour scale. Maps a value (e.g. temperature) to an (R, G, B) tuple.\n
+
+    Built once from a nested list in the same format lin_interp takes: the first
+    row are x-values in ascending order, the next three rows are the red, green
+    and blue values at each x. All three channels are found with one search, and
+    the gradients of each segment are worked out up front.
+    Like lin_interp, x-values outside the table return the closest end colour.\n
+
+    If lut_resolution is given (e.g. 0.1 for 0.1C steps) a dense lookup table
+    is also built, so each lookup is a single index, whatever the table size.
+    """
+    def __init__(self, table, lut_resolution=None):
+        if len(table) < 4:
+            raise ValueError("Table needs a row of x-values and three colour rows")
+
+        xs = [float(x) for x in table[0]]
+        rows = [[float(y) for y in table[d]] for d in (1, 2, 3)]
+
+        for row in rows:
+            if len(row) != len(xs):
+                raise ValueError("Colour rows must be the same length as the x-values")
+        for i in range(1, len(xs)):
+            if xs[i] <= xs[i-1]:
+                raise ValueError("X-values must be in strictly ascending order")
+
+        self.xs = xs
+        self.points = list(zip(*rows)) #one (R, G, B) tuple per x-value.
+
+        #Gradient of each channel between point i and i+1.
+        self._grads = []
+        for i in range(len(xs)-1):
+            dx = xs[i+1]-xs[i]
+            self._grads.append(tuple((rows[d][i+1]-rows[d][i])/dx for d in range(3)))
+
+        self.lut = None
+        self.lut_resolution = None
+        if lut_resolution:
+            self.build_lut(lut_resolution)
+
+    def _interp(self, xvalue):
+        """Interpolate all three channels at xvalue without the lookup table."""
+        xs = self.xs
+        if xvalue >= xs[-1]:
+            return self.points[-1]
+        if xvalue <= xs[0]:
+            return self.points[0]
+
+        m = bisect.bisect_right(xs, xvalue)-1 #segment xvalue falls into.
+        offset = xvalue-xs[m]
+        r, g, b = self.points[m]
+        gr, gg, gb = self._grads[m]
+        return (r+offset*gr, g+offset*gg, b+offset*gb)
+
+    def build_lut(self, resolution=0.1):
+        """Precompute the colour every resolution x-units across the whole table.\n
+
+        After this, rgb() returns the nearest precomputed colour.
+        """
+        if resolution <= 0:
+            raise ValueError("LUT resolution must be greater than zero")
+
+        count = int(round((self.xs[-1]-self.xs[0])/resolution))+1
+        self.lut = [self._interp(self.xs[0]+i*resolution) for i in range(count)]
+        self.lut_resolution = resolution
+        self._lut_scale = 1/resolution
+
+    def rgb(self, xvalue):
+        """Return the (R, G, B) tuple for xvalue."""
+        lut = self.lut
+        if lut is None:
+            return self._interp(xvalue)
+
+        i = int(round((xvalue-self.xs[0])*self._lut_scale))
+        if i < 0:
+            i = 0
+        elif i >= len(lut):
+            i = len(lut)-1
+        return lut[i]
+
+    __call__ = rgb
+
+    def rgb_many(self, xvalues):
+        """Return the colours for a sequence of x-values.\n
+
+        A list of (R, G, B) tuples is returned for a list or other iterable.
+        If xvalues is a NumPy array the whole batch is interpolated at once
+        and an (N, 3) array is returned.
+        """
+        if type(xvalues).__module__ == 'numpy':
+            import numpy #only reached if the caller already has NumPy loaded.
+            xarr = numpy.asarray(xvalues, dtype=float)
+            points = numpy.asarray(self.points)
+            return numpy.stack([numpy.interp(xarr, self.xs, points[:, d]) for d in range(3)],
+                               axis=-1)
+
+        rgb = self.rgb
+        return [rgb(x) for x in xvalues]
+
+
+def save_colour(path, rgb):
+    """Save the (R, G, B) colour being shown to path, for load_colour() after a restart."""
+    try:
+        with open(path+'.tmp', 'w') as f:
+            f.write(' '.join(repr(float(c)) for c in rgb)+'\n')
+        os.replace(path+'.tmp', path) #so a power cut never leaves half a file.
+    except OSError as err:
+        print("Couldn't save colour:", err)
+
+
+def load_colour(path):
+    """The (R, G, B) colour saved by save_colour(), or None if there isn't one."""
+    try:
+        with open(path) as f:
+            rgb = tuple(float(c) for c in f.read().split())
+    except (OSError, ValueError):
+        return None
+    if len(rgb) != 3:
+        return None
+    return rgb
+
+
+def process_age():
+    """Seconds since this process started, from /proc on Linux, or None where that's not available."""
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        #Fields after the command name, which is in brackets and may contain spaces.
+        started = int(stat.rsplit(')', 1)[1].split()[19])/os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime-started)
+
+
+class StartupTimer:
+    """
+    Times the stages of starting up from when the process started (or, if
+    that isn't known, from when the StartupTimer was made). Call mark(name)
+    as each stage finishes, then report() gives them all in milliseconds.
+    """
+    def __init__(self):
+        self.start = _clock.monotonic()-(process_age() or 0.0)
+        self.marks = []
+
+    def mark(self, name):
+        """Record that stage name has finished, returning seconds since the start."""
+        elapsed = _clock.monotonic()-self.start
+        self.marks.append((name, elapsed))
+        return elapsed
+
+    def report(self):
+        return "Startup: "+", ".join("%s %.0f ms" % (name, elapsed*1000) for name, elapsed in self.marks)
+
+
+def epoch_from_monotonic(monotonic_time):
+    """Convert a monotonic clock time to seconds since the epoch."""
+    return _clock.time()+(monotonic_time-_clock.monotonic())
+
+
+class RefreshScheduler:
+    """
+    Works out when a lamp should next fetch its forecast, spreading a fleet
+    of lamps out so they don't all hit the server in the same second.\n
+
+    Refreshes happen every interval minutes, on the same whole-interval
+    boundaries as next_refresh(), plus a fixed offset of up to jitter seconds
+    worked out from device_id (e.g. hostname and location), so it's the same
+    every time a device runs but differs between devices.\n
+
+    Times returned are on the monotonic clock, so they aren't moved by NTP
+    adjusting the wall clock. monotonic and wall are the clocks to use,
+    by default those of the current clock (see set_clock).\n
+
+    After a failure retries back off exponentially from backoff_base
+    seconds up to backoff_max, randomised per device. After retry_budget
+    failures in a row it gives up retrying early and waits for the next
+    regular refresh.
+    """
+    def __init__(self, interval, device_id='', jitter=120, backoff_base=30, backoff_max=1800,
+                 retry_budget=5, monotonic=None, wall=None):
+        self.period = interval*60
+        self.device_id = str(device_id)
+        self.offset = (zlib.crc32(self.device_id.encode())/2**32)*min(jitter, self.period)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.monotonic = monotonic or (lambda: _clock.monotonic())
+        self.wall = wall or (lambda: _clock.time())
+        self.failures = 0
+
+    def _boundary(self):
+        """Monotonic time of the next regular refresh."""
+        now_wall = self.wall()
+        since = (now_wall-self.offset) % self.period
+        return self.monotonic()+(self.period-since)
+
+    def success(self, max_age=None):
+        """Call after a successful fetch. Returns the monotonic time to refresh next.\n
+
+        max_age is the server's hint for how long the forecast stays fresh;
+        the lamp won't refresh before then.
+        """
+        self.failures = 0
+        deadline = self._boundary()
+        if max_age is not None:
+            deadline = max(deadline, self.monotonic()+max_age+self.offset)
+        return deadline
+
+    def failure(self, retry_after=None):
+        """Call after a failed (e.g. timed out) fetch. Returns the monotonic time to retry.\n
+
+        retry_after is the server's hint for how long to wait before trying again.
+        """
+        import random
+        self.failures += 1
+        if self.failures > self.retry_budget:
+            self.failures = 0
+            delay = None
+        else:
+            delay = min(self.backoff_max, self.backoff_base*2**(self.failures-1))
+            #Randomise, but the same way for this device and attempt every time.
+            delay *= 0.5+0.5*random.Random(self.device_id+':'+str(self.failures)).random()
+
+        if delay is None:
+            deadline = self._boundary()
+        else:
+            deadline = self.monotonic()+delay
+        if retry_after is not None:
+            deadline = max(deadline, self.monotonic()+retry_after)
+        return deadline
+
+
 def next_refresh(refresh_interval):
     """
     Returns the epoch time (in second, as float) of the next whole number of
@@ -427,6 +3653,7 @@ def next_refresh(refresh_interval):
     e.g. If refresh_interval is 10 (minutes) and it's now 16:24:15, next_refresh(10)
     will return the epoch seconds for 16:30:00.
     """
+    import calendar #for transforming to epoch time.
 
     if 60 % refresh_interval != 0:
         #Warn user that you're not going to get evenly spaced refreshes.
@@ -435,7 +3662,7 @@ def next_refresh(refresh_interval):
     #Create list of each hourly fresh time.
     refreshes = list(range(0, 60, int(refresh_interval)))
 
-    s = time.gmtime() ##get a time_struct for Now.
+    s = time.gmtime(_clock.time()) ##get a time_struct for Now.
     #we can't edit a time_struct, so make a tuple list of it that we can:
     nfresh=list(s)
     #nfresh[3]=hour, [4]=min, [5]=sec.
@@ -468,3 +3695,681 @@ def next_refresh(refresh_interval):
     return calendar.timegm(nfresh) #return epoch time for next refresh
 
 
+##Multiple lamps##
+
+##Temperature (C) to colour scale for the globes, in the format lin_interp and ColourScale take.
+TEMP_SCALE = [
+                [-30,-17, -0, 12, 20, 26, 35, 50], #degress C
+                [  0,  0,  0,100,255,255,255,255], #Red
+                [183, 65, 94,100,224,140, 55,  0], #Green
+                [  0,178,255,100,  0,  0,  0,197], #Blue
+             ]
+
+
+@functools.lru_cache(maxsize=1)
+def default_colour_scale():
+    """The ColourScale for TEMP_SCALE with a 0.1C lookup table, built once and shared."""
+    return ColourScale(TEMP_SCALE, lut_resolution=0.1)
+
+
+def wunderground_fetcher(apikey, cache=None):
+    """
+    Make a fetch(location, hours, hints) function for LampController using getUWeather.\n
+
+    It returns a ForecastSeries holding just those hours, or raises getUWeather's ForecastErrors.
+    hints is filled in as getUWeather does.
+    """
+    def fetch(location, hours, hints=None):
+        return ForecastSeries.from_hourly(getUWeather(apikey, location, cache=cache, hours=hours,
+                                                      hints=hints))
+    return fetch
+
+
+class Lamp:
+    """
+    One globe run by a LampController: its light object, the location and
+    forecast time (hours ahead) it shows, and how the forecast maps to colour
+    (a ColourScale, default from TEMP_SCALE) and pulses (a PrecipRules table).
+    """
+    def __init__(self, lightobj, location, foretime=3, scale=None, rules=None, name=None):
+        self.light = lightobj
+        self.location = location
+        self.foretime = int(foretime)
+        self.scale = scale if scale is not None else default_colour_scale()
+        self.rules = rules if rules is not None else DEFAULT_PRECIP_RULES
+        self.name = name if name is not None else location
+        self.rgb = (0, 0, 0) #What the light is showing now.
+
+    def timeline(self, series, start, stop):
+        """Frames showing this lamp's hour of series from monotonic time start until stop.\n
+
+        Fades from the current colour to the new one first. If series is
+        None, or is missing the hour, the lamp pulses dimly instead.
+        """
+        try:
+            forecast = series.hour(self.foretime)
+        except (AttributeError, KeyError):
+            print(self.name+": no forecast, pulsing dimly.")
+            rgb, pulses, intensity = (0, 0, 0), 5, 100
+        else:
+            rgb = self.scale.rgb(forecast['tempC'])
+            pulses, intensity = self.rules.pulses(forecast['condition'], forecast['pop'])
+            print(self.name, ": ", forecast['tempC'], "C, ", forecast['condition'],
+                  ", pulses: ", pulses, sep="")
+
+        fade = fade_timeline(self.rgb, rgb, start)
+        fade_time = 50*0.1
+        self.rgb = rgb
+        return itertools.chain(fade, pulse_timeline(rgb[0], rgb[1], rgb[2], pulses, intensity,
+                                                    start+fade_time, stop))
+
+
+class LampController:
+    """
+    Runs many lamps from one process and one thread.\n
+
+    fetch(location, hours, hints) is called once per distinct location per
+    refresh, with the forecast hours the lamps at that location need, and
+    must return a ForecastSeries (or raise), e.g. from wunderground_fetcher().
+    hints is a dict to fill in with the server's cache_hints. fetch can
+    instead be a WeatherProvider, which gets every location in one
+    fetch_many() call, batched if its service allows. Fetches
+    run in the background, starting prefetch_lead seconds before each refresh.\n
+
+    Refreshes are timed by scheduler, a RefreshScheduler (by default one
+    every refresh_interval minutes). If any location failed, or was only
+    served stale from a cache, they all retry with its backoff and the
+    server's retry_after; otherwise the server's max_age is respected.
+    All lamps' animations are merged into one timeline by play_timelines.
+    Once all the lamps are holding steady colours the process sleeps until
+    the refresh, or until the wake Event is set (e.g. from a signal handler)
+    to refresh straight away.
+    """
+    def __init__(self, lamps, fetch, refresh_interval=30, prefetch_lead=20, scheduler=None):
+        self.lamps = list(lamps)
+        self.refresh_interval = refresh_interval
+        self.prefetch_lead = prefetch_lead
+        self.scheduler = scheduler or RefreshScheduler(refresh_interval)
+        self.wake = threading.Event()
+
+        self.prefetchers = {} #location: Prefetcher, or None: one Prefetcher for all of them.
+        if isinstance(fetch, WeatherProvider):
+            locations = list(dict.fromkeys(lamp.location for lamp in self.lamps))
+            hours = sorted(set(lamp.foretime for lamp in self.lamps))
+            self.prefetchers[None] = Prefetcher(self._with_hints(fetch.fetch_many, locations, hours))
+            return
+        for lamp in self.lamps:
+            if lamp.location not in self.prefetchers:
+                hours = sorted(set(l.foretime for l in self.lamps if l.location == lamp.location))
+                self.prefetchers[lamp.location] = Prefetcher(self._with_hints(fetch, lamp.location, hours))
+
+    @staticmethod
+    def _with_hints(fetch, *args):
+        """A function calling fetch(*args, hints) with a new hints dict, returning (result, hints)."""
+        def fetch_with_hints():
+            hints = {}
+            return fetch(*args, hints=hints), hints
+        return fetch_with_hints
+
+    def _next_refresh(self, results, hints):
+        """Monotonic time of the next refresh, from the scheduler, given this refresh's results and hints."""
+        retry_afters = [getattr(series, 'retry_after', None) for series in results.values()
+                        if isinstance(series, Exception)]
+        retry_afters += [h.get('retry_after') for h in hints if h.get('stale')]
+        if retry_afters:
+            known = [r for r in retry_afters if r is not None]
+            return self.scheduler.failure(max(known) if known else None)
+        max_ages = [h['max_age'] for h in hints if h.get('max_age') is not None]
+        return self.scheduler.success(min(max_ages) if max_ages else None)
+
+    def run(self, cycles=None, report=None):
+        """Show the forecasts, refreshing as the scheduler says, for cycles refreshes (forever if None)."""
+        for prefetch in self.prefetchers.values():
+            prefetch.start() #all locations download at the same time.
+
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            results = {}
+            hints = []
+            for location, prefetch in self.prefetchers.items():
+                try:
+                    result, result_hints = prefetch.result()
+                    hints.append(result_hints)
+                except Exception as err:
+                    result = err
+                if location is not None:
+                    result = {location: result}
+                elif isinstance(result, Exception): #the whole batch failed.
+                    result = dict.fromkeys(set(lamp.location for lamp in self.lamps), result)
+                results.update(result)
+
+            stop = self._next_refresh(results, hints)
+            refresh_epoch = epoch_from_monotonic(stop)
+            for prefetch in self.prefetchers.values():
+                prefetch.start(at=refresh_epoch-self.prefetch_lead)
+
+            for name, series in results.items():
+                if isinstance(series, Exception):
+                    print(name+": error getting forecast:", series)
+                    results[name] = None
+
+            start = _clock.monotonic()
+            players = [(lamp.light, lamp.timeline(results[lamp.location], start, stop))
+                       for lamp in self.lamps]
+            play_timelines(players, report)
+            if wait_until(stop, self.wake): #lamps holding a steady colour finish early.
+                self.wake.clear()
+                for prefetch in self.prefetchers.values():
+                    prefetch.start_now()
+            cycle += 1
+
+    def shutdown(self):
+        """Fade all lamps out and stop their lights."""
+        start = _clock.monotonic()
+        play_timelines([(lamp.light, fade_timeline(lamp.rgb, (0, 0, 0), start)) for lamp in self.lamps])
+        for lamp in self.lamps:
+            lamp.rgb = (0, 0, 0)
+            lamp.light.shutdown()
+
+
+##Shared forecast proxy##
+
+class HTTPKeepAlive:
+    """
+    Makes HTTP(S) GET requests, keeping one connection open per host so
+    repeated requests don't pay for a new connection each time.
+    A connection that turns out to have been closed is reopened and the
+    request tried once more. Replies are asked for gzip-compressed, and
+    decompressed before they're returned.
+    """
+    def __init__(self, timeout=2):
+        self.timeout = timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        """GET url, returning (status, headers, body bytes). Network errors are raised."""
+        import http.client
+        import urllib.parse
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/')+('?'+parts.query if parts.query else '')
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+
+        metrics = _metrics
+        if metrics is not None:
+            started = time.perf_counter()
+        with self._lock:
+            for attempt in (0, 1):
+                connection = self._connections.get(key)
+                if connection is None:
+                    if parts.scheme == 'https':
+                        connection = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+                    else:
+                        connection = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+                    self._connections[key] = connection
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except (http.client.HTTPException, ConnectionError):
+                    connection.close()
+                    del self._connections[key]
+                    if attempt:
+                        raise
+                    continue
+                except OSError: #e.g. timeouts, don't retry.
+                    connection.close()
+                    del self._connections[key]
+                    raise
+                if response.will_close:
+                    connection.close()
+                    del self._connections[key]
+                break
+        if metrics is not None:
+            metrics.observe('fetch_seconds', time.perf_counter()-started)
+            metrics.observe('fetch_bytes', len(body))
+        if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16+zlib.MAX_WBITS)
+        return response.status, response.headers, body
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+
+class ForecastProxy:
+    """
+    Local forecast daemon: owns the upstream fetches for any number of lamps
+    and serves the parsed forecasts to them over a Unix socket.\n
+
+    fetch(location) must return a ForecastSeries or raise, e.g. a
+    WeatherProvider's fetch method.
+    Each location is fetched at most once every interval seconds however many
+    clients ask for it; clients asking while a fetch is running wait for it.
+    If a fetch fails the last forecast (or the error) carries on being
+    served, without asking upstream again until a RefreshScheduler's backoff
+    for that location, or the server's retry_after, has passed.\n
+
+    The protocol is one JSON object per line each way: the client sends
+    {"location": ...}, the reply is {"ok": true, "series": ForecastSeries.to_dict()}
+    or {"ok": false, "error": message}. Replies are encoded once per download.
+    """
+    def __init__(self, fetch, socket_path, interval=600):
+        import socketserver
+        import json
+        self.fetch = fetch
+        self.socket_path = socket_path
+        self.interval = interval
+        self._replies = {} #location: (monotonic time fetched, encoded reply)
+        self._failed = {} #location: (monotonic time to try again, encoded reply meanwhile)
+        self._schedulers = {} #location: RefreshScheduler, for its backoff.
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.upstream_requests = 0
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path) #left over from last time.
+
+        proxy = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        location = json.loads(line)['location']
+                    except (ValueError, KeyError, TypeError):
+                        self.wfile.write(b'{"ok": false, "error": "bad request"}\n')
+                        continue
+                    self.wfile.write(proxy.reply(location))
+                    self.wfile.flush()
+
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self.server.daemon_threads = True
+
+    def _ready(self, location):
+        """The reply to give without fetching, if the last one is fresh or a retry isn't due, else None."""
+        now = _clock.monotonic()
+        cached = self._replies.get(location)
+        if cached is not None and now-cached[0] < self.interval:
+            return cached[1]
+        failed = self._failed.get(location)
+        if failed is not None and now < failed[0]:
+            return failed[1]
+        return None
+
+    def reply(self, location):
+        """Encoded reply for location, fetching it upstream if it's missing or older than interval."""
+        import json
+        reply = self._ready(location)
+        if reply is not None:
+            return reply
+
+        with self._lock:
+            lock = self._locks.setdefault(location, threading.Lock())
+            scheduler = self._schedulers.get(location)
+            if scheduler is None:
+                scheduler = self._schedulers[location] = RefreshScheduler(
+                    self.interval/60, device_id=location, jitter=0, backoff_max=self.interval)
+        with lock: #only one upstream fetch per location at a time.
+            reply = self._ready(location)
+            if reply is not None:
+                return reply #another client's fetch got it, or failed.
+            try:
+                self.upstream_requests += 1
+                series = self.fetch(location)
+            except Exception as err:
+                print(location+": forecast fetch failed:", err)
+                cached = self._replies.get(location)
+                if cached is not None:
+                    reply = cached[1]
+                else:
+                    reply = (json.dumps({'ok': False, 'error': str(err)})+'\n').encode()
+                self._failed[location] = (scheduler.failure(getattr(err, 'retry_after', None)), reply)
+                return reply
+            reply = (json.dumps({'ok': True, 'series': series.to_dict()})+'\n').encode()
+            self._replies[location] = (_clock.monotonic(), reply)
+            self._failed.pop(location, None)
+            scheduler.success()
+            return reply
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread. Returns self."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+class ForecastProxyClient:
+    """Gets forecasts from a ForecastProxy over its Unix socket, keeping the connection open."""
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def series(self, location):
+        """Return the ForecastSeries for location. Raises ValueError if the proxy has none."""
+        import json
+        request = (json.dumps({'location': location})+'\n').encode()
+        with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(request)
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("Forecast proxy closed the connection")
+                    break
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise ValueError(reply['error'])
+        return ForecastSeries.from_dict(reply['series'])
+
+    def fetcher(self):
+        """A fetch(location, hours, hints) function for LampController. The daemon does the scheduling, so hints stay empty."""
+        def fetch(location, hours, hints=None):
+            return self.series(location)
+        return fetch
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+
+##Weather providers##
+
+class WeatherProvider:
+    """
+    Gets hourly forecasts as ForecastSeries from one weather service.\n
+
+    Subclasses implement fetch(location, hours=None, hints=None), which
+    returns a ForecastSeries or raises ForecastUnavailable (try again later)
+    or ForecastError (don't). hours, if given, are the forecast hours that
+    are needed, so a provider can ask for less. hints, if a dict, is filled
+    in with the server's cache_hints. Services that can answer for many
+    locations in one request also override fetch_many.\n
+
+    All requests go over one HTTPKeepAlive, which can be shared between
+    providers, asking for gzip-compressed replies.
+    """
+    name = None
+
+    def __init__(self, connection=None, timeout=2):
+        self.connection = connection if connection is not None else HTTPKeepAlive(timeout)
+
+    def fetch(self, location, hours=None, hints=None):
+        raise NotImplementedError
+
+    def fetch_many(self, locations, hours=None, hints=None):
+        """
+        Fetch the forecasts for several locations, returning a dict of
+        location: ForecastSeries, or the ForecastError for that location.
+        hints, if a dict, is filled in from the replies as for fetch().
+        """
+        results = {}
+        for location in locations:
+            try:
+                results[location] = self.fetch(location, hours, hints)
+            except ForecastError as err:
+                results[location] = err
+        return results
+
+    def cache_key(self, location, hours=None):
+        """The ForecastCache key fetch_cached keeps location's forecast under, for those hours."""
+        key = ('series', self.name, location)
+        if hours is not None:
+            key = key+(','.join(str(h) for h in sorted(hours)),)
+        return key
+
+    def fetch_cached(self, cache, location, hours=None, hints=None):
+        """
+        fetch() through a ForecastCache: a fresh cached forecast is returned
+        without asking the server, and a stale one if the server can't be
+        reached for now. The series' retrieved_epoch is when it was downloaded.
+        hints are filled in as getUWeather does.
+        """
+        if hints is None:
+            hints = {}
+        key = self.cache_key(location, hours)
+        entry = cache.get(key)
+        if entry is not None and cache.is_fresh(entry):
+            if _metrics is not None:
+                _metrics.count('cache_hits')
+            hints.update(cache.hints(key, entry))
+            return ForecastSeries.from_dict(entry['data'])
+        try:
+            series = self.fetch(location, hours, hints)
+        except ForecastUnavailable as err:
+            if entry is None:
+                raise
+            print("Using cached forecast from", round(cache.age(entry)), "seconds ago.")
+            if _metrics is not None:
+                _metrics.count('cache_stale_hits')
+            hints['stale'] = True
+            if err.retry_after is not None:
+                hints['retry_after'] = err.retry_after
+            return ForecastSeries.from_dict(entry['data'])
+        if _metrics is not None:
+            _metrics.count('cache_misses')
+        cache.put(key, series.to_dict(), max_age=hints.get('max_age'))
+        return series
+
+    def _error_message(self, parsed_json):
+        """The service's explanation in a decoded error reply, or None."""
+        return None
+
+    def _get(self, url, hints=None):
+        """GET url and return the decoded JSON reply, raising ForecastError or ForecastUnavailable."""
+        import json
+        import http.client
+        try:
+            status, headers, body = self.connection.get(url)
+        except (OSError, http.client.HTTPException) as err:
+            raise _network_error(err) from err
+        if hints is not None:
+            hints.update(cache_hints(headers))
+        try:
+            parsed_json = json.loads(body.decode(headers.get_content_charset() or 'utf-8'))
+        except ValueError as err:
+            parsed_json = err
+        if status != 200:
+            message = None if isinstance(parsed_json, ValueError) else self._error_message(parsed_json)
+            raise _status_error(status, message or "HTTP status "+str(status)+" from "+url, headers)
+        if isinstance(parsed_json, ValueError):
+            raise ForecastError("Reply from "+url+" isn't JSON: "+str(parsed_json))
+        return parsed_json
+
+    def close(self):
+        self.connection.close()
+
+
+class WundergroundProvider(WeatherProvider):
+    """
+    wunderground.com hourly forecasts. Locations are 'Country/City' outside
+    the USA and 'TWO_LETTER_STATE/City' inside, e.g. 'UK/Bristol'. The API
+    has no batch requests, so fetch_many asks for each location in turn,
+    over the one connection. base_url can point at another server with the
+    same API, e.g. lampi_sim's FakeForecastServer.
+    """
+    name = 'wunderground'
+
+    def __init__(self, apikey, base_url=WUNDERGROUND_URL, connection=None, timeout=2):
+        super().__init__(connection, timeout)
+        self.apikey = apikey
+        self.base_url = base_url
+
+    def fetch(self, location, hours=None, hints=None):
+        parsed_json = self._get(self.base_url+self.apikey+"/hourly/q/"+location+".json", hints)
+        error = _wunderground_error(parsed_json)
+        if error is not None:
+            raise ForecastError(error)
+        try:
+            return ForecastSeries.from_hourly(parsed_json)
+        except (KeyError, TypeError, ValueError) as err:
+            raise ForecastError("Not a wunderground.com hourly forecast: "+repr(err)) from err
+
+
+OPEN_METEO_URL = 'https://api.open-meteo.com/v1/forecast'
+OPEN_METEO_CUSTOMER_URL = 'https://customer-api.open-meteo.com/v1/forecast'
+
+##WMO weather interpretation codes, as Open-Meteo gives, in the wunderground.com
+##condition phrases PrecipRules matches.
+WMO_CONDITIONS = {0: 'Clear', 1: 'Scattered Clouds', 2: 'Partly Cloudy', 3: 'Overcast',
+                  45: 'Fog', 48: 'Freezing Fog',
+                  51: 'Light Drizzle', 53: 'Drizzle', 55: 'Heavy Drizzle',
+                  56: 'Light Freezing Drizzle', 57: 'Heavy Freezing Drizzle',
+                  61: 'Light Rain', 63: 'Rain', 65: 'Heavy Rain',
+                  66: 'Light Freezing Rain', 67: 'Heavy Freezing Rain',
+                  71: 'Light Snow', 73: 'Snow', 75: 'Heavy Snow', 77: 'Snow Grains',
+                  80: 'Light Rain Showers', 81: 'Rain Showers', 82: 'Heavy Rain Showers',
+                  85: 'Light Snow Showers', 86: 'Heavy Snow Showers',
+                  95: 'Thunderstorm', 96: 'Thunderstorms with Small Hail',
+                  99: 'Heavy Thunderstorms with Hail'}
+
+
+class OpenMeteoProvider(WeatherProvider):
+    """
+    open-meteo.com hourly forecasts. Locations are 'latitude,longitude'
+    strings, e.g. '51.45,-2.59'. fetch_many asks for up to batch_size
+    locations in each request. The free API needs no key; give apikey to
+    use the commercial one.\n
+
+    Hour 0 is the next whole hour, as with wunderground.com, and weather
+    codes become wunderground.com condition phrases (see WMO_CONDITIONS),
+    so the same PrecipRules work for both.
+    """
+    name = 'open-meteo'
+    HOURLY = ('temperature_2m', 'wind_speed_10m', 'precipitation_probability', 'precipitation',
+              'weather_code')
+
+    def __init__(self, apikey=None, base_url=None, batch_size=50, connection=None, timeout=5):
+        super().__init__(connection, timeout)
+        self.apikey = apikey
+        if base_url is None:
+            base_url = OPEN_METEO_URL if apikey is None else OPEN_METEO_CUSTOMER_URL
+        self.base_url = base_url
+        self.batch_size = batch_size
+
+    @staticmethod
+    def coordinates(location):
+        """(latitude, longitude) from a 'latitude,longitude' location, raising ForecastError if it isn't one."""
+        try:
+            latitude, longitude = (float(part) for part in location.split(','))
+        except (ValueError, AttributeError):
+            raise ForecastError("Open-Meteo locations are 'latitude,longitude', not "+repr(location))
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ForecastError("Location out of range: "+repr(location))
+        return latitude, longitude
+
+    def fetch(self, location, hours=None, hints=None):
+        return self._request([self.coordinates(location)], hours, hints)[0]
+
+    def fetch_many(self, locations, hours=None, hints=None):
+        results = {}
+        wanted = []
+        for location in dict.fromkeys(locations):
+            try:
+                wanted.append((location, self.coordinates(location)))
+            except ForecastError as err:
+                results[location] = err
+        for i in range(0, len(wanted), self.batch_size):
+            batch = wanted[i:i+self.batch_size]
+            try:
+                forecasts = self._request([coordinates for location, coordinates in batch], hours, hints)
+            except ForecastError as err:
+                forecasts = [err]*len(batch)
+            for (location, coordinates), series in zip(batch, forecasts):
+                results[location] = series
+        return results
+
+    def _request(self, coordinates, hours=None, hints=None):
+        """One request for all the coordinates, returning a ForecastSeries for each in order."""
+        import urllib.parse
+        query = {'latitude': ','.join(str(latitude) for latitude, longitude in coordinates),
+                 'longitude': ','.join(str(longitude) for latitude, longitude in coordinates),
+                 'hourly': ','.join(self.HOURLY), 'timeformat': 'unixtime', 'timezone': 'GMT',
+                 'precipitation_unit': 'mm'}
+        if hours:
+            query['forecast_hours'] = max(hours)+2 #the current hour, then up to the last one wanted.
+        if self.apikey is not None:
+            query['apikey'] = self.apikey
+        replies = self._get(self.base_url+'?'+urllib.parse.urlencode(query, safe=','), hints)
+        if isinstance(replies, dict): #a single location isn't sent as a list.
+            replies = [replies]
+        if not isinstance(replies, list) or len(replies) != len(coordinates):
+            raise ForecastError("Open-Meteo sent the wrong number of forecasts")
+        retrieved = _clock.time()
+        return [self.series(reply, hours, retrieved) for reply in replies]
+
+    def _error_message(self, parsed_json):
+        if isinstance(parsed_json, dict) and parsed_json.get('error'):
+            return "Open-Meteo: "+str(parsed_json.get('reason'))
+        return None
+
+    @classmethod
+    def series(cls, reply, hours=None, retrieved_epoch=None):
+        """
+        Build a ForecastSeries from one location's Open-Meteo reply (with
+        timeformat=unixtime), keeping only hours if given. Precipitation
+        comes in millimetres (or inches), and is kept in cm.
+        """
+        series = ForecastSeries(retrieved_epoch)
+        try:
+            hourly = reply['hourly']
+            columns = [hourly['time']]+[hourly[name] for name in cls.HOURLY]
+        except (KeyError, TypeError) as err:
+            raise ForecastError("Not an Open-Meteo hourly forecast, missing "+str(err)) from err
+        unit = (reply.get('hourly_units') or {}).get('precipitation', 'mm')
+        to_cm = 2.54 if unit == 'inch' else 0.1
+        wanted = None if hours is None else set(hours)
+
+        hour = 0
+        for epoch, temp, wind, pop, precipitation, code in zip(*columns):
+            if epoch <= series.retrieved_epoch:
+                continue #the hour that's already begun.
+            if temp is not None and (wanted is None or hour in wanted):
+                #Missing values are null, far enough ahead.
+                series.append(hour, epoch, float(temp), float(wind or 0), float(pop or 0),
+                              float(precipitation or 0)*to_cm, WMO_CONDITIONS.get(code, 'Unknown'))
+            hour += 1
+        return series
+
+
+##Providers by name, each made with a provider's API key (or None if it doesn't need one).
+PROVIDERS = {'wunderground': WundergroundProvider,
+             'open-meteo': OpenMeteoProvider}
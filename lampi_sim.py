@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+"""
+lampi_sim.py
+Simulation tools for lampi_lib, for testing without a Pi or the internet:
+generated forecasts, a local fake forecast server, a simulated fleet
+of lamps to check refresh scheduling against it, and replay of recorded
+forecasts through a lamp on a virtual clock.
+
+Run it to compare the fleet's load on the server with and without
+RefreshScheduler's jitter and backoff, or with --replay DIR to replay
+the forecasts recorded in DIR (or in a ForecastArchive file).
+"""
+
+import lampi_lib as ll
+import io
+import os
+import json
+import gzip
+import time
+import bisect
+import heapq
+import threading
+import contextlib
+import http.server
+import urllib.parse
+import argparse
+
+
+def sample_hourly_forecast(hours=36, start_epoch=1500000000):
+    """Make a dict in the layout of a wunderground.com hourly forecast, with hours entries."""
+    conditions = ['Clear', 'Partly Cloudy', 'Chance of Rain', 'Light Rain', 'Rain',
+                  'Heavy Rain', 'Thunderstorm', 'Overcast', 'Light Snow', 'Fog']
+    hourly = []
+    for h in range(hours):
+        epoch = start_epoch+h*3600
+        t = time.gmtime(epoch)
+        condition = conditions[h % len(conditions)]
+        hourly.append({
+            'FCTTIME': {'hour': str(t.tm_hour), 'hour_padded': '%02d' % t.tm_hour,
+                        'min': '00', 'min_unpadded': '0', 'sec': '0',
+                        'year': str(t.tm_year), 'mon': str(t.tm_mon), 'mon_padded': '%02d' % t.tm_mon,
+                        'mon_abbrev': time.strftime('%b', t), 'mday': str(t.tm_mday),
+                        'mday_padded': '%02d' % t.tm_mday, 'yday': str(t.tm_yday-1),
+                        'isdst': '0', 'epoch': str(epoch),
+                        'pretty': time.strftime('%I:%M %p UTC on %B %d, %Y', t),
+                        'civil': time.strftime('%I:%M %p', t), 'month_name': time.strftime('%B', t),
+                        'month_name_abbrev': time.strftime('%b', t),
+                        'weekday_name': time.strftime('%A', t),
+                        'weekday_name_night': time.strftime('%A', t)+' Night',
+                        'weekday_name_abbrev': time.strftime('%a', t),
+                        'weekday_name_unlang': time.strftime('%A', t),
+                        'weekday_name_night_unlang': time.strftime('%A', t)+' Night',
+                        'ampm': time.strftime('%p', t), 'tz': '', 'age': '', 'UTCDATE': ''},
+            'temp': {'english': str(50+h % 20), 'metric': str(10+h % 11)},
+            'dewpoint': {'english': '40', 'metric': '4'},
+            'condition': condition,
+            'icon': condition.lower().replace(' ', ''),
+            'icon_url': 'http://icons.wxug.com/i/c/k/'+condition.lower().replace(' ', '')+'.gif',
+            'fctcode': str(h % 24),
+            'sky': str(h*7 % 100),
+            'wspd': {'english': '9', 'metric': str(10+h % 15)},
+            'wdir': {'dir': 'SW', 'degrees': '225'},
+            'wx': condition,
+            'uvi': '1',
+            'humidity': '70',
+            'windchill': {'english': '-9999', 'metric': '-9999'},
+            'heatindex': {'english': '-9999', 'metric': '-9999'},
+            'feelslike': {'english': '50', 'metric': '10'},
+            'qpf': {'english': '0.0', 'metric': '' if h % 3 else '0.2'},
+            'snow': {'english': '0.0', 'metric': '0'},
+            'pop': str(h*13 % 101),
+            'mslp': {'english': '30.0', 'metric': '1016'},
+        })
+    return {'response': {'version': '0.1',
+                         'termsofService': 'http://www.wunderground.com/weather/api/d/terms.html',
+                         'features': {'hourly': 1}},
+            'hourly_forecast': hourly}
+
+
+##WMO weather codes for sample_hourly_forecast()'s conditions, for Open-Meteo replies.
+SAMPLE_WMO_CODES = {'Clear': 0, 'Partly Cloudy': 2, 'Chance of Rain': 80, 'Light Rain': 61, 'Rain': 63,
+                    'Heavy Rain': 65, 'Thunderstorm': 95, 'Overcast': 3, 'Light Snow': 71, 'Fog': 45}
+
+
+def sample_open_meteo_forecast(latitude, longitude, hours=36, start_epoch=1500000000):
+    """Make one location's Open-Meteo hourly forecast (timeformat=unixtime) with sample_hourly_forecast()'s weather."""
+    hourly = sample_hourly_forecast(hours, start_epoch)['hourly_forecast']
+    return {'latitude': latitude, 'longitude': longitude, 'generationtime_ms': 0.1,
+            'utc_offset_seconds': 0, 'timezone': 'GMT', 'timezone_abbreviation': 'GMT', 'elevation': 10.0,
+            'hourly_units': {'time': 'unixtime', 'temperature_2m': '°C', 'wind_speed_10m': 'km/h',
+                             'precipitation_probability': '%', 'precipitation': 'mm', 'weather_code': 'wmo code'},
+            'hourly': {'time': [int(h['FCTTIME']['epoch']) for h in hourly],
+                       'temperature_2m': [float(h['temp']['metric']) for h in hourly],
+                       'wind_speed_10m': [float(h['wspd']['metric']) for h in hourly],
+                       'precipitation_probability': [int(h['pop']) for h in hourly],
+                       'precipitation': [float(h['qpf']['metric'] or 0)*10 for h in hourly], #cm to mm.
+                       'weather_code': [SAMPLE_WMO_CODES[h['condition']] for h in hourly]}}
+
+
+class FakeForecastServer:
+    """
+    Local HTTP server answering wunderground.com style hourly forecast
+    requests (.../hourly/q/<location>.json) with sample_hourly_forecast(),
+    and Open-Meteo style ones (/v1/forecast?latitude=...&longitude=...,
+    any number of locations) with sample_open_meteo_forecast() starting
+    at the current hour. Replies are gzip-compressed if asked for.\n
+
+    At most capacity requests (None for unlimited) are answered in each
+    second of sim_time, which a simulation sets as it goes (the wall clock
+    if None); the rest get 503 with a Retry-After of retry_after seconds.
+    max_age, if given, is sent as Cache-Control max-age. Each request is
+    logged in requests as (time, location, status), and bytes_sent counts
+    the reply bodies' bytes.
+    """
+    def __init__(self, hours=36, capacity=None, retry_after=60, max_age=None, port=0):
+        self.hours = hours
+        self.payload = json.dumps(sample_hourly_forecast(hours)).encode('utf-8')
+        self.compressed_payload = gzip.compress(self.payload)
+        self._open_meteo_samples = {} #(hours, start epoch): sample_open_meteo_forecast()
+        self.bytes_sent = 0
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.max_age = max_age
+        self.sim_time = None
+        self.requests = []
+        self._per_second = {}
+        self._lock = threading.Lock()
+
+        fake = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True #or kept-alive clients wait on delayed ACKs.
+
+            def do_GET(self):
+                status = fake._admit(self.path)
+                if status == 200:
+                    compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+                    if self.path.startswith('/v1/forecast'):
+                        status, payload = fake._open_meteo(self.path)
+                        if compress:
+                            payload = gzip.compress(payload)
+                    else:
+                        payload = fake.compressed_payload if compress else fake.payload
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json; charset=utf-8')
+                    if compress:
+                        self.send_header('Content-Encoding', 'gzip')
+                    if fake.max_age is not None:
+                        self.send_header('Cache-Control', 'max-age='+str(int(fake.max_age)))
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    with fake._lock:
+                        fake.bytes_sent += len(payload)
+                    self.wfile.write(payload)
+                else:
+                    self.send_response(503)
+                    self.send_header('Retry-After', str(int(fake.retry_after)))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:'+str(self.server.server_address[1])+'/api/'
+        self.open_meteo_url = 'http://127.0.0.1:'+str(self.server.server_address[1])+'/v1/forecast'
+
+    def _open_meteo(self, path):
+        """(status, body) answering an Open-Meteo request for path."""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        try:
+            latitudes = [float(v) for v in query['latitude'][0].split(',')]
+            longitudes = [float(v) for v in query['longitude'][0].split(',')]
+            hours = int(query.get('forecast_hours', [self.hours])[0])
+        except (KeyError, ValueError) as err:
+            return 400, json.dumps({'error': True, 'reason': 'Bad request: '+str(err)}).encode('utf-8')
+        if len(latitudes) != len(longitudes):
+            return 400, json.dumps({'error': True, 'reason': 'Latitude and longitude must have'
+                                    ' the same number of elements'}).encode('utf-8')
+        now = time.time() if self.sim_time is None else self.sim_time
+        start = int(now//3600*3600)
+        sample = self._open_meteo_samples.get((hours, start))
+        if sample is None:
+            sample = self._open_meteo_samples[hours, start] = sample_open_meteo_forecast(0, 0, hours, start)
+        forecasts = [dict(sample, latitude=lat, longitude=lon) for lat, lon in zip(latitudes, longitudes)]
+        return 200, json.dumps(forecasts[0] if len(forecasts) == 1 else forecasts).encode('utf-8')
+
+    def provider(self, name='wunderground'):
+        """A lampi_lib WeatherProvider that asks this server, as name."""
+        if name == 'open-meteo':
+            return ll.OpenMeteoProvider(base_url=self.open_meteo_url)
+        return ll.WundergroundProvider('SIMKEY', base_url=self.url)
+
+    def _admit(self, path):
+        with self._lock:
+            now = time.time() if self.sim_time is None else self.sim_time
+            second = int(now)
+            count = self._per_second.get(second, 0)+1
+            self._per_second[second] = count
+            status = 503 if self.capacity is not None and count > self.capacity else 200
+            if path.startswith('/v1/forecast'):
+                location = urllib.parse.unquote(path.partition('?')[2])
+            else:
+                location = path.split('/q/', 1)[-1].rsplit('.json', 1)[0]
+            self.requests.append((now, location, status))
+        return status
+
+    def peak_rate(self, since=None):
+        """Most requests received in any one second, optionally only from time since on."""
+        return max((count for second, count in self._per_second.items()
+                    if since is None or second >= since), default=0)
+
+    def start(self):
+        """Serve in a background thread. Returns self."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def simulate_fleet(devices=100, hours=6, interval=30, capacity=10, jitter=120, baseline=False,
+                   start_epoch=1500000000):
+    """
+    Simulate a fleet of lamps refreshing from a FakeForecastServer for hours of
+    simulated time, which runs as fast as the requests can be made.\n
+
+    Each lamp makes real getUWeather requests to the local server on the
+    times its RefreshScheduler gives. With baseline True the lamps behave as
+    before RefreshScheduler: no jitter, and a fixed 5 minute wait after a
+    failure. Returns a dict of statistics.
+    """
+    now = [0.0] #simulated monotonic time, seconds since the start.
+    server = FakeForecastServer(capacity=capacity).start()
+
+    schedulers = []
+    for n in range(devices):
+        if baseline:
+            scheduler = ll.RefreshScheduler(interval, 'lamp'+str(n), jitter=0, backoff_base=300,
+                                            backoff_max=300, retry_budget=float('inf'),
+                                            monotonic=lambda: now[0], wall=lambda: start_epoch+now[0])
+        else:
+            scheduler = ll.RefreshScheduler(interval, 'lamp'+str(n), jitter=jitter,
+                                            monotonic=lambda: now[0], wall=lambda: start_epoch+now[0])
+        schedulers.append(scheduler)
+
+    #All lamps switched on together, as after a power cut.
+    events = [(0.0, n) for n in range(devices)]
+    heapq.heapify(events)
+    end = hours*3600
+    successes = failures = 0
+    stale = 0.0 #total lamp-seconds spent without a fresh forecast.
+    failed_since = {}
+
+    try:
+        while events and events[0][0] < end:
+            now[0], n = heapq.heappop(events)
+            server.sim_time = start_epoch+now[0]
+            hints = {}
+            try:
+                with contextlib.redirect_stdout(io.StringIO()): #getUWeather is chatty.
+                    ll.getUWeather('SIMKEY', 'SIM/Lamp'+str(n), hints=hints, base_url=server.url)
+            except ll.ForecastError:
+                failures += 1
+                failed_since.setdefault(n, now[0])
+                retry_after = None if baseline else hints.get('retry_after')
+                heapq.heappush(events, (schedulers[n].failure(retry_after), n))
+            else:
+                successes += 1
+                stale += now[0]-failed_since.pop(n, now[0])
+                heapq.heappush(events, (schedulers[n].success(hints.get('max_age')), n))
+    finally:
+        server.stop()
+
+    stale += sum(end-t for t in failed_since.values())
+    return {'devices': devices, 'hours': hours, 'capacity': capacity, 'baseline': baseline,
+            'requests': successes+failures, 'successes': successes, 'failures': failures,
+            'peak_rate': server.peak_rate(),
+            'steady_peak_rate': server.peak_rate(since=start_epoch+interval*60),
+            'mean_stale_seconds': stale/devices}
+
+
+def write_sample_recordings(directory, days=1, start_epoch=1500000000, every=3600):
+    """Write sample_hourly_forecast()s recorded every seconds for days into directory, for replay()."""
+    os.makedirs(directory, exist_ok=True)
+    for epoch in range(start_epoch, start_epoch+int(days*86400), every):
+        #Forecasts start with the next whole hour.
+        forecast = sample_hourly_forecast(start_epoch=epoch-epoch % 3600+3600)
+        with open(os.path.join(directory, str(epoch)+'.json'), 'w') as f:
+            json.dump(forecast, f)
+
+
+def load_recordings(directory):
+    """
+    Read recorded forecasts from directory for replay(), as a list of
+    (epoch recorded, hourly forecast dict) in time order. See
+    ll.read_recorded_forecast for the files it reads.
+    """
+    recordings = [ll.read_recorded_forecast(os.path.join(directory, name))
+                  for name in os.listdir(directory) if name.endswith('.json')]
+    recordings.sort(key=lambda recording: recording[0])
+    return recordings
+
+
+def load_archive(path, start_epoch=None, end_epoch=None):
+    """
+    Read the forecasts retrieved from start_epoch up to end_epoch (None for
+    no limit) out of a ll.ForecastArchive for replay(), as a list of
+    (epoch retrieved, ForecastSeries) in time order.
+    """
+    archive = ll.ForecastArchive(path)
+    try:
+        return [(series.retrieved_epoch, series) for series in archive.downloads(start_epoch, end_epoch)]
+    finally:
+        archive.close()
+
+
+def replay(recordings, foretime=3, refresh=30, start_epoch=None, end_epoch=None,
+           scale=None, rules=None, animate=True):
+    """
+    Run the run_weatherlight.py loop over recorded forecasts on a VirtualClock
+    and a SimulatedBackend, as fast as it will go.\n
+
+    recordings is a list as from load_recordings() or load_archive(). The lamp runs from
+    start_epoch (the first recording by default) to end_epoch (one refresh
+    after the last recording), at each refresh using the latest recording
+    made by then. With animate False the fades and pulses are skipped and
+    time just moves on, for replaying months at a time.\n
+
+    Returns (timeline, backend). timeline has a dict for every refresh: when
+    it was, the forecast used, the colour and pulses shown, until when, and
+    the animation frames shown. backend holds every duty cycle write.
+    """
+    if scale is None:
+        scale = ll.default_colour_scale()
+    recorded = [recording[0] for recording in recordings]
+    if start_epoch is None:
+        start_epoch = recorded[0]
+    if end_epoch is None:
+        end_epoch = recorded[-1]+refresh*60
+
+    clock = ll.VirtualClock(start_epoch)
+    old_clock = ll.set_clock(clock)
+    try:
+        backend = ll.SimulatedBackend()
+        globe = ll.light(19, 21, 23, backend=backend)
+        scheduler = ll.RefreshScheduler(refresh, 'replay')
+        frames = [0]
+        def count_frame(index, late):
+            frames[0] += 1
+
+        timeline = []
+        current_rgb = (0, 0, 0)
+        while clock.time() < end_epoch:
+            now = clock.time()
+            n = max(0, bisect.bisect_right(recorded, now)-1)
+            data = recordings[n][1]
+            if not isinstance(data, ll.ForecastSeries):
+                data = ll.ForecastSeries.from_hourly(data, now)
+            forecast = data.hour(foretime)
+            rgb = scale.rgb(forecast['tempC'])
+            pulses, intensity = ll.pulsefreq_fromrain(forecast, rules)
+            refresh_epoch = min(ll.epoch_from_monotonic(scheduler.success()), end_epoch)
+
+            frames[0] = 0
+            if animate:
+                ll.crossfade(globe, current_rgb, rgb, report=count_frame)
+                ll.pulse_light(globe, *rgb, pulses, intensity, refresh_epoch, report=count_frame)
+            else:
+                globe.set_rgb(*rgb)
+                ll.sleep_until(ll.monotonic_from_epoch(refresh_epoch))
+            current_rgb = rgb
+
+            timeline.append({'epoch': now, 'recorded': recordings[n][0],
+                             'forecast_epoch': forecast['forecast_time'].timestamp(),
+                             'tempC': forecast['tempC'], 'condition': forecast['condition'],
+                             'pop': forecast['pop'], 'rgb': list(rgb), 'pulses': pulses,
+                             'intensity': intensity, 'until': clock.time(), 'frames': frames[0]})
+        globe.shutdown()
+    finally:
+        ll.set_clock(old_clock)
+    return timeline, backend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a fleet of lamps refreshing forecasts,'
+                                     ' or replay recorded forecasts through a lamp.')
+    parser.add_argument("-d", "--devices", default=100, type=int, help="Lamps in the fleet. Default 100")
+    parser.add_argument("--hours", default=6, type=int, help="Simulated hours. Default 6")
+    parser.add_argument("-c", "--capacity", default=10, type=int,
+                        help="Requests a second the fake server can answer. Default 10")
+    parser.add_argument("--replay", default=None, metavar="DIR",
+                        help="Instead, replay the recorded forecasts in DIR, or a forecast archive"
+                        " file, through one lamp on a virtual clock, printing its timeline as"
+                        " JSON lines.")
+    parser.add_argument("--write-samples", default=None, type=float, metavar="DAYS",
+                        help="With --replay, first write DAYS of sample forecasts into DIR.")
+    parser.add_argument("-f", "--foretime", default=3, type=int,
+                        help="Replay: how far in advance to forecast, hours. Default 3")
+    parser.add_argument("-r", "--refresh", default=30, type=int,
+                        help="Replay: refresh time, minutes. Default 30")
+    parser.add_argument("--no-animate", action="store_true",
+                        help="Replay: skip the fades and pulses, just schedule them.")
+    args = parser.parse_args()
+
+    if args.replay:
+        if args.write_samples:
+            write_sample_recordings(args.replay, args.write_samples)
+        started = time.perf_counter()
+        if os.path.isdir(args.replay):
+            recordings = load_recordings(args.replay)
+        else:
+            recordings = load_archive(args.replay)
+        timeline, backend = replay(recordings, args.foretime, args.refresh,
+                                   animate=not args.no_animate)
+        wall = time.perf_counter()-started
+        for refresh in timeline:
+            print(json.dumps(refresh))
+        simulated = timeline[-1]['until']-timeline[0]['epoch'] if timeline else 0
+        print(json.dumps({'refreshes': len(timeline), 'simulated_seconds': simulated,
+                          'wall_seconds': wall, 'writes': len(backend.times),
+                          'speedup': simulated/wall if wall else None}))
+        raise SystemExit
+
+    for baseline in (True, False):
+        print(json.dumps(simulate_fleet(args.devices, args.hours, capacity=args.capacity,
+                                        baseline=baseline)))
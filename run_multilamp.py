@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+run_multilamp.py
+www.henryleach.com
+Run several weather globes from one Pi and one process. Each globe
+has its own pins, location and forecast time; globes showing the same
+location share one download.
+
+The config file is JSON, for example:
+{
+ "apikey": "0123456789abcdef",
+ "refresh": 30,
+ "lamps": [
+  {"name": "hall", "pins": [19, 21, 23], "location": "UK/Bristol", "foretime": 3},
+  {"name": "kitchen", "pins": [11, 13, 15], "location": "UK/Bristol", "foretime": 6},
+  {"name": "office", "pins": [29, 31, 33], "location": "TX/El_Paso"}
+ ]
+}
+
+"provider" can also be given, as "open-meteo" with "latitude,longitude"
+locations: then all locations are fetched together in one request, and
+"apikey" is only needed for its commercial API.
+"""
+
+import lampi_lib as ll
+import os
+import json
+import signal
+import socket
+import argparse
+
+parser = argparse.ArgumentParser(description='Run several weather globes from one process.')
+parser.add_argument("config", help="JSON file listing the lamps, see the top of this script.")
+parser.add_argument("-b", "--backend", default="rpi", choices=sorted(ll.BACKENDS),
+                    help="LED output backend: rpi (RPi.GPIO), pigpio (pigpiod DMA-timed PWM, or hardware"
+                    " PWM on pins 12/32 and 33/35, no CPU use while idle)"
+                    " or sim (no hardware, log writes). Default rpi")
+parser.add_argument("--proxy", default=None,
+                    help="Unix socket of a forecast_daemon.py to get forecasts from.")
+parser.add_argument("--cache-dir", default=os.path.expanduser("~/.cache/lampi"),
+                    help="Directory to keep downloaded forecasts in. Empty string for memory only.")
+parser.add_argument("--metrics-port", default=None, type=int,
+                    help="Collect metrics (frame timing, writes, downloads) and serve them"
+                    " in Prometheus' text format on this localhost port.")
+parser.add_argument("--metrics-file", default=None,
+                    help="Collect metrics and write them to this file every minute.")
+parser.add_argument("--fixed-frames", action="store_true",
+                    help="Always use the effects' fixed frame counts, rather than fitting"
+                    " the frames to how fast this Pi writes them.")
+args = parser.parse_args()
+
+##Metrics are only collected if asked for, they cost next to nothing otherwise.
+metrics = None
+if args.metrics_port or args.metrics_file:
+    metrics = ll.enable_metrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.flush_every(args.metrics_file)
+
+##Fewer, longer frames on a slow or busy Pi, so fades and pulses keep time.
+if not args.fixed_frames:
+    ll.enable_governor()
+
+with open(args.config) as f:
+    config = json.load(f)
+
+##All lamps share one backend, and one cache of forecasts.
+backend = ll.BACKENDS[args.backend]()
+forecast_cache = ll.ForecastCache(args.cache_dir or None, ttl=config.get('cache_ttl', 10)*60)
+
+lamps = []
+for lamp_config in config['lamps']:
+    R_pin, G_pin, B_pin = lamp_config['pins']
+    lamps.append(ll.Lamp(ll.light(R_pin, G_pin, B_pin, backend=backend),
+                         lamp_config['location'],
+                         lamp_config.get('foretime', 3),
+                         name=lamp_config.get('name')))
+
+provider = config.get('provider', 'wunderground')
+if args.proxy:
+    fetch = ll.ForecastProxyClient(args.proxy).fetcher()
+elif provider == 'wunderground':
+    fetch = ll.wunderground_fetcher(config['apikey'], forecast_cache)
+else:
+    fetch = ll.PROVIDERS[provider](config.get('apikey')) #a WeatherProvider, batched.
+
+##Each device gets its own fixed offset from the refresh boundaries, so a
+##fleet doesn't all ask for forecasts at once, and backs off after failures.
+scheduler = ll.RefreshScheduler(config.get('refresh', 30),
+                                device_id=socket.gethostname()+os.path.abspath(args.config))
+controller = ll.LampController(lamps, fetch, refresh_interval=config.get('refresh', 30),
+                               scheduler=scheduler)
+
+##Program can be stopped by a keyboard interrupt (ctrl+c) at the consol.
+##Signals: SIGUSR1 refreshes the forecast now, SIGTERM stops as ctrl+c does.
+##The lamp sleeps until its next change or a signal, it never polls for them.
+signal.signal(signal.SIGUSR1, lambda signum, frame: controller.wake.set())
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+try:
+    controller.run()
+except KeyboardInterrupt:
+    pass
+
+##Fade out, close the connections and tidy up.
+controller.shutdown()
+backend.cleanup()
+
+if args.metrics_file:
+    metrics.flush(args.metrics_file) #the last minute's worth.
+ll.disable_metrics()
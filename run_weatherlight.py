@@ -9,9 +9,15 @@ precipitation, base colour is temperature.
 """
 
 import lampi_lib as ll
-import RPi.GPIO as GPIO
 import time
+import os
 import argparse
+##socket, signal, threading and itertools aren't needed until the lamp
+##is lit, so they're imported after that.
+
+##Time how long it takes from the process starting to the lamp lighting up.
+startup = ll.StartupTimer()
+startup.mark("imports")
 
 ##command line arguments for user, plus defaults and help details.
 parser = argparse.ArgumentParser(description='Script to collect weather data from'
@@ -22,14 +28,56 @@ parser = argparse.ArgumentParser(description='Script to collect weather data fro
                                  'on a scale from -30C (green) to +50C (red).'
                                  )
 ## APIKEY LOCATION -f foretime -r refresh_min
-parser.add_argument("apikey", help="wunderground.com 16-char apikey.")
-parser.add_argument("location", help="<country(or US state)>/<city>.")
+parser.add_argument("apikey", help="wunderground.com 16-char apikey. For open-meteo, a key"
+                    " for its commercial API, or - for the free one.")
+parser.add_argument("location", help="<country(or US state)>/<city>. For open-meteo,"
+                    " <latitude>,<longitude>.")
 parser.add_argument("-f", "--foretime", default=3, choices=range(12),
                     help="How far in advance to forecast, hours. Default 3", type=int)
 parser.add_argument("-r ", "--refresh", default=30, choices=range(5,59),
                     help="Refresh time, minutes. Default 30", type=int)
+parser.add_argument("-b", "--backend", default="rpi", choices=sorted(ll.BACKENDS),
+                    help="LED output backend: rpi (RPi.GPIO), pigpio (pigpiod DMA-timed PWM, or hardware"
+                    " PWM on pins 12/32 and 33/35, no CPU use while idle)"
+                    " or sim (no hardware, log writes). Default rpi")
+parser.add_argument("--provider", default="wunderground", choices=sorted(ll.PROVIDERS),
+                    help="Weather service to get forecasts from. Default wunderground")
+parser.add_argument("--proxy", default=None,
+                    help="Unix socket of a forecast_daemon.py to get forecasts from,"
+                    " instead of downloading them directly.")
+parser.add_argument("--rules", default=None,
+                    help="JSON file of precipitation conditions and pulse intensities"
+                    " to use instead of the built in ones.")
+parser.add_argument("--cache-dir", default=os.path.expanduser("~/.cache/lampi"),
+                    help="Directory to keep downloaded forecasts in, so they survive"
+                    " restarts and network outages. Empty string for memory only.")
+parser.add_argument("--cache-ttl", default=10, type=int,
+                    help="Minutes a cached forecast is used before checking for a new one. Default 10")
+parser.add_argument("--metrics-port", default=None, type=int,
+                    help="Collect metrics (frame timing, writes, downloads) and serve them"
+                    " in Prometheus' text format on this localhost port.")
+parser.add_argument("--metrics-file", default=None,
+                    help="Collect metrics and write them to this file every minute.")
+parser.add_argument("--archive", default=None,
+                    help="Keep every forecast downloaded in this forecast archive file,"
+                    " for replay (lampi_sim.py --replay) and analysis. Downloads whole"
+                    " forecasts rather than just the hour shown.")
+parser.add_argument("--split", action="store_true",
+                    help="Drive the LED from a separate, higher priority process, so"
+                    " downloads and parsing can't make the pulses stutter.")
+parser.add_argument("--control", default=None, metavar="SOCKET",
+                    help="Take commands (notification pulses, brightness, off/on) as JSON"
+                    " lines on this Unix socket, e.g. from home automation.")
+parser.add_argument("--control-port", default=None, type=int,
+                    help="Take the same commands POSTed over HTTP on this localhost port.")
+parser.add_argument("--fixed-frames", action="store_true",
+                    help="Always use the effects' fixed frame counts, rather than fitting"
+                    " the frames to how fast this Pi writes them.")
 
 args = parser.parse_args()
+control = args.control is not None or args.control_port is not None
+if control and args.split:
+    parser.error("Commands need the LED in this process, so can't be used with --split.")
 print("Options chosen:\n",
       "API key:", args.apikey,
       "Location:", args.location,".",
@@ -45,16 +93,91 @@ green_pin = 21
 blue_pin = 23
 run = True #If True, main light and refresh data loop will run.
 
+##Initialise light object with correct board pins. In split mode the light
+##lives in a driver process, started before any threads are.
+if args.split:
+    driver = ll.LightDriverProcess([(red_pin, green_pin, blue_pin)], backend=args.backend)
+    globe = driver.lights[0]
+else:
+    driver = None
+    globe = ll.light(red_pin, green_pin, blue_pin, backend=ll.BACKENDS[args.backend]())
+
+##With commands, wake (see below) is also their queue, and the globe
+##carries them out between frames and while it waits.
+if control:
+    wake = ll.CommandQueue()
+    globe = ll.ControlledLight(globe, wake)
+
+##Show the last colour straight away, so the lamp isn't dark while
+##everything else starts up and the forecast downloads.
+colour_file = os.path.join(args.cache_dir, "colour") if args.cache_dir else None
+current_rgb = (0, 0, 0) #What the LED is showing now.
+if colour_file:
+    current_rgb = ll.load_colour(colour_file) or current_rgb
+globe.set_rgb(*current_rgb)
+startup.mark("first light")
+
+import socket
+import signal
+import threading
+import itertools
+
+##Signals: SIGUSR1 refreshes the forecast now, SIGTERM stops as ctrl+c does.
+##The lamp sleeps until its next change or a signal, it never polls for them.
+if not control:
+    wake = threading.Event()
+signal.signal(signal.SIGUSR1, lambda signum, frame: wake.set())
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+##Metrics are only collected if asked for, they cost next to nothing otherwise.
+metrics = None
+if args.metrics_port or args.metrics_file:
+    metrics = ll.enable_metrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.flush_every(args.metrics_file)
+
+##Fewer, longer frames on a slow or busy Pi, so fades and pulses keep time.
+if not args.fixed_frames:
+    ll.enable_governor()
+
 ##Scale for RGB intensity combinations to give the correct
 ##temperature/colour scale.
-temp_scale = [
-                [-30,-17, -0, 12, 20, 26, 35, 50], #degress C
-                [  0,  0,  0,100,255,255,255,255], #Red
-                [183, 65, 94,100,224,140, 55,  0], #Green
-                [  0,178,255,100,  0,  0,  0,197], #Blue
-             ]
-##Initialise light object with correct board pins
-globe = ll.light(red_pin, green_pin, blue_pin)
+##See ll.TEMP_SCALE for the table.
+temp_scale = ll.TEMP_SCALE
+##Compile the scale once, with a 0.1C lookup table, rather than
+##interpolating every channel on every refresh.
+colour_scale = ll.ColourScale(temp_scale, lut_resolution=0.1)
+
+##Which weather conditions make the light pulse.
+if args.rules:
+    precip_rules = ll.PrecipRules.from_file(args.rules)
+else:
+    precip_rules = ll.DEFAULT_PRECIP_RULES
+
+##Keep the last forecast so the lamp can carry on through restarts and outages.
+forecast_cache = ll.ForecastCache(args.cache_dir or None, ttl=args.cache_ttl*60)
+
+##The archive needs every hour of each forecast, otherwise only download the one shown.
+if args.archive:
+    forecast_archive = ll.ForecastArchive(args.archive)
+    wanted_hours = None
+else:
+    forecast_archive = None
+    wanted_hours = [args.foretime]
+archived = [None] #the forecast last archived; a 304 Not Modified gives the same one back.
+
+##wunderground.com forecasts are streamed and revalidated by getUWeather,
+##other services go through their WeatherProvider.
+if args.provider == 'wunderground':
+    provider = None
+    cache_key = ll.wunderground_cache_key(args.location, wanted_hours)
+    service_url = 'http://www.wunderground.com'
+else:
+    provider = ll.PROVIDERS[args.provider](None if args.apikey == '-' else args.apikey)
+    cache_key = provider.cache_key(args.location, wanted_hours)
+    service_url = provider.base_url
 
 ##Check forecase time
 if args.foretime < 0 or args.foretime > 12:
@@ -69,67 +192,171 @@ if args.refresh < 5 or args.refresh > 60:
     print("Refresh time out of range (10-60 minutes). Set to 15 minutes.")
     globe.colour(0,255,255,1) #flash cyan to tell user.
     
-##Can we connect to our website?
-if ll.check_connection('http://www.wunderground.com'):
+##Can we connect to our website? (The forecast daemon does that for us.)
+##Not worth checking if there's a cached forecast to start with.
+if args.proxy:
+    proxy_client = ll.ForecastProxyClient(args.proxy)
+elif forecast_cache.get(cache_key) is not None:
+    print("Starting with the cached forecast.")
+elif ll.check_connection(service_url):
     print("Internet connection available.")
     globe.colour(0,255,0,1) #green if true
 else:
     globe.colour(255,0,0,5) #red if can't connect
     print("No internet connection.")
     run = False #stop the run.
+globe.set_rgb(*current_rgb) #back to the last colour after any flashes.
+
+##How many seconds before each refresh to start downloading the next forecast,
+##so it's ready by the time it's needed.
+prefetch_lead = 20
+
+##When to refresh. Each device gets its own fixed offset from the refresh
+##boundaries, so a fleet of lamps doesn't all ask for forecasts at once, and
+##backs off when the server times out or is busy.
+scheduler = ll.RefreshScheduler(args.refresh, device_id=socket.gethostname()+args.location)
+
+def fetch_forecast():
+    """Download the forecast and pick out the hour we want, in the background.\n
+
+    Returns the forecast dict and a dict of the server's hints on when to
+    ask again. Raises ForecastUnavailable if it's worth trying again later,
+    ForecastError if not.
+    """
+    hints = {}
+    if args.proxy:
+        try:
+            return proxy_client.series(args.location).hour(args.foretime), hints
+        except (OSError, ValueError, KeyError) as err:
+            #probably temporary, try again later.
+            raise ll.ForecastUnavailable("No forecast from proxy: "+str(err)) from err
+
+    if provider is not None:
+        series = provider.fetch_cached(forecast_cache, args.location, wanted_hours, hints)
+        last = forecast_archive.last_retrieved() if forecast_archive is not None else None
+        if forecast_archive is not None and (last is None or series.retrieved_epoch > last):
+            forecast_archive.append(series)
+        return series.hour(args.foretime), hints
+
+    raw_weather_data = ll.getUWeather(args.apikey, args.location, cache=forecast_cache,
+                                      hours=wanted_hours, hints=hints)
+    ##Build the compact forecast series and pick the forecast time we're interested in
+    series = ll.ForecastSeries.from_hourly(raw_weather_data)
+    if forecast_archive is not None:
+        ##Archive each download once, as of when it was made, even across restarts.
+        entry = forecast_cache.get(cache_key)
+        last = forecast_archive.last_retrieved()
+        if (entry is not None and raw_weather_data is not archived[0]
+                and (last is None or entry['fetched'] > last)):
+            series.retrieved_epoch = entry['fetched']
+            forecast_archive.append(series)
+            archived[0] = raw_weather_data
+    return series.hour(args.foretime), hints
+
+prefetch = ll.Prefetcher(fetch_forecast)
+
+if control:
+    command_server = ll.CommandServer(wake, args.control, args.control_port).start()
+
+def show(from_rgb, rgb, pulses, intensity, until_epoch):
+    """Fade from from_rgb to rgb, then hold it, pulsing, until until_epoch.\n
+
+    Returns True if a signal cut it short.
+    """
+    if driver is None:
+        ll.crossfade(globe, from_rgb, rgb)
+        return ll.pulse_light(globe, rgb[0], rgb[1], rgb[2], pulses, intensity, until_epoch, wake=wake)
+
+    ##Hand the whole lot to the driver process ahead of time, then just wait.
+    start = time.monotonic()
+    stop = ll.monotonic_from_epoch(until_epoch)
+    timeline = itertools.chain(ll.fade_timeline(from_rgb, rgb, start),
+                               ll.pulse_timeline(rgb[0], rgb[1], rgb[2], pulses, intensity, start+5, stop))
+    if globe.play_timeline(timeline, wake) or ll.wait_until(max(stop, driver.last_deadline), wake):
+        driver.clear()
+        return True
+    return False
 
 ##Main loop. Program can be stopped by a keyboard interrupt (ctrl+c) at the consol.
 try:
     while run:
         
-        ##Get weather data
-        ##Download the raw 10 hour forcast JSON and convert to a dict.      
-        raw_weather_data = ll.getUWeather(args.apikey, args.location)
-
-        if raw_weather_data == -1:
+        ##Get weather data. Except for the first time round, this was
+        ##downloaded in the background while the last forecast was shown.
+        try:
+            forecast, hints = prefetch.result()
+        except ll.ForecastUnavailable as err:
+            ##Connection timeout error. This might be temporary...let's wait and try again
+            ##until we get a positive response or a terminal error.
+            print(err)
+            retry_epoch = ll.epoch_from_monotonic(scheduler.failure(err.retry_after))
+            print("Timeout, trying again in", round(retry_epoch-time.time()), "seconds.")
+            prefetch.start(at=retry_epoch)
+            #pulse dimly until then.
+            woken = show(current_rgb, (0, 0, 0), 5, 100, retry_epoch)
+            current_rgb = (0, 0, 0)
+            if woken:
+                wake.clear()
+                prefetch.start_now()
+        except ll.ForecastError as err:
             ##There was a terminal error getting the data, so we have to stop.
-            print("Stopped. Error getting weather data.")
+            print("Stopped. Error getting weather data:", err)
             run = False
             break
-        elif raw_weather_data == -2:
-            ##Connection timeout error. This might be temporary...let's wait and try again
-            ##until we get a positive response or a terminal error.
-            print("Timeout, waiting 5 minutes.")
-            #pulse dimly for five minutes.
-            ll.pulse_light(globe, 0, 0, 0, 5, 100, time.time()+300)
         else:
-            ##Extract the weather data for the forecase time we're interested in
-            forecast = ll.extractHourlyUWeather(raw_weather_data, args.foretime)
-
             print("In ",args.foretime," hours the temperature will be: ",forecast['tempC'], "C", sep="")
 
             ##Set the intensities to each colour.
-            r = ll.lin_interp(temp_scale, 1, forecast['tempC'])
-            g = ll.lin_interp(temp_scale, 2, forecast['tempC'])
-            b = ll.lin_interp(temp_scale, 3, forecast['tempC'])
+            r, g, b = colour_scale.rgb(forecast['tempC'])
 
-            ##Work out the next time to stop and refresh.
-            refresh_epoch = ll.next_refresh(args.refresh)
+            ##Work out the next time to stop and refresh, and get the
+            ##next forecast downloading just before then. A cached forecast
+            ##shown because the server couldn't be reached counts as a failure,
+            ##so the lamp backs off rather than asking again at every refresh.
+            if hints.get('stale'):
+                refresh_epoch = ll.epoch_from_monotonic(scheduler.failure(hints.get('retry_after')))
+            else:
+                refresh_epoch = ll.epoch_from_monotonic(scheduler.success(hints.get('max_age')))
+            print("Refresh at:", time.strftime("%H:%M:%S", time.gmtime(refresh_epoch)))
+            prefetch.start(at=refresh_epoch-prefetch_lead)
 
             print("Condition: ", forecast['condition'], " with ", forecast['pop'],"% probability.", sep="")
             
             ##Set the number of pulses based on rain forecast
-            pulses, intensity = ll.pulsefreq_fromrain(forecast)
+            pulses, intensity = ll.pulsefreq_fromrain(forecast, precip_rules)
             print("Pulses: ", pulses, ", Intensity: ", intensity,"\n", sep="")
 
-            ##Turn LED on and off smoothly. Run colour and pulsing until
-            ##next refresh time.
-            ll.ramp(globe, r, g, b, 50)
-            ll.pulse_light(globe, r, g, b, pulses, intensity, refresh_epoch)
-            ll.ramp(globe, r, g, b,-50)
-            globe.colour(0,0,0,0) #make sure the LED is really off during the refresh.
+            ##Fade from the old colour to the new one, then run colour and
+            ##pulsing until next refresh time.
+            if startup is not None:
+                startup.mark("forecast ready")
+                print(startup.report())
+                startup = None
+            if colour_file:
+                ll.save_colour(colour_file, (r, g, b))
+            woken = show(current_rgb, (r, g, b), pulses, intensity, refresh_epoch)
+            current_rgb = (r, g, b)
+            if woken:
+                print("Refreshing now.")
+                wake.clear()
+                prefetch.start_now()
+
+    ll.crossfade(globe, current_rgb, (0, 0, 0)) #Fade out before stopping.
 
 except KeyboardInterrupt:
     pass
 
 
 ##Close the connections
+if control:
+    command_server.stop()
 globe.shutdown()
+if provider is not None:
+    provider.close()
 
 ##Tidy up anything that might be left
-GPIO.cleanup()
+globe.backend.cleanup()
+
+if args.metrics_file:
+    metrics.flush(args.metrics_file) #the last minute's worth.
+ll.disable_metrics()